@@ -1,10 +1,56 @@
+import time
+
 import fastapi
+import orjson
+from fastapi.responses import JSONResponse
+
+from shared import timing, tracing
+from shared.outbox import OutboxFull
 from .sensors.controller import router as sensorsRouter
 
 app = fastapi.FastAPI(title="Senser", version="0.1.0-alpha.1")
 
 app.include_router(sensorsRouter)
 
+
+@app.exception_handler(OutboxFull)
+async def outbox_full(request: fastapi.Request, exc: OutboxFull):
+    # The broker has been down long enough to fill the outbox
+    return JSONResponse(status_code=503, content={"detail": "Broker unavailable, try again later"},
+                        headers={"Retry-After": "30"})
+
+
+@app.middleware("http")
+async def record_backend_timings(request: fastapi.Request, call_next):
+    # The header has the time spent in each backend until the response started, the log line is written once
+    # the whole body has been sent, so it also has the time of the results streamed in it
+    started = time.perf_counter()
+    timings = timing.start()
+    response = await call_next(request)
+    if timings:
+        response.headers["Server-Timing"] = timing.server_timing(timings)
+    body = response.body_iterator
+
+    async def body_iterator():
+        try:
+            async for chunk in body:
+                yield chunk
+        finally:
+            print(orjson.dumps({"method": request.method, "path": request.url.path, "status": response.status_code,
+                                "ms": round((time.perf_counter() - started) * 1000, 1),
+                                "backends": timing.summary(timings)}).decode())
+
+    response.body_iterator = body_iterator()
+    return response
+
+
+@app.middleware("http")
+async def trace_requests(request: fastapi.Request, call_next):
+    # Readings published by the request carry its trace to the consumer
+    with tracing.start_trace(f"{request.method} {request.url.path}", request.headers.get(tracing.TRACEPARENT)):
+        return await call_next(request)
+
+
 @app.get("/")
 def index():
     #Return the api name and version
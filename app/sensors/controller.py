@@ -1,21 +1,41 @@
+import asyncio
+import itertools
 import json
+from contextlib import contextmanager
 
-from fastapi import APIRouter, Depends, HTTPException, Request
+import orjson
+
+from fastapi import APIRouter, Depends, HTTPException, Request, Response, WebSocket, status
 from sqlalchemy.orm import Session
 from fastapi import Query
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from pydantic import conlist
+
+from app.sensors.live import LiveClient, LiveFeed
 
 from shared.database import SessionLocal
+from shared.outbox import get_outbox
 from shared.publisher import Publisher
 from shared.redis_client import RedisClient
 from shared.mongodb_client import MongoDBClient
 from shared.elasticsearch_client import ElasticsearchClient
-from shared.sensors.exceptions import NotCompatible
+from shared import timescale as timescale_client
+from shared.sensors.exceptions import InvalidParameter, NotCompatible
 from shared.sensors.repository import DataCommand
 from shared.timescale import Timescale
 from shared.cassandra_client import CassandraClient
-from shared.sensors import repository, schemas
+from shared.sensors import cache, repository, schemas
 
 _SENSORS = 'sensors'
+# Sensors registered by one POST /sensors/batch, the Postgres insert binds two parameters per sensor
+_MAX_BATCH_SENSORS = 10000
+# Sensors whose data is read by one GET /sensors/data
+_MAX_DATA_SENSORS = 200
+# Buckets of one page of GET /sensors/{sensor_id}/data, a page is read whole
+_MAX_DATA_LIMIT = 10000
+# Sent with a full page: the after that gets the next one
+NEXT_AFTER_HEADER = 'X-Next-After'
 
 def get_db():
     db = SessionLocal()
@@ -72,12 +92,15 @@ def get_cassandra_client():
         cassandra.close()
 
 
-publisher = Publisher()
+# Readings published while the broker is down wait in the outbox, if OUTBOX_PATH is set
+publisher = Publisher(outbox=get_outbox())
+live_feed = LiveFeed()
 
 router = APIRouter(
     prefix="/sensors",
     responses={404: {"description": "Not found"}},
     tags=["sensors"],
+    default_response_class=ORJSONResponse,
 )
 
 
@@ -90,6 +113,115 @@ def get_sensors_near(latitude: float, longitude: float, radius: float, db: Sessi
                                        longitude=longitude, radius=radius)
 
 
+# Live readings of the sensors given by ids (1,2,3) or inside box (min_latitude,min_longitude,max_latitude,
+# max_longitude). The sensors of a box are the ones it had when the client connected.
+@router.get("/live")
+def get_live_feed(ids: str | None = None, box: str | None = None):
+    sensor_ids = _get_live_sensor_ids(ids=ids, box=box)
+    return StreamingResponse(_encode_events(sensor_ids), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache"})
+
+
+@router.websocket("/live/ws")
+async def live_feed_socket(websocket: WebSocket, ids: str | None = None, box: str | None = None):
+    try:
+        sensor_ids = await run_in_threadpool(_get_live_sensor_ids, ids=ids, box=box)
+    except HTTPException as e:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION, reason=e.detail)
+        return
+    await websocket.accept()
+    client = LiveClient(sensor_ids, asyncio.get_running_loop())
+    live_feed.add(client)
+    disconnected = asyncio.create_task(_wait_for_disconnect(websocket, client))
+    try:
+        while True:
+            readings = await client.get(timeout=_KEEPALIVE_SECONDS)
+            if disconnected.done():
+                break
+            await websocket.send_text(orjson.dumps({"readings": readings, "dropped": client.take_dropped()}).decode())
+    finally:
+        disconnected.cancel()
+        live_feed.remove(client)
+
+
+_KEEPALIVE_SECONDS = 15
+
+
+def _get_live_sensor_ids(ids: str | None, box: str | None) -> list:
+    # The streams last as long as the clients stay, so the database clients are only held to find the sensors
+    # instead of being dependencies of the routes
+    try:
+        if ids:
+            return [int(sensor_id) for sensor_id in ids.split(",")]
+        if box:
+            min_latitude, min_longitude, max_latitude, max_longitude = (float(value) for value in box.split(","))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="ids must be a list of ids and box four coordinates")
+    if not box:
+        raise HTTPException(status_code=400, detail="Either ids or box must be given")
+    with SessionLocal() as db, contextmanager(get_mongodb_client)() as mongodb_client:
+        return repository.get_sensor_ids_in_box(db=db, mongo_client=mongodb_client, min_latitude=min_latitude,
+                                                min_longitude=min_longitude, max_latitude=max_latitude,
+                                                max_longitude=max_longitude)
+
+
+async def _wait_for_disconnect(websocket: WebSocket, client: LiveClient):
+    # Messages from the client are ignored, they are only read to know when it goes away
+    while (await websocket.receive())["type"] != "websocket.disconnect":
+        pass
+    client.event.set()
+
+
+async def _encode_events(sensor_ids: list):
+    client = LiveClient(sensor_ids, asyncio.get_running_loop())
+    live_feed.add(client)
+    try:
+        while True:
+            readings = await client.get(timeout=_KEEPALIVE_SECONDS)
+            dropped = client.take_dropped()
+            if dropped:
+                yield b"event: dropped\ndata: %d\n\n" % dropped
+            if readings:
+                yield b"".join(b"data: " + orjson.dumps(reading) + b"\n\n" for reading in readings)
+            else:
+                yield b": keepalive\n\n"
+    finally:
+        live_feed.remove(client)
+
+
+# Data of several sensors given by ids (1,2,3) with the same from, to and bucket as the data of one sensor,
+# one column per value for each sensor
+@router.get("/data")
+def get_sensors_data(
+        ids: str,
+        r: Request,
+        max_points: int | None = Query(None, ge=3),
+        db: Session = Depends(get_db),
+        mongodb_client: MongoDBClient = Depends(get_mongodb_client),
+        timescale: Timescale = Depends(get_timescale)):
+    try:
+        sensor_ids = [int(sensor_id) for sensor_id in ids.split(",")]
+    except ValueError:
+        raise HTTPException(status_code=400, detail="ids must be a list of ids")
+    if len(sensor_ids) > _MAX_DATA_SENSORS:
+        raise HTTPException(status_code=400, detail="At most %d sensors per request" % _MAX_DATA_SENSORS)
+    try:
+        data_command = DataCommand(
+            r.query_params.get('from'), r.query_params.get('to'), r.query_params.get('bucket'), max_points=max_points)
+        return repository.get_sensors_data(timescale=timescale, mongo_client=mongodb_client, db=db,
+                                           sensor_ids=sensor_ids, dataCommand=data_command)
+    except InvalidParameter as e:
+        raise HTTPException(status_code=400, detail=e.message)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Sensor not found")
+    except ValueError:
+        raise HTTPException(status_code=404, detail="Data not found")
+    except TypeError:
+        raise HTTPException(status_code=409, detail="Conflict - This type of sensor doesn't exist")
+    except timescale_client.ERRORS:
+        raise HTTPException(status_code=503, detail="Timescale unavailable")
+
+
 # 🙋🏽‍♀️ Add here the route to search sensors by query to Elasticsearch
 # Parameters:
 # - query: string to search
@@ -111,19 +243,48 @@ def search_sensors(query: str, size: int = 10, search_type: str = "match", db: S
 
 @router.get("/temperature/values")
 def get_temperature_values(db: Session = Depends(get_db), mongodb_client: MongoDBClient = Depends(get_mongodb_client),
-                           cassandra_client: CassandraClient = Depends(get_cassandra_client)):
-    return repository.get_temperature_values(db=db, mongo_client=mongodb_client, cassandra=cassandra_client)
+                           redis_client: RedisClient = Depends(get_redis_client)):
+    def compute():
+        with contextmanager(get_cassandra_client)() as cassandra_client:
+            return repository.get_temperature_values(db=db, mongo_client=mongodb_client, cassandra=cassandra_client)
+    return Response(content=cache.get_or_compute(redis_client, cache.TEMPERATURE_VALUES, compute),
+                    media_type="application/json")
+
+
+# Temperatures of a sensor between from and to, newest first, read from the Cassandra partitions of those days
+@router.get("/{sensor_id}/temperature")
+def get_temperature_data(sensor_id: int, r: Request, db: Session = Depends(get_db),
+                         mongodb_client: MongoDBClient = Depends(get_mongodb_client)):
+    try:
+        with contextmanager(get_cassandra_client)() as cassandra_client:
+            return repository.get_sensor_temperatures(db=db, mongo_client=mongodb_client, cassandra=cassandra_client,
+                                                      sensor_id=sensor_id, from_time=r.query_params.get('from'),
+                                                      to_time=r.query_params.get('to'))
+    except InvalidParameter as e:
+        raise HTTPException(status_code=400, detail=e.message)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Sensor not found")
+    except NotCompatible as e:
+        raise HTTPException(status_code=409, detail=e.message)
 
 
 @router.get("/quantity_by_type")
-def get_sensors_quantity(cassandra_client: CassandraClient = Depends(get_cassandra_client)):
-    return repository.get_sensors_quantity(cassandra=cassandra_client)
+def get_sensors_quantity(redis_client: RedisClient = Depends(get_redis_client)):
+    def compute():
+        with contextmanager(get_cassandra_client)() as cassandra_client:
+            return repository.get_sensors_quantity(cassandra=cassandra_client)
+    return Response(content=cache.get_or_compute(redis_client, cache.QUANTITY_BY_TYPE, compute),
+                    media_type="application/json")
 
 
 @router.get("/low_battery")
 def get_low_battery_sensors(db: Session = Depends(get_db), mongodb_client: MongoDBClient = Depends(get_mongodb_client),
-                            cassandra_client: CassandraClient = Depends(get_cassandra_client)):
-    return repository.get_low_battery_sensors(db=db, mongo_client=mongodb_client, cassandra=cassandra_client)
+                            redis_client: RedisClient = Depends(get_redis_client)):
+    def compute():
+        with contextmanager(get_cassandra_client)() as cassandra_client:
+            return repository.get_low_battery_sensors(db=db, mongo_client=mongodb_client, cassandra=cassandra_client)
+    return Response(content=cache.get_or_compute(redis_client, cache.LOW_BATTERY, compute),
+                    media_type="application/json")
 
 @router.get("")
 def get_sensors(db: Session = Depends(get_db)):
@@ -138,7 +299,15 @@ def create_sensor(sensor: schemas.SensorCreate, db: Session = Depends(get_db),
     db_sensor = repository.get_sensor_by_name(db, sensor.name)
     if db_sensor:
         raise HTTPException(status_code=400, detail="Sensor with same name already registered")
-    return repository.create_sensor(mongo_client=mongodb_client, db=db, sensor=sensor, es=es)
+    return repository.create_sensor(mongo_client=mongodb_client, db=db, sensor=sensor, es=es, publisher=publisher)
+
+
+# The length of the batch is checked before any of its sensors is validated
+@router.post("/batch")
+def create_sensors(sensors: conlist(schemas.SensorCreate, max_items=_MAX_BATCH_SENSORS), db: Session = Depends(get_db),
+                   mongodb_client: MongoDBClient = Depends(get_mongodb_client),
+                   es: ElasticsearchClient = Depends(get_elastic_search)):
+    return repository.create_sensors(mongo_client=mongodb_client, db=db, sensors=sensors, es=es, publisher=publisher)
 
 
 
@@ -157,7 +326,8 @@ def delete_sensor(sensor_id: int, db: Session = Depends(get_db),
                   redis_client: RedisClient = Depends(get_redis_client),
                   mongodb_client: MongoDBClient = Depends(get_mongodb_client)):
     try:
-        return repository.delete_sensor(db=db, mongo_client=mongodb_client, redis=redis_client, sensor_id=sensor_id)
+        return repository.delete_sensor(db=db, mongo_client=mongodb_client, redis=redis_client, sensor_id=sensor_id,
+                                         publisher=publisher)
     except FileNotFoundError:
         raise HTTPException(status_code=404, detail="Sensor not found")
 
@@ -167,13 +337,10 @@ def delete_sensor(sensor_id: int, db: Session = Depends(get_db),
 
 @router.post("/{sensor_id}/data")
 def record_data(sensor_id: int, data: schemas.SensorDataTemperature | schemas.SensorDataVelocity,
-                db: Session = Depends(get_db), redis_client: RedisClient = Depends(get_redis_client),
-                mongodb_client: MongoDBClient = Depends(get_mongodb_client),
-                cassandra_client: CassandraClient = Depends(get_cassandra_client),
-                timescale: Timescale = Depends(get_timescale)):
+                db: Session = Depends(get_db),
+                mongodb_client: MongoDBClient = Depends(get_mongodb_client)):
     try:
-        return repository.record_data(timescale=timescale, redis=redis_client, mongo_client=mongodb_client,
-                                      db=db, cassandra=cassandra_client,
+        return repository.record_data(publisher=publisher, mongo_client=mongodb_client, db=db,
                                       sensor_id=sensor_id,
                                       data=data)
     except FileNotFoundError:
@@ -186,17 +353,26 @@ def record_data(sensor_id: int, data: schemas.SensorDataTemperature | schemas.Se
 def get_data(
         sensor_id: int,
         r: Request,
+        after: str | None = None,
+        limit: int | None = Query(None, ge=1, le=_MAX_DATA_LIMIT),
+        max_points: int | None = Query(None, ge=3),
+        response_format: str = Query("json", alias="format"),
         db: Session = Depends(get_db),
         mongodb_client: MongoDBClient = Depends(get_mongodb_client),
         timescale: Timescale = Depends(get_timescale)):
     try:
         # Get the from, to and bucket from the request
         data_command = DataCommand(
-            r.query_params['from'], r.query_params['to'], r.query_params['bucket'])
+            r.query_params.get('from'), r.query_params.get('to'), r.query_params.get('bucket'),
+            after=after, limit=limit, max_points=max_points)
 
-        return repository.get_data(timescale=timescale,
+        rows = repository.get_data(timescale=timescale,
                                    mongo_client=mongodb_client, db=db,
                                    sensor_id=sensor_id,dataCommand=data_command)
+        # The query runs with the first row, before the status is sent, so its errors still get one
+        rows = _pull_first(rows)
+    except InvalidParameter as e:
+        raise HTTPException(status_code=400, detail=e.message)
     except FileNotFoundError:
         raise HTTPException(status_code=404, detail="Sensor not found")
     except ValueError:
@@ -205,6 +381,48 @@ def get_data(
         raise HTTPException(status_code=409, detail="Conflict - This type of sensor doesn't exist")
     except NotCompatible as e:
         raise HTTPException(status_code=409, detail=e.message)
+    except timescale_client.ERRORS:
+        raise HTTPException(status_code=503, detail="Timescale unavailable")
+    # The after of the next page, there is none after the last one
+    headers = {}
+    if data_command.next_after is not None:
+        headers[NEXT_AFTER_HEADER] = data_command.next_after.isoformat()
+    if response_format == "ndjson":
+        return StreamingResponse(_encode_ndjson(rows), media_type="application/x-ndjson", headers=headers)
+    return StreamingResponse(_encode_json_array(rows), media_type="application/json", headers=headers)
+
+
+_STREAM_CHUNK_ROWS = 1000
+
+
+def _pull_first(rows):
+    for first in rows:
+        return itertools.chain((first,), rows)
+    return iter(())
+
+
+def _encode_ndjson(rows):
+    chunk = []
+    for row in rows:
+        chunk.append(orjson.dumps(row) + b"\n")
+        if len(chunk) >= _STREAM_CHUNK_ROWS:
+            yield b"".join(chunk)
+            chunk = []
+    yield b"".join(chunk)
+
+
+def _encode_json_array(rows):
+    # Same body as returning the list, but sent in chunks while the cursor is read
+    yield b"["
+    separator = b""
+    chunk = []
+    for row in rows:
+        chunk.append(separator + orjson.dumps(row))
+        separator = b","
+        if len(chunk) >= _STREAM_CHUNK_ROWS:
+            yield b"".join(chunk)
+            chunk = []
+    yield b"".join(chunk) + b"]"
 
 
 class ExamplePayload():
@@ -0,0 +1,114 @@
+import asyncio
+import collections
+import threading
+import time
+
+import orjson
+import pika
+
+from shared.publisher import CONNECTION_ERRORS, LIVE_EXCHANGE, backoff, get_parameters
+
+# Readings kept for a client that doesn't read them fast enough, the oldest are dropped first
+CLIENT_BUFFER = 1000
+# Batches the broker keeps for this process while it's behind, the oldest are dropped first as well
+FEED_BUFFER = 1000
+
+
+class LiveClient:
+    # The feed thread pushes readings and the event loop of the client takes them
+
+    def __init__(self, sensor_ids, loop: asyncio.AbstractEventLoop):
+        self.sensor_ids = set(sensor_ids)
+        self.loop = loop
+        self.buffer = collections.deque(maxlen=CLIENT_BUFFER)
+        self.event = asyncio.Event()
+        self.dropped = 0
+
+    def push(self, reading: dict):
+        if len(self.buffer) == CLIENT_BUFFER:
+            self.dropped += 1
+        self.buffer.append(reading)
+
+    def wake(self):
+        self.loop.call_soon_threadsafe(self.event.set)
+
+    async def get(self, timeout: float) -> list:
+        # Every reading buffered so far, or nothing if none arrived within timeout
+        if not self.buffer:
+            try:
+                await asyncio.wait_for(self.event.wait(), timeout)
+            except asyncio.TimeoutError:
+                return []
+        self.event.clear()
+        readings = []
+        while self.buffer:
+            readings.append(self.buffer.popleft())
+        return readings
+
+    def take_dropped(self) -> int:
+        dropped, self.dropped = self.dropped, 0
+        return dropped
+
+
+class LiveFeed:
+    # One subscription to the fanout of readings for each API process, shared by all of its clients. Nothing is
+    # opened until the first client arrives.
+
+    def __init__(self, host='rabbitmq'):
+        self.parameters = get_parameters(host)
+        self.clients_by_sensor = {}
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def add(self, client: LiveClient):
+        with self.lock:
+            for sensor_id in client.sensor_ids:
+                self.clients_by_sensor.setdefault(sensor_id, set()).add(client)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name="live-feed", daemon=True)
+                self.thread.start()
+
+    def remove(self, client: LiveClient):
+        with self.lock:
+            for sensor_id in client.sensor_ids:
+                clients = self.clients_by_sensor.get(sensor_id)
+                if clients is not None:
+                    clients.discard(client)
+                    if not clients:
+                        del self.clients_by_sensor[sensor_id]
+
+    def _run(self):
+        attempt = 0
+        while True:
+            try:
+                conn = pika.BlockingConnection(self.parameters)
+                channel = conn.channel()
+                channel.exchange_declare(exchange=LIVE_EXCHANGE, exchange_type='fanout')
+                queue = channel.queue_declare(queue='', exclusive=True,
+                                              arguments={'x-max-length': FEED_BUFFER,
+                                                         'x-overflow': 'drop-head'}).method.queue
+                channel.queue_bind(queue=queue, exchange=LIVE_EXCHANGE)
+                channel.basic_consume(queue=queue, on_message_callback=self._on_message, auto_ack=True)
+                attempt = 0
+                channel.start_consuming()
+            except CONNECTION_ERRORS:
+                # Readings published while the feed is down are not replayed, clients only get newer ones
+                time.sleep(backoff(attempt))
+                attempt += 1
+
+    def _on_message(self, channel, method, properties, body):
+        with self.lock:
+            clients_by_sensor = {sensor_id: list(clients) for sensor_id, clients in self.clients_by_sensor.items()}
+        if not clients_by_sensor:
+            return
+        woken = set()
+        for reading in orjson.loads(body)['readings']:
+            for client in clients_by_sensor.get(reading['sensor_id'], ()):
+                client.push(reading)
+                woken.add(client)
+        for client in woken:
+            try:
+                client.wake()
+            except RuntimeError:
+                # The loop of the client has already been closed
+                self.remove(client)
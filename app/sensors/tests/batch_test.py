@@ -0,0 +1,75 @@
+import pytest
+from fastapi.testclient import TestClient
+
+from app.main import app
+from app.sensors import controller
+from app.sensors.tests.fakes import (FakeBroker, FakeElasticsearchClient, FakeMongoDBClient, FakePublisher,
+                                     FakeRedisClient, FakeSubscriber, fake_session_factory)
+from consumer.processor import process_control
+from shared.publisher import CONTROL, get_lane_queue
+from shared.sensors import records, repository, schemas
+from shared.subscriber import Lane
+
+
+class PartlyDownElasticsearchClient(FakeElasticsearchClient):
+    # Refuses the documents of the sensors named in refused
+    def __init__(self, refused):
+        super().__init__()
+        self.refused = refused
+
+    def bulk_index(self, index_name, documents):
+        accepted = [document for document in documents if document["name"] not in self.refused]
+        super().bulk_index(index_name, accepted)
+        return [{"index": {"status": 503, "error": "unavailable"}} if document["name"] in self.refused else None
+                for document in documents]
+
+
+@pytest.fixture
+def stores():
+    db = fake_session_factory()()
+    mongo = FakeMongoDBClient()
+    mongo.getDatabase("sensors")
+    broker = FakeBroker()
+    yield {"db": db, "mongo": mongo, "broker": broker, "publisher": FakePublisher(broker)}
+    db.close()
+
+
+def _get_sensors(*names) -> list:
+    return [schemas.SensorCreate(name=name, latitude=1.0, longitude=2.0, type="Temperatura",
+                                 mac_address="00:00:00:00:00:01", manufacturer="Dummy", model="Dummy",
+                                 serie_number="1", firmware_version="1.0", description="Dummy") for name in names]
+
+
+def _create_sensors(stores, sensors: list, es=None) -> list:
+    return repository.create_sensors(mongo_client=stores["mongo"], db=stores["db"], sensors=sensors,
+                                     es=es or FakeElasticsearchClient(), publisher=stores["publisher"])
+
+
+def test_batch_is_one_control_event_for_the_read_model(stores):
+    results = _create_sensors(stores, _get_sensors("sensor_1", "sensor_2", "sensor_1"))
+    assert [(result.name, result.created) for result in results] == \
+           [("sensor_1", True), ("sensor_2", True), ("sensor_1", False)]
+    assert len(stores["broker"].queues[get_lane_queue(CONTROL)]) == 1
+    FakeSubscriber(stores["broker"]).subscribe_lanes([Lane(
+        [get_lane_queue(CONTROL)], lambda bodies: process_control(bodies, redis=FakeRedisClient(),
+                                                                  mongo_client=stores["mongo"]),
+        batch_size=50, flush_interval=0)])
+    assert sorted(records.find_by_names(stores["mongo"], ["sensor_1", "sensor_2"])) == ["sensor_1", "sensor_2"]
+
+
+def test_sensors_that_could_not_be_indexed_are_not_created(stores):
+    results = _create_sensors(stores, _get_sensors("sensor_1", "sensor_2"),
+                              es=PartlyDownElasticsearchClient(refused={"sensor_2"}))
+    assert [(result.name, result.created) for result in results] == [("sensor_1", True), ("sensor_2", False)]
+    assert repository.get_sensor_by_name(stores["db"], "sensor_2") is None
+    assert stores["mongo"].getCollection("sensors").find_one({"name": "sensor_2"}) is None
+    # Sent again, it's registered
+    results = _create_sensors(stores, _get_sensors("sensor_2"))
+    assert [(result.name, result.created) for result in results] == [("sensor_2", True)]
+
+
+def test_batch_over_the_limit_is_refused_before_validating_it():
+    client = TestClient(app)
+    response = client.post("/sensors/batch", json=[{}] * (controller._MAX_BATCH_SENSORS + 1))
+    assert response.status_code == 422
+    assert response.json()["detail"][0]["type"] == "value_error.list.max_items"
@@ -0,0 +1,89 @@
+import pytest
+from pydantic import BaseModel
+
+from app.sensors.tests.fakes import FakeRedisClient
+from shared.sensors import cache
+
+
+class Value(BaseModel):
+    value: int
+
+
+class Compute:
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self) -> Value:
+        self.calls += 1
+        return Value(value=self.calls)
+
+
+def test_value_is_computed_once_until_bumped():
+    redis = FakeRedisClient()
+    compute = Compute()
+    assert cache.get_or_compute(redis, cache.LOW_BATTERY, compute) == '{"value": 1}'
+    assert cache.get_or_compute(redis, cache.LOW_BATTERY, compute) == b'{"value": 1}'
+    cache.bump(redis, [cache.LOW_BATTERY])
+    assert cache.get_or_compute(redis, cache.LOW_BATTERY, compute) == '{"value": 2}'
+    assert compute.calls == 2
+
+
+def test_waits_for_the_client_that_holds_the_lock(monkeypatch):
+    redis = FakeRedisClient()
+    key = cache._get_key(redis, cache.LOW_BATTERY)
+    redis.set(key + ':lock', 1)
+    # The other client stores its result while this one waits
+    monkeypatch.setattr(cache.time, "sleep", lambda seconds: redis.set(key, '{"value": 7}'))
+    compute = Compute()
+    assert cache.get_or_compute(redis, cache.LOW_BATTERY, compute) == b'{"value": 7}'
+    assert compute.calls == 0
+
+
+def test_computes_itself_when_the_lock_holder_gives_up(monkeypatch):
+    redis = FakeRedisClient()
+    key = cache._get_key(redis, cache.LOW_BATTERY)
+    redis.set(key + ':lock', 1)
+    monkeypatch.setattr(cache.time, "sleep", lambda seconds: redis.delete(key + ':lock'))
+    compute = Compute()
+    assert cache.get_or_compute(redis, cache.LOW_BATTERY, compute) == '{"value": 1}'
+    assert compute.calls == 1
+
+
+def test_lock_is_released_when_compute_fails():
+    redis = FakeRedisClient()
+
+    def compute():
+        raise RuntimeError("store down")
+
+    with pytest.raises(RuntimeError):
+        cache.get_or_compute(redis, cache.LOW_BATTERY, compute)
+    assert redis.get(cache._get_key(redis, cache.LOW_BATTERY) + ':lock') is None
+
+
+def test_a_holder_whose_lock_expired_leaves_the_lock_of_the_next_one():
+    redis = FakeRedisClient()
+    lock = cache._get_key(redis, cache.LOW_BATTERY) + ':lock'
+
+    def compute():
+        # The lock expires while computing and another client takes it
+        redis.set(lock, "other client")
+        return Value(value=1)
+
+    assert cache.get_or_compute(redis, cache.LOW_BATTERY, compute) == '{"value": 1}'
+    assert redis.get(lock) == b"other client"
+
+
+def test_waits_no_longer_than_the_lock_ttl_and_reads_the_stores(monkeypatch):
+    redis = FakeRedisClient()
+    redis.set(cache._get_key(redis, cache.LOW_BATTERY) + ':lock', "stuck client")
+    clock = [0.0]
+
+    def sleep(seconds):
+        clock[0] += seconds
+
+    monkeypatch.setattr(cache.time, "monotonic", lambda: clock[0])
+    monkeypatch.setattr(cache.time, "sleep", sleep)
+    compute = Compute()
+    assert cache.get_or_compute(redis, cache.LOW_BATTERY, compute) == '{"value": 1}'
+    assert compute.calls == 1
+    assert cache._MAX_WAIT <= clock[0] < cache._MAX_WAIT + 2 * cache._WAIT_STEP
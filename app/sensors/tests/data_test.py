@@ -0,0 +1,172 @@
+from datetime import datetime
+
+import pytest
+from fastapi.testclient import TestClient
+
+from app.main import app
+from app.sensors import controller
+from app.sensors.tests.fakes import (FakeElasticsearchClient, FakeMongoDBClient, FakePublisher, FakeTimescale,
+                                     fake_session_factory)
+from shared import timescale as timescale_client
+from shared.sensors import repository, schemas
+from shared.sensors.exceptions import InvalidParameter
+from shared.sensors.repository import DataCommand
+
+
+class DownTimescale(FakeTimescale):
+    def stream(self, query, values=None, itersize=2000):
+        raise timescale_client.ERRORS[0]("server closed the connection")
+
+
+class BucketsTimescale(FakeTimescale):
+    # The buckets the query of several sensors gives: name, period, temperature, humidity, velocity,
+    # battery_level and last_seen
+    BUCKETS = [
+        ("sensor_1", datetime(2020, 1, 1, 0), 20.0, 50.0, None, 0.9, datetime(2020, 1, 1, 0, 59)),
+        ("sensor_1", datetime(2020, 1, 1, 1), 21.0, 55.0, None, 0.8, datetime(2020, 1, 1, 1, 59)),
+        ("sensor_2", datetime(2020, 1, 1, 0), None, None, 40.0, 0.7, datetime(2020, 1, 1, 0, 30)),
+    ]
+
+    def stream(self, query, values=None, itersize=2000):
+        return iter([bucket for bucket in self.BUCKETS if bucket[0] in values[1]])
+
+
+class PagesTimescale(FakeTimescale):
+    # Hourly buckets of sensor_1 as the query of one sensor gives them: period, temperature, humidity,
+    # battery_level and last_seen. The values end with after, interval and after when paging, then the limit.
+    BUCKETS = [(datetime(2020, 1, 1, hour), 20.0 + hour, 50.0, 0.9, datetime(2020, 1, 1, hour, 59))
+               for hour in range(5)]
+
+    def stream(self, query, values=None, itersize=2000):
+        after = values[4] if "HAVING" in query else datetime.min
+        buckets = [bucket for bucket in self.BUCKETS if bucket[0] > after]
+        return iter(buckets[:values[-1]] if "LIMIT" in query else buckets)
+
+
+@pytest.fixture
+def stores():
+    db = fake_session_factory()()
+    mongo = FakeMongoDBClient()
+    mongo.getDatabase("sensors")
+    for index, sensor_type in ((1, "Temperatura"), (2, "Velocitat")):
+        repository.create_sensor(mongo_client=mongo, db=db, es=FakeElasticsearchClient(), publisher=FakePublisher(),
+                                 sensor=schemas.SensorCreate(
+                                     name=f"sensor_{index}", latitude=1.0, longitude=2.0, type=sensor_type,
+                                     mac_address=f"00:00:00:00:00:0{index}", manufacturer="Dummy", model="Dummy",
+                                     serie_number=str(index), firmware_version="1.0", description="Dummy"))
+    app.dependency_overrides[controller.get_db] = lambda: db
+    app.dependency_overrides[controller.get_mongodb_client] = lambda: mongo
+    yield
+    app.dependency_overrides.clear()
+    db.close()
+
+
+@pytest.fixture
+def client(stores):
+    app.dependency_overrides[controller.get_timescale] = DownTimescale
+    return TestClient(app)
+
+
+@pytest.fixture
+def buckets_client(stores):
+    app.dependency_overrides[controller.get_timescale] = BucketsTimescale
+    return TestClient(app)
+
+
+def test_data_command_parses_the_times_as_utc():
+    command = DataCommand("2020-01-01T01:00:00+01:00", "2020-01-02T00:00:00.000Z", None,
+                          after="2020-01-01T12:00:00Z")
+    assert command.from_time == datetime(2020, 1, 1)
+    assert command.to_time == datetime(2020, 1, 2)
+    assert command.after == datetime(2020, 1, 1, 12)
+    assert command.bucket == "day"
+
+
+def test_data_command_refuses_a_wrong_time():
+    with pytest.raises(InvalidParameter):
+        DataCommand("2020-01-01", "tomorrow", "hour")
+
+
+@pytest.mark.parametrize("bucket,max_points", [("fortnight", None), ("0m", None), ("hour", 2)])
+def test_data_command_refuses_a_wrong_bucket_or_max_points(bucket, max_points):
+    with pytest.raises(InvalidParameter):
+        DataCommand("2020-01-01", "2020-01-02", bucket, max_points=max_points)
+
+
+@pytest.mark.parametrize("bucket", ["fortnight", "0m"])
+def test_wrong_bucket_is_a_bad_request(client, bucket):
+    response = client.get(f"/sensors/1/data?from=2020-01-01T00:00:00Z&to=2020-01-02T00:00:00Z&bucket={bucket}")
+    assert response.status_code == 400
+
+
+def test_wrong_time_is_a_bad_request(client):
+    response = client.get("/sensors/1/data?from=2020-01-01T00:00:00Z&to=tomorrow&bucket=hour")
+    assert response.status_code == 400
+
+
+def test_query_error_is_sent_as_the_status(client):
+    response = client.get("/sensors/1/data?from=2020-01-01T00:00:00Z&to=2020-01-02T00:00:00Z&bucket=hour")
+    assert response.status_code == 503
+
+
+def test_data_of_several_sensors(buckets_client):
+    response = buckets_client.get("/sensors/data?ids=2,1&from=2020-01-01T00:00:00Z&to=2020-01-02T00:00:00Z"
+                                  "&bucket=hour")
+    assert response.status_code == 200
+    assert response.json() == {"sensors": {
+        "2": {"name": "sensor_2", "type": "Velocitat", "time": ["2020-01-01T00:00:00"], "velocity": [40.0],
+              "battery_level": [0.7], "last_seen": ["2020-01-01T00:30:00"]},
+        "1": {"name": "sensor_1", "type": "Temperatura", "time": ["2020-01-01T00:00:00", "2020-01-01T01:00:00"],
+              "temperature": [20.0, 21.0], "humidity": [50.0, 55.0], "battery_level": [0.9, 0.8],
+              "last_seen": ["2020-01-01T00:59:00", "2020-01-01T01:59:00"]},
+    }}
+
+
+def test_data_of_an_unknown_sensor_is_not_found(buckets_client):
+    response = buckets_client.get("/sensors/data?ids=1,3&from=2020-01-01T00:00:00Z&to=2020-01-02T00:00:00Z")
+    assert response.status_code == 404
+
+
+def test_data_of_several_sensors_with_a_wrong_time_is_a_bad_request(buckets_client):
+    response = buckets_client.get("/sensors/data?ids=1,2&from=yesterday&to=2020-01-02T00:00:00Z")
+    assert response.status_code == 400
+
+
+def test_data_of_several_sensors_with_a_query_error_is_sent_as_the_status(client):
+    response = client.get("/sensors/data?ids=1,2&from=2020-01-01T00:00:00Z&to=2020-01-02T00:00:00Z")
+    assert response.status_code == 503
+
+
+@pytest.mark.parametrize("ids", ["1,a", ",".join(str(sensor_id) for sensor_id in range(1, 202))])
+def test_data_of_wrong_ids_is_a_bad_request(buckets_client, ids):
+    response = buckets_client.get(f"/sensors/data?ids={ids}&from=2020-01-01T00:00:00Z&to=2020-01-02T00:00:00Z")
+    assert response.status_code == 400
+
+
+@pytest.mark.parametrize("path", ["/sensors/1/data?", "/sensors/data?ids=1,2&"])
+def test_fewer_than_three_points_is_a_client_error(buckets_client, path):
+    response = buckets_client.get(f"{path}from=2020-01-01T00:00:00Z&to=2020-01-02T00:00:00Z"
+                                  "&bucket=hour&max_points=2")
+    assert response.status_code == 422
+
+
+def test_pages_of_data_give_the_after_of_the_next_one(stores):
+    app.dependency_overrides[controller.get_timescale] = PagesTimescale
+    client = TestClient(app)
+    pages = []
+    url = "/sensors/1/data?from=2020-01-01T00:00:00Z&to=2020-01-02T00:00:00Z&bucket=hour&limit=2"
+    after = ""
+    while True:
+        response = client.get(url + after)
+        assert response.status_code == 200
+        pages.append([row["temperature"] for row in response.json()])
+        if controller.NEXT_AFTER_HEADER not in response.headers:
+            break
+        after = "&after=" + response.headers[controller.NEXT_AFTER_HEADER]
+    assert pages == [[20.0, 21.0], [22.0, 23.0], [24.0]]
+
+
+@pytest.mark.parametrize("limit", [0, -1, 10001])
+def test_limit_out_of_range_is_a_client_error(client, limit):
+    response = client.get(f"/sensors/1/data?from=2020-01-01T00:00:00Z&to=2020-01-02T00:00:00Z&limit={limit}")
+    assert response.status_code == 422
@@ -0,0 +1,73 @@
+import math
+
+import numpy as np
+import pytest
+
+from shared.sensors import downsampling
+
+
+def _reference_lttb(x: list, y: list, max_points: int) -> list:
+    # LTTB a point at a time, with the buckets of downsampling.lttb. A missing value counts as 0 in the average
+    # of a bucket and its triangle as smaller than any other.
+    n = len(x)
+    if max_points >= n or max_points < 3:
+        return list(range(n))
+    edges = [int(edge) for edge in np.linspace(1, n - 1, max_points - 1)]
+    selected = [0]
+    kept = 0
+    for bucket in range(max_points - 2):
+        start, end = edges[bucket], edges[bucket + 1]
+        if bucket + 2 < len(edges):
+            next_start, next_end = end, edges[bucket + 2]
+            count = next_end - next_start
+            next_x = sum(x[next_start:next_end]) / count
+            next_y = sum(0.0 if math.isnan(value) else value for value in y[next_start:next_end]) / count
+        else:
+            next_x, next_y = x[-1], y[-1]
+        best, best_area = start, -math.inf
+        for i in range(start, end):
+            area = abs((x[kept] - next_x) * (y[i] - y[kept]) - (x[kept] - x[i]) * (next_y - y[kept]))
+            if math.isnan(area):
+                area = -1.0
+            if area > best_area:
+                best, best_area = i, area
+        kept = best
+        selected.append(kept)
+    selected.append(n - 1)
+    return selected
+
+
+def _get_series(n: int, seed: int = 0):
+    x = np.arange(n, dtype=np.float64)
+    y = np.sin(x / 50) + np.random.default_rng(seed).random(n)
+    return x, y
+
+
+@pytest.mark.parametrize("n,max_points", [(1000, 100), (1000, 3), (1001, 7), (10, 9)])
+def test_lttb_keeps_the_points_of_the_reference(n, max_points):
+    x, y = _get_series(n)
+    selected = downsampling.lttb(x, y, max_points)
+    assert selected.tolist() == _reference_lttb(x.tolist(), y.tolist(), max_points)
+
+
+@pytest.mark.parametrize("max_points", [10, 11])
+def test_lttb_keeps_every_point_of_a_short_series(max_points):
+    x, y = _get_series(10)
+    assert downsampling.lttb(x, y, max_points).tolist() == list(range(10))
+
+
+def test_lttb_with_three_points_keeps_the_ends_and_one_point():
+    x, y = _get_series(1000)
+    selected = downsampling.lttb(x, y, 3)
+    assert len(selected) == 3 and selected[0] == 0 and selected[-1] == 999
+    assert 0 < selected[1] < 999
+
+
+def test_lttb_with_missing_values():
+    x, y = _get_series(1000)
+    y[::7] = np.nan
+    y[500:520] = np.nan
+    selected = downsampling.lttb(x, y, 50)
+    assert len(selected) == 50 and selected[0] == 0 and selected[-1] == 999
+    assert np.all(np.diff(selected) > 0)
+    assert selected.tolist() == _reference_lttb(x.tolist(), y.tolist(), 50)
@@ -0,0 +1,794 @@
+import collections
+import fnmatch
+import itertools
+import re
+import time
+from collections import namedtuple
+from datetime import datetime, timezone
+
+from pika.exceptions import AMQPConnectionError, NackError, UnroutableError
+from pymongo.errors import DuplicateKeyError
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+from shared.database import Base
+from shared.publisher import Publisher
+from shared.subscriber import Subscriber
+
+# In-memory stand-ins for the clients in shared, with the same methods, for the benchmarks and unit tests that
+# must not need the docker-compose services. They keep data the way the real stores do, but they only understand
+# the queries the repository sends: anything else raises NotImplementedError instead of answering something wrong.
+
+
+def fake_session_factory():
+    # SQLite in memory with the same models, one connection shared by every session
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    Base.metadata.create_all(bind=engine)
+    return sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+
+class FakeRedisClient:
+    def __init__(self, host='localhost', port=6379, db=0):
+        self._data = {}
+        self._expires = {}
+
+    def close(self):
+        pass
+
+    def ping(self):
+        return True
+
+    def get(self, key):
+        key = _redis_key(key)
+        expires = self._expires.get(key)
+        if expires is not None and expires <= time.monotonic():
+            self._data.pop(key, None)
+            self._expires.pop(key, None)
+        return self._data.get(key)
+
+    def set(self, key, value, ex=None, nx=False):
+        if nx and self.get(key) is not None:
+            return None
+        key = _redis_key(key)
+        self._data[key] = _redis_value(value)
+        if ex is None:
+            self._expires.pop(key, None)
+        else:
+            self._expires[key] = time.monotonic() + ex
+        return True
+
+    def incr(self, key):
+        value = int(self.get(key) or 0) + 1
+        self._data[_redis_key(key)] = _redis_value(value)
+        return value
+
+    def mget(self, keys):
+        return [self.get(key) for key in keys]
+
+    def set_many(self, mapping, ex=None):
+        return [self.set(key, value, ex=ex) for key, value in mapping.items()]
+
+    def delete(self, key):
+        key = _redis_key(key)
+        self._expires.pop(key, None)
+        return int(self._data.pop(key, None) is not None)
+
+    def delete_if_equal(self, key, value):
+        if self.get(key) != _redis_value(value):
+            return 0
+        return self.delete(key)
+
+    def keys(self, pattern):
+        return [key.encode() for key in list(self._data) if fnmatch.fnmatchcase(key, pattern) and self.get(key)]
+
+    def clearAll(self):
+        self._data.clear()
+        self._expires.clear()
+
+
+def _redis_key(key):
+    return key.decode() if isinstance(key, bytes) else str(key)
+
+
+def _redis_value(value):
+    # Redis stores bytes and gives bytes back
+    if isinstance(value, bytes):
+        return value
+    return str(value).encode()
+
+
+class FakeMongoDBClient:
+    def __init__(self, host="localhost", port=27017):
+        self.databases = collections.defaultdict(dict)
+        self.database = None
+        self.collection = None
+
+    def close(self):
+        pass
+
+    def ping(self):
+        return {'ok': 1.0}
+
+    def getDatabase(self, database):
+        self.database = self.databases[database]
+        return self.database
+
+    def getCollection(self, collection):
+        if collection not in self.database:
+            self.database[collection] = FakeCollection()
+        self.collection = self.database[collection]
+        return self.collection
+
+    def clearDb(self, database):
+        self.databases.pop(database, None)
+
+    def create_indexes(self, collection, indexes):
+        # indexes are (keys, options) pairs, creating an index that already exists does nothing
+        target = self.getCollection(collection)
+        return [target.create_index(keys, **options) for keys, options in indexes]
+
+    def find_by_names(self, collection, names, projection=None):
+        # The documents of all the names in one query, by name
+        documents = self.getCollection(collection).find({'name': {'$in': list(names)}}, projection)
+        return {document['name']: document for document in documents}
+
+
+InsertOneResult = namedtuple('InsertOneResult', ['inserted_id'])
+DeleteResult = namedtuple('DeleteResult', ['deleted_count'])
+UpdateResult = namedtuple('UpdateResult', ['matched_count', 'upserted'])
+
+_MONGO_OPERATORS = {
+    '$gte': lambda value, operand: value is not None and value >= operand,
+    '$lte': lambda value, operand: value is not None and value <= operand,
+    '$gt': lambda value, operand: value is not None and value > operand,
+    '$lt': lambda value, operand: value is not None and value < operand,
+    '$ne': lambda value, operand: value != operand,
+    '$in': lambda value, operand: value in operand,
+    '$nin': lambda value, operand: value not in operand,
+}
+
+
+class FakeCollection:
+    def __init__(self):
+        self.documents = []
+        self.indexes = []
+        self.unique = []
+        self._ids = itertools.count(1)
+
+    def insert_one(self, document):
+        # Like pymongo, the _id is also added to the given document
+        document.setdefault('_id', next(self._ids))
+        self._check_unique(document)
+        self.documents.append(dict(document))
+        return InsertOneResult(document['_id'])
+
+    def insert_many(self, documents):
+        return [self.insert_one(document).inserted_id for document in documents]
+
+    def find(self, filter=None, projection=None):
+        return [_project(document, projection) for document in self.documents if _matches(document, filter or {})]
+
+    def find_one(self, filter=None, projection=None):
+        for document in self.documents:
+            if _matches(document, filter or {}):
+                return _project(document, projection)
+        return None
+
+    def count_documents(self, filter):
+        return sum(1 for document in self.documents if _matches(document, filter))
+
+    def replace_one(self, filter, replacement, upsert=False):
+        for index, document in enumerate(self.documents):
+            if _matches(document, filter):
+                self._check_unique(replacement, document['_id'])
+                self.documents[index] = dict(replacement, _id=document['_id'])
+                return UpdateResult(1, False)
+        if upsert:
+            self.insert_one(dict(replacement))
+        return UpdateResult(0, upsert)
+
+    def delete_many(self, filter):
+        deleted = [document for document in self.documents if _matches(document, filter)]
+        self.documents = [document for document in self.documents if not _matches(document, filter)]
+        return DeleteResult(len(deleted))
+
+    def delete_one(self, filter):
+        for index, document in enumerate(self.documents):
+            if _matches(document, filter):
+                del self.documents[index]
+                return DeleteResult(1)
+        return DeleteResult(0)
+
+    def create_index(self, keys, **kwargs):
+        # Indexes only change how fast a real collection answers, they are recorded and only the unique ones
+        # are enforced
+        self.indexes.append((keys, kwargs))
+        if kwargs.get('unique') and isinstance(keys, str):
+            self.unique.append(keys)
+        return kwargs.get('name', str(keys))
+
+    def _check_unique(self, document, own_id=None):
+        for field in self.unique:
+            for other in self.documents:
+                if other['_id'] != own_id and field in document and other.get(field) == document[field]:
+                    raise DuplicateKeyError(f"E11000 duplicate key error dup key: {{ {field}: {document[field]!r} }}")
+
+
+def _matches(document, filter):
+    for field, condition in filter.items():
+        value = document.get(field)
+        if isinstance(condition, dict) and condition and all(key.startswith('$') for key in condition):
+            for operator, operand in condition.items():
+                if operator not in _MONGO_OPERATORS:
+                    raise NotImplementedError(operator)
+                if not _MONGO_OPERATORS[operator](value, operand):
+                    return False
+        elif value != condition:
+            return False
+    return True
+
+
+def _project(document, projection):
+    if not projection:
+        return dict(document)
+    if isinstance(projection, dict):
+        included = [field for field, include in projection.items() if include]
+        excluded = {field for field, include in projection.items() if not include}
+    else:
+        included, excluded = list(projection), set()
+    if not included:
+        return {field: value for field, value in document.items() if field not in excluded}
+    fields = included if '_id' in excluded or '_id' in included else ['_id'] + included
+    return {field: document[field] for field in fields if field in document}
+
+
+class FakeElasticsearchClient:
+    def __init__(self, host="localhost", port="9200"):
+        self.indices = {}
+
+    def ping(self):
+        return True
+
+    def clearIndex(self, index_name):
+        return self.indices.pop(index_name, None)
+
+    def close(self):
+        pass
+
+    def create_index(self, index_name):
+        self.indices.setdefault(index_name, [])
+        return {'acknowledged': True, 'index': index_name}
+
+    def create_mapping(self, index_name, mapping):
+        return {'acknowledged': True}
+
+    def index_document(self, index_name, document):
+        self.indices.setdefault(index_name, []).append(dict(document))
+        return {'result': 'created'}
+
+    def bulk_index(self, index_name, documents):
+        self.indices.setdefault(index_name, []).extend(dict(document) for document in documents)
+        return [None] * len(documents)
+
+    def search(self, index_name, query):
+        # match_phrase, match_phrase_prefix and match, with fuzziness and operator and for the last one
+        (kind, clause), = query['query'].items()
+        (field, value), = clause.items()
+        documents = self.indices.get(index_name, [])
+        if kind == 'match_phrase':
+            hits = [document for document in documents if _has_phrase(document.get(field), value, prefix=False)]
+        elif kind == 'match_phrase_prefix':
+            hits = [document for document in documents if _has_phrase(document.get(field), value, prefix=True)]
+        elif kind == 'match':
+            text = value['query'] if isinstance(value, dict) else value
+            fuzzy = isinstance(value, dict) and value.get('fuzziness') is not None
+            hits = [document for document in documents if _has_terms(document.get(field), text, fuzzy)]
+        else:
+            raise NotImplementedError(kind)
+        start = query.get('from', 0)
+        hits = hits[start:start + query.get('size', 10)]
+        return {'hits': {'total': {'value': len(hits), 'relation': 'eq'},
+                         'hits': [{'_index': index_name, '_source': document} for document in hits]}}
+
+
+def _tokens(text):
+    return re.findall(r"\w+", str(text).lower()) if text is not None else []
+
+
+def _has_phrase(text, phrase, prefix):
+    words = _tokens(text)
+    terms = _tokens(phrase)
+    if not terms:
+        return False
+    for start in range(len(words) - len(terms) + 1):
+        window = words[start:start + len(terms)]
+        if window[:-1] != terms[:-1]:
+            continue
+        if window[-1] == terms[-1] or (prefix and window[-1].startswith(terms[-1])):
+            return True
+    return False
+
+
+def _has_terms(text, query, fuzzy):
+    words = _tokens(text)
+    return bool(words) and all(any(_is_close(word, term, fuzzy) for word in words) for term in _tokens(query))
+
+
+def _is_close(word, term, fuzzy):
+    if not fuzzy:
+        return word == term
+    # AUTO fuzziness: exact up to 2 characters, one edit up to 5, two edits after that
+    allowed = 0 if len(term) <= 2 else 1 if len(term) <= 5 else 2
+    return _edit_distance(word, term) <= allowed
+
+
+def _edit_distance(a, b):
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (char_a != char_b)))
+        previous = current
+    return previous[-1]
+
+
+class FakeRows(list):
+    def one(self):
+        return self[0] if self else None
+
+
+class FakeFuture:
+    def __init__(self, rows):
+        self.rows = rows
+
+    def result(self):
+        return self.rows
+
+
+class FakeBatch:
+    def __init__(self):
+        self.statements = []
+
+    def add(self, query, values):
+        self.statements.append((query, values))
+
+
+_CQL_INSERT = re.compile(r"INSERT INTO (\w+) \(([^)]*)\) VALUES", re.IGNORECASE)
+_CQL_SELECT = re.compile(r"SELECT (.+?) FROM (\w+)(?: WHERE (.+?))?(?: GROUP BY (\w+))?(?: ALLOW FILTERING)?;?$",
+                         re.IGNORECASE)
+_CQL_CONDITION = re.compile(r"(\w+) (=|>=|<=|>|<) (\?|%s)$")
+_CQL_AGGREGATE = re.compile(r"(MAX|MIN|SUM|COUNT)\((\*|\w+)\)(?: AS \w+)?$", re.IGNORECASE)
+
+
+class FakeCassandraClient:
+    # Tables with the primary key and clustering order of CassandraClient.create_tables
+    PRIMARY_KEYS = {
+        'low_battery': ('battery_level', 'name'),
+        'type_sensor': ('sensor_type', 'id'),
+        'temperature_data_by_day': ('name', 'day_bucket', 'time'),
+        'temperature_days': ('name', 'day_bucket'),
+    }
+    DESCENDING = {'temperature_data_by_day': 'time'}
+
+    def __init__(self, hosts=None):
+        self.tables = {}
+        self.prepared = {}
+
+    def create_tables(self):
+        for table in self.PRIMARY_KEYS:
+            self.tables.setdefault(table, {})
+
+    def get_session(self):
+        return self
+
+    def close(self):
+        pass
+
+    def execute(self, query, values=None):
+        # A SimpleStatement carries its query, and the tables of system_schema are the ones with rows here
+        query = " ".join(getattr(query, 'query_string', query).split())
+        if query.startswith("SELECT table_name FROM system_schema.tables "):
+            return FakeRows((table,) for table in self.tables if table == values[1])
+        insert = _CQL_INSERT.match(query)
+        if insert:
+            self._insert(insert.group(1), [column.strip() for column in insert.group(2).split(',')], values)
+            return FakeRows()
+        select = _CQL_SELECT.match(query)
+        if select:
+            return self._select(*select.groups(), list(values or ()))
+        if query.upper().startswith(("CREATE ", "DROP ")):
+            return FakeRows()
+        raise NotImplementedError(query)
+
+    def prepare(self, query):
+        self.prepared.setdefault(query, query)
+        return query
+
+    def execute_prepared(self, query, values=None):
+        return self.execute(self.prepare(query), values)
+
+    def execute_async(self, query, values=None):
+        return FakeFuture(self.execute_prepared(query, values))
+
+    def execute_concurrent(self, statements_and_values, concurrency=None):
+        results = []
+        for statement, values in statements_and_values:
+            if isinstance(statement, FakeBatch):
+                for query, batch_values in statement.statements:
+                    self.execute(query, batch_values)
+                results.append((True, FakeRows()))
+            else:
+                results.append((True, self.execute_prepared(statement, values)))
+        return results
+
+    def unlogged_batches(self, query, rows, size=100):
+        batches = []
+        for start in range(0, len(rows), size):
+            batch = FakeBatch()
+            for values in rows[start:start + size]:
+                batch.add(self.prepare(query), values)
+            batches.append(batch)
+        return batches
+
+    def _insert(self, table, columns, values):
+        # Inserts are upserts, as in Cassandra
+        row = dict(zip(columns, (_cql_value(value) for value in values)))
+        key = tuple(row[column] for column in self.PRIMARY_KEYS[table])
+        self.tables.setdefault(table, {}).setdefault(key, {}).update(row)
+
+    def _select(self, selection, table, where, group_by, values):
+        rows = list(self.tables.get(table, {}).values())
+        for condition in (where.split(" AND ") if where else ()):
+            match = _CQL_CONDITION.match(condition.strip())
+            if match is None:
+                raise NotImplementedError(condition)
+            column, operator, _ = match.groups()
+            operand = _cql_value(values.pop(0))
+            rows = [row for row in rows if _compare(row.get(column), operator, operand)]
+        if table in self.DESCENDING:
+            rows.sort(key=lambda row: row[self.DESCENDING[table]], reverse=True)
+        items = [item.strip() for item in selection.split(',')]
+        aggregates = [_CQL_AGGREGATE.match(item) for item in items]
+        if not any(aggregates):
+            return FakeRows(tuple(row.get(item) for item in items) for row in rows)
+        groups = collections.OrderedDict()
+        for row in rows:
+            groups.setdefault(row[group_by] if group_by else None, []).append(row)
+        if not group_by and not groups:
+            groups[None] = []
+        return FakeRows(tuple(_aggregate(match, item, group) for match, item in zip(aggregates, items))
+                        for group in groups.values())
+
+
+def _cql_value(value):
+    # Timestamps are kept in UTC and come back without a time zone, as the driver returns them
+    if isinstance(value, datetime) and value.tzinfo is not None:
+        return value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+def _compare(value, operator, operand):
+    if operator == '=':
+        return value == operand
+    if value is None:
+        return False
+    if operator == '>=':
+        return value >= operand
+    if operator == '<=':
+        return value <= operand
+    if operator == '>':
+        return value > operand
+    return value < operand
+
+
+def _aggregate(match, item, rows):
+    if match is None:
+        return rows[0].get(item) if rows else None
+    function, column = match.group(1).upper(), match.group(2)
+    if function == 'COUNT':
+        return len(rows) if column == '*' else sum(1 for row in rows if row.get(column) is not None)
+    values = [row[column] for row in rows if row.get(column) is not None]
+    if function == 'SUM':
+        return sum(values)
+    if not values:
+        return None
+    return max(values) if function == 'MAX' else min(values)
+
+
+_SQL_INSERT = re.compile(r"INSERT INTO (\w+) \(([^)]*)\)", re.IGNORECASE)
+
+
+class FakeTimescale:
+    # Rows of the tables the consumer writes, by their unique key. Rows are only written here: reading them
+    # back needs time_bucket and a real Timescale.
+    UNIQUE_KEYS = {
+        'sensor_data': ('name', 'time'),
+        'sensor_data_rollup': ('name', 'bucket'),
+    }
+
+    def __init__(self):
+        self.tables = {table: {} for table in self.UNIQUE_KEYS}
+
+    def create_table(self):
+        pass
+
+    def get_cursor(self):
+        raise NotImplementedError("FakeTimescale has no cursor")
+
+    def close(self):
+        pass
+
+    def ping(self):
+        return True
+
+    def execute(self, query, values=None):
+        raise NotImplementedError(query)
+
+    def stream(self, query, values=None, itersize=2000):
+        raise NotImplementedError(query)
+
+    def execute_values(self, query, rows):
+        table, columns = self._parse_insert(query)
+        update = "DO UPDATE" in query.upper()
+        for row in rows:
+            self._upsert(table, dict(zip(columns, row)), update)
+
+    def fetch_values(self, query, rows):
+        # Only the last_seen of the rollup windows given by (name, bucket)
+        if not query.strip().startswith("SELECT sensor_data_rollup.name, sensor_data_rollup.bucket"):
+            raise NotImplementedError(query)
+        windows = self.tables['sensor_data_rollup']
+        return [(name, bucket, windows[(name, bucket)]['last_seen']) for name, bucket in rows
+                if (name, bucket) in windows]
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def copy_rows(self, table, columns, rows):
+        for row in rows:
+            self._upsert(table, dict(zip(columns, row)), update=False)
+
+    def delete(self, table):
+        self.tables[table].clear()
+
+    def _parse_insert(self, query):
+        match = _SQL_INSERT.search(query)
+        if match is None or match.group(1) not in self.UNIQUE_KEYS:
+            raise NotImplementedError(query)
+        return match.group(1), [column.strip() for column in match.group(2).split(',')]
+
+    def _upsert(self, table, row, update):
+        rows = self.tables[table]
+        key = tuple(row[column] for column in self.UNIQUE_KEYS[table])
+        current = rows.get(key)
+        if current is None:
+            rows[key] = row
+        elif update and table == 'sensor_data_rollup':
+            _merge_rollup(current, row)
+        elif update:
+            current.update(row)
+
+
+def _merge_rollup(current, row):
+    # The same merge as the ON CONFLICT of the rollup upsert in the repository
+    is_last = row['last_seen'] >= current['last_seen']
+    for column, value in row.items():
+        if column.endswith('_min'):
+            current[column] = min((v for v in (current[column], value) if v is not None), default=None)
+        elif column.endswith('_max'):
+            current[column] = max((v for v in (current[column], value) if v is not None), default=None)
+        elif column.endswith('_sum'):
+            current[column] = None if current[column] is None or value is None else current[column] + value
+        elif column.endswith('_last') and is_last:
+            current[column] = value
+    current['count'] += row['count']
+    current['last_seen'] = max(current['last_seen'], row['last_seen'])
+
+
+FakeMethod = namedtuple('FakeMethod', ['delivery_tag', 'routing_key'])
+FakeQueueDeclared = namedtuple('FakeQueueDeclared', ['method'])
+FakeQueue = namedtuple('FakeQueue', ['queue'])
+
+
+class FakeBroker:
+    # Queues, exchanges and bindings shared by the fake publishers and subscribers of a test. While down, every
+    # publish fails like a lost connection, and while refusing the broker nacks them.
+    def __init__(self):
+        self.down = False
+        self.refusing = False
+        self.queues = collections.OrderedDict()
+        self.arguments = {}
+        self.exchanges = {}
+        self.bindings = collections.defaultdict(list)
+        self._names = itertools.count(1)
+
+    def declare_queue(self, queue, arguments=None):
+        if not queue:
+            queue = f"amq.gen-{next(self._names)}"
+        self.queues.setdefault(queue, collections.deque())
+        self.arguments.setdefault(queue, arguments or {})
+        return queue
+
+    def publish(self, exchange, routing_key, body, properties):
+        if not exchange:
+            queues = [routing_key] if routing_key in self.queues else []
+        elif self.exchanges.get(exchange) == 'fanout':
+            queues = [queue for queue, _ in self.bindings[exchange]]
+        else:
+            queues = [queue for queue, pattern in self.bindings[exchange] if _topic_matches(pattern, routing_key)]
+        # Like the broker, a message nobody can receive is dropped
+        for queue in queues:
+            self.queues[queue].append((routing_key, body, properties))
+        return len(queues)
+
+    def dead_letter(self, queue, routing_key, body, properties):
+        exchange = self.arguments[queue].get('x-dead-letter-exchange')
+        if exchange:
+            self.publish(exchange, routing_key, body, properties)
+
+
+def _topic_matches(pattern, routing_key):
+    if pattern == '#':
+        return True
+    return re.fullmatch(re.escape(pattern).replace(r'\*', r'[^.]+').replace(r'\#', r'.*'), routing_key) is not None
+
+
+class FakeChannel:
+    def __init__(self, broker):
+        self.broker = broker
+        self.consumers = {}
+        self.unacked = collections.OrderedDict()
+        self.prefetch_count = 0
+        self.confirming = False
+        # In a transaction messages wait here until the commit, and those the broker returns wait in returned
+        # until the connection dispatches them to the return callback
+        self.transaction = None
+        self.commits = 0
+        self.returned = []
+        self.on_return = None
+        self._tags = itertools.count(1)
+
+    def confirm_delivery(self):
+        self.confirming = True
+
+    def tx_select(self):
+        self.transaction = []
+
+    def tx_commit(self):
+        if self.broker.down:
+            raise AMQPConnectionError("broker down")
+        messages, self.transaction = self.transaction, []
+        self.commits += 1
+        for exchange, routing_key, body, properties, mandatory in messages:
+            if not self.broker.publish(exchange, routing_key, body, properties) and mandatory:
+                self.returned.append((FakeMethod(None, routing_key), properties, body))
+
+    def add_on_return_callback(self, callback):
+        self.on_return = callback
+
+    def queue_declare(self, queue='', exclusive=False, arguments=None):
+        return FakeQueueDeclared(FakeQueue(self.broker.declare_queue(queue, arguments)))
+
+    def exchange_declare(self, exchange, exchange_type='direct'):
+        self.broker.exchanges.setdefault(exchange, exchange_type)
+
+    def queue_bind(self, queue, exchange, routing_key=None):
+        if (queue, routing_key) not in self.broker.bindings[exchange]:
+            self.broker.bindings[exchange].append((queue, routing_key))
+
+    def basic_qos(self, prefetch_count=0):
+        self.prefetch_count = prefetch_count
+
+    def basic_consume(self, queue, on_message_callback, auto_ack=False):
+        self.consumers[queue] = (on_message_callback, auto_ack)
+
+    def basic_publish(self, exchange, routing_key, body, properties=None, mandatory=False):
+        if self.broker.down:
+            raise AMQPConnectionError("broker down")
+        if self.transaction is not None:
+            self.transaction.append((exchange, routing_key, body, properties, mandatory))
+            return
+        if self.confirming and self.broker.refusing:
+            raise NackError([])
+        queues = self.broker.publish(exchange, routing_key, body, properties)
+        if self.confirming and mandatory and not queues:
+            raise UnroutableError([])
+
+    def basic_ack(self, delivery_tag, multiple=False):
+        self._settle(delivery_tag, multiple, requeue=False, rejected=False)
+
+    def basic_nack(self, delivery_tag, multiple=False, requeue=True):
+        self._settle(delivery_tag, multiple, requeue, rejected=True)
+
+    def deliver(self):
+        # Hands the waiting messages to the consumers of this channel, at most prefetch_count unacked
+        delivered = 0
+        returned, self.returned = self.returned, []
+        for method, properties, body in returned:
+            self.on_return(self, method, properties, body)
+        for queue, (callback, auto_ack) in self.consumers.items():
+            messages = self.broker.queues[queue]
+            while messages and (auto_ack or not self.prefetch_count or len(self.unacked) < self.prefetch_count):
+                routing_key, body, properties = messages.popleft()
+                tag = next(self._tags)
+                if not auto_ack:
+                    self.unacked[tag] = (queue, routing_key, body, properties)
+                callback(self, FakeMethod(tag, routing_key), properties, body)
+                delivered += 1
+        return delivered
+
+    def _settle(self, delivery_tag, multiple, requeue, rejected):
+        tags = [tag for tag in self.unacked if tag <= delivery_tag] if multiple else [delivery_tag]
+        # Requeued messages go back to the head of their queue in the order they had
+        for tag in reversed(tags) if requeue else tags:
+            queue, routing_key, body, properties = self.unacked.pop(tag)
+            if requeue:
+                self.broker.queues[queue].appendleft((routing_key, body, properties))
+            elif rejected:
+                self.broker.dead_letter(queue, routing_key, body, properties)
+
+
+class FakeConnection:
+    def __init__(self, broker):
+        self.broker = broker
+        self.channels = []
+        self.is_closed = False
+        self.is_open = True
+
+    def channel(self):
+        channel = FakeChannel(self.broker)
+        self.channels.append(channel)
+        return channel
+
+    def process_data_events(self, time_limit=0):
+        return sum(channel.deliver() for channel in self.channels)
+
+    def close(self):
+        self.is_closed = True
+        self.is_open = False
+
+
+class FakePublisher(Publisher):
+    # The real publisher, routing included, over a FakeBroker
+    def __init__(self, broker=None, outbox=None):
+        # Set first, the relay of an outbox that isn't empty starts right away
+        self.broker = broker or FakeBroker()
+        super().__init__(outbox=outbox)
+
+    def _connect(self):
+        if self.broker.down:
+            raise AMQPConnectionError("broker down")
+        return FakeConnection(self.broker)
+
+
+class FakeSubscriber(Subscriber):
+    # The real lanes over a FakeBroker. Instead of consuming forever, the subscribe methods return once every
+    # message published so far has been handled.
+    def __init__(self, broker=None):
+        self.broker = broker or FakeBroker()
+        self.conn = FakeConnection(self.broker)
+        self.channel = self.conn.channel()
+
+    def subscribe(self, callback):
+        self.channel.queue_declare(queue='test')
+        self.channel.basic_consume(queue='test', on_message_callback=callback, auto_ack=True)
+        self.conn.process_data_events()
+
+    def subscribe_lanes(self, lanes, tick=None):
+        for lane in lanes:
+            lane.open(self.conn)
+        while True:
+            self.conn.process_data_events()
+            pending = [lane for lane in lanes if lane.batch]
+            if not pending:
+                break
+            # Without waiting for the flush interval, only for the backoff of a batch that failed
+            for lane in pending:
+                if time.monotonic() >= lane.retry_at:
+                    lane.flush()
+            if tick is not None:
+                tick()
@@ -0,0 +1,94 @@
+import json
+
+import pytest
+
+from app.sensors.tests.fakes import (FakeCassandraClient, FakeElasticsearchClient, FakeMongoDBClient, FakePublisher,
+                                     FakeTimescale, fake_session_factory)
+from backfill.loader import Loader, guess_format, read_records
+from shared.sensors import repository, schemas
+
+
+class FailingTimescale(FakeTimescale):
+    # Fails the COPY of the chunk number fail_at, as if the process had died in the middle of the run
+    def __init__(self, fail_at: int):
+        super().__init__()
+        self.fail_at = fail_at
+        self.chunks = 0
+
+    def copy_rows(self, table, columns, rows):
+        self.chunks += 1
+        if self.chunks == self.fail_at:
+            raise RuntimeError("killed")
+        super().copy_rows(table, columns, rows)
+
+
+@pytest.fixture
+def stores(tmp_path):
+    db = fake_session_factory()()
+    mongo = FakeMongoDBClient()
+    mongo.getDatabase("sensors")
+    for index, sensor_type in ((1, "Temperatura"), (2, "Velocitat")):
+        repository.create_sensor(mongo_client=mongo, db=db, es=FakeElasticsearchClient(), publisher=FakePublisher(),
+                                 sensor=schemas.SensorCreate(
+                                     name=f"sensor_{index}", latitude=1.0, longitude=2.0, type=sensor_type,
+                                     mac_address=f"00:00:00:00:00:0{index}", manufacturer="Dummy", model="Dummy",
+                                     serie_number=str(index), firmware_version="1.0", description="Dummy"))
+    cassandra = FakeCassandraClient()
+    cassandra.create_tables()
+    yield {"db": db, "mongo": mongo, "cassandra": cassandra, "checkpoint": str(tmp_path / "readings.checkpoint")}
+    db.close()
+
+
+def _get_loader(stores, timescale: FakeTimescale, chunk_size: int = 2) -> Loader:
+    return Loader(db=stores["db"], mongo_client=stores["mongo"], timescale=timescale, cassandra=stores["cassandra"],
+                  checkpoint_path=stores["checkpoint"], chunk_size=chunk_size)
+
+
+def _get_record(minute: int) -> dict:
+    last_seen = f"2023-01-01T00:{minute:02d}:00"
+    return {"name": "sensor_1", "temperature": 20.0 + minute, "humidity": 50.0, "battery_level": 0.9,
+            "last_seen": last_seen}
+
+
+def _get_loaded(timescale: FakeTimescale) -> list:
+    return sorted(row["temperature"] for row in timescale.tables["sensor_data"].values())
+
+
+def test_bad_records_are_skipped(stores):
+    timescale = FakeTimescale()
+    loader = _get_loader(stores, timescale)
+    loader.load(iter([_get_record(0),
+                      dict(_get_record(1), last_seen="yesterday"),
+                      dict(_get_record(2), time="2023-13-01T00:00:00"),
+                      dict(_get_record(3), name="sensor_9"),
+                      dict(_get_record(4), temperature="hot"),
+                      {"name": "sensor_2", "velocity": 40.0, "battery_level": 0.9, "last_seen": "2023-01-01T00:05:00"},
+                      dict(_get_record(6), last_seen=None)]))
+    assert loader.skipped == 5
+    assert sorted(name for name, _ in timescale.tables["sensor_data"]) == ["sensor_1", "sensor_2"]
+
+
+def test_checkpoint_is_written_after_each_chunk(stores):
+    _get_loader(stores, FakeTimescale()).load(iter([_get_record(minute) for minute in range(5)]))
+    with open(stores["checkpoint"]) as file:
+        assert file.read() == "5"
+
+
+def test_load_resumes_after_the_last_chunk_written(stores):
+    records = [_get_record(minute) for minute in range(6)]
+    timescale = FailingTimescale(fail_at=2)
+    with pytest.raises(RuntimeError):
+        _get_loader(stores, timescale).load(iter(records))
+    assert _get_loaded(timescale) == [20.0, 21.0]
+    with open(stores["checkpoint"]) as file:
+        assert file.read() == "2"
+    _get_loader(stores, timescale).load(iter(records))
+    assert _get_loaded(timescale) == [20.0, 21.0, 22.0, 23.0, 24.0, 25.0]
+
+
+def test_records_are_read_from_csv_and_ndjson(tmp_path):
+    (tmp_path / "readings.csv").write_text("name,temperature,last_seen\nsensor_1,20.0,2023-01-01T00:00:00\n")
+    (tmp_path / "readings.jsonl").write_text(json.dumps(_get_record(0)) + "\n\n")
+    assert list(read_records(str(tmp_path / "readings.csv"), guess_format("readings.csv"))) == [
+        {"name": "sensor_1", "temperature": "20.0", "last_seen": "2023-01-01T00:00:00"}]
+    assert list(read_records(str(tmp_path / "readings.jsonl"), guess_format("readings.jsonl"))) == [_get_record(0)]
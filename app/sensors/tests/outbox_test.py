@@ -0,0 +1,143 @@
+import threading
+import time
+
+import pytest
+
+from app.sensors.tests.fakes import FakeBroker, FakePublisher
+from shared.outbox import Outbox, OutboxFull
+from shared.publisher import CONTROL, get_lane_queue
+from shared.sensors import schemas
+
+
+@pytest.fixture
+def outbox(tmp_path):
+    return Outbox(str(tmp_path / "outbox.db"))
+
+
+def _get_event(sensor_id: int) -> schemas.SensorEvent:
+    return schemas.SensorEvent(event="created", sensor_id=sensor_id, name=f"sensor_{sensor_id}")
+
+
+def _get_delivered(broker: FakeBroker) -> list:
+    return [schemas.SensorEvent.parse_raw(body).sensor_id for _, body, _ in broker.queues[get_lane_queue(CONTROL)]]
+
+
+def _wait_until(condition, timeout=10.0):
+    # The relay runs in its own thread
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_outbox_keeps_the_messages_in_order(outbox):
+    outbox.append("", "a", b"1", "id-1", None)
+    outbox.append("", "b", b"22", None, {"traceparent": "00-1-2-01"})
+    rows = outbox.peek(10)
+    assert [(exchange, routing_key, body, message_id, headers) for _, exchange, routing_key, body, message_id,
+            headers in rows] == [("", "a", b"1", "id-1", None), ("", "b", b"22", None, {"traceparent": "00-1-2-01"})]
+    outbox.remove(rows[:1])
+    assert len(outbox) == 1
+    assert outbox.size == 2
+
+
+def test_outbox_refuses_what_goes_over_its_size(tmp_path):
+    outbox = Outbox(str(tmp_path / "outbox.db"), max_bytes=3)
+    outbox.append("", "a", b"12", None, None)
+    with pytest.raises(OutboxFull):
+        outbox.append("", "a", b"34", None, None)
+    assert len(outbox) == 1
+
+
+def test_messages_are_published_directly_while_the_broker_is_up(outbox):
+    broker = FakeBroker()
+    publisher = FakePublisher(broker, outbox=outbox)
+    publisher.publish(_get_event(1), lane=CONTROL)
+    assert _get_delivered(broker) == [1]
+    assert len(outbox) == 0
+
+
+def test_messages_wait_in_the_outbox_while_the_broker_is_down(outbox):
+    broker = FakeBroker()
+    publisher = FakePublisher(broker, outbox=outbox)
+    broker.down = True
+    publisher.publish(_get_event(1), lane=CONTROL)
+    broker.down = False
+    publisher.publish(_get_event(2), lane=CONTROL)
+    _wait_until(lambda: len(outbox) == 0)
+    assert _get_delivered(broker) == [1, 2]
+
+
+def test_refused_messages_are_relayed_in_order(outbox):
+    broker = FakeBroker()
+    publisher = FakePublisher(broker, outbox=outbox)
+    broker.refusing = True
+    publisher.publish(_get_event(1), lane=CONTROL)
+    broker.refusing = False
+    publisher.publish(_get_event(2), lane=CONTROL)
+    _wait_until(lambda: len(outbox) == 0)
+    assert _get_delivered(broker) == [1, 2]
+    assert outbox.dead_letters() == []
+
+
+def test_unroutable_messages_wait_in_the_outbox(outbox):
+    broker = FakeBroker()
+    publisher = FakePublisher(broker, outbox=outbox)
+    publisher.publish(_get_event(1), lane=CONTROL)
+    # As if the broker had lost its queues, the relay declares them again when it connects
+    del broker.queues[get_lane_queue(CONTROL)]
+    publisher.publish(_get_event(2), lane=CONTROL)
+    _wait_until(lambda: len(outbox) == 0)
+    assert _get_delivered(broker) == [2]
+
+
+def test_messages_nobody_can_receive_go_to_the_dead_letters(outbox):
+    broker = FakeBroker()
+    publisher = FakePublisher(broker, outbox=outbox)
+    publisher.publish(_get_event(1), lane="nowhere")
+    publisher.publish(_get_event(2), lane=CONTROL)
+    _wait_until(lambda: len(outbox) == 0)
+    assert _get_delivered(broker) == [2]
+    assert [routing_key for _, routing_key, _, _ in outbox.dead_letters()] == [get_lane_queue("nowhere")]
+
+
+def test_relay_sends_a_batch_in_one_transaction(outbox):
+    for sensor_id in range(1, 4):
+        outbox.append("", get_lane_queue(CONTROL), _get_event(sensor_id).to_json(), None, None)
+    broker = FakeBroker()
+    publisher = FakePublisher(broker, outbox=outbox)
+    _wait_until(lambda: len(outbox) == 0)
+    assert _get_delivered(broker) == [1, 2, 3]
+    assert [conn.channels[0].commits for conn in publisher.connections] == [1]
+
+
+def test_a_publish_waiting_for_its_confirm_does_not_hold_back_the_others(outbox):
+    broker = FakeBroker()
+    publisher = FakePublisher(broker, outbox=outbox)
+    released = threading.Event()
+    publish = broker.publish
+
+    def slow_publish(exchange, routing_key, body, properties):
+        if schemas.SensorEvent.parse_raw(body).sensor_id == 1:
+            assert released.wait(timeout=10.0)
+        return publish(exchange, routing_key, body, properties)
+
+    broker.publish = slow_publish
+    slow = threading.Thread(target=publisher.publish, args=(_get_event(1),), kwargs={"lane": CONTROL})
+    slow.start()
+    publisher.publish(_get_event(2), lane=CONTROL)
+    assert _get_delivered(broker) == [2]
+    released.set()
+    slow.join()
+    assert _get_delivered(broker) == [2, 1]
+
+
+def test_relay_starts_with_what_a_previous_run_left(tmp_path):
+    outbox = Outbox(str(tmp_path / "outbox.db"))
+    outbox.append("", get_lane_queue(CONTROL), _get_event(1).to_json(), None, None)
+    outbox.conn.close()
+    outbox = Outbox(str(tmp_path / "outbox.db"))
+    broker = FakeBroker()
+    FakePublisher(broker, outbox=outbox)
+    _wait_until(lambda: len(outbox) == 0)
+    assert _get_delivered(broker) == [1]
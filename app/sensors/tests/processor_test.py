@@ -0,0 +1,128 @@
+import json
+import uuid
+
+import pytest
+
+from app.sensors.tests.fakes import (FakeBroker, FakeCassandraClient, FakePublisher, FakeRedisClient,
+                                     FakeSubscriber, FakeTimescale)
+from consumer.processor import process_batch
+from consumer.sinks import Sink
+from consumer.spill import SpillFile
+from shared import cassandra_client, timescale as timescale_client
+from shared.publisher import DEAD_LETTERS, LIVE_EXCHANGE, declare_queues, get_lane_queue, get_shard_queue
+from shared.sensors import repository, rollups, schemas
+from shared.subscriber import Lane
+
+
+@pytest.fixture
+def stores(tmp_path):
+    timescale = FakeTimescale()
+    cassandra = FakeCassandraClient()
+    cassandra.create_tables()
+    sinks = [Sink("timescale", lambda messages: repository.store_in_timescale(timescale, messages),
+                  errors=timescale_client.ERRORS, spill=SpillFile(str(tmp_path / "timescale"))),
+             Sink("cassandra", lambda messages: repository.store_in_cassandra(cassandra, messages),
+                  errors=cassandra_client.ERRORS, spill=SpillFile(str(tmp_path / "cassandra")))]
+    return {"timescale": timescale, "cassandra": cassandra, "sinks": sinks, "redis": FakeRedisClient(),
+            "publisher": FakePublisher()}
+
+
+def _get_body(sensor_id: int, temperature: float, last_seen: str, message_id: str | None = None) -> bytes:
+    return json.dumps({"message_id": message_id or str(uuid.uuid4()), "sensor_id": sensor_id,
+                       "name": f"sensor_{sensor_id}", "type": "Temperatura", "time": last_seen,
+                       "data": {"temperature": temperature, "humidity": 50.0, "battery_level": 0.9,
+                                "last_seen": last_seen}}).encode()
+
+
+def _process(stores, bodies: list):
+    process_batch(bodies, sinks=stores["sinks"], redis=stores["redis"], publisher=stores["publisher"])
+
+
+def test_readings_with_a_wrong_time_are_discarded(stores):
+    _process(stores, [_get_body(1, 20.0, "2023-01-01T00:00:00"), _get_body(2, 21.0, "yesterday"), b"{}"])
+    assert [name for name, _ in stores["timescale"].tables["sensor_data"]] == ["sensor_1"]
+    assert stores["redis"].get(2) is None
+
+
+def test_redelivered_batch_is_written_once(stores, monkeypatch):
+    monkeypatch.setitem(rollups.ROLLUP_WINDOWS, "Temperatura", 60)
+    bodies = [_get_body(1, 20.0, "2023-01-01T00:00:00"), _get_body(1, 22.0, "2023-01-01T00:00:30")]
+    _process(stores, bodies)
+    _process(stores, bodies)
+    assert len(stores["timescale"].tables["sensor_data"]) == 2
+    [window] = stores["timescale"].tables["sensor_data_rollup"].values()
+    assert window["count"] == 2
+
+
+def test_redelivery_after_a_crash_before_marking_is_written_once(stores, monkeypatch):
+    # The batch got to the stores but not to Redis, so it isn't known as seen
+    monkeypatch.setitem(rollups.ROLLUP_WINDOWS, "Temperatura", 60)
+    bodies = [_get_body(1, 20.0, "2023-01-01T00:00:00"), _get_body(1, 22.0, "2023-01-01T00:00:30")]
+    _process(stores, bodies)
+    stores["redis"].clearAll()
+    _process(stores, bodies)
+    [window] = stores["timescale"].tables["sensor_data_rollup"].values()
+    assert window["count"] == 2
+    assert window["temperature_sum"] == 42.0
+
+
+def test_duplicates_in_a_batch_are_written_once(stores, monkeypatch):
+    monkeypatch.setitem(rollups.ROLLUP_WINDOWS, "Temperatura", 60)
+    body = _get_body(1, 20.0, "2023-01-01T00:00:00", message_id="same")
+    _process(stores, [body, body])
+    [window] = stores["timescale"].tables["sensor_data_rollup"].values()
+    assert window["count"] == 1
+
+
+def test_latest_value_is_the_last_reading(stores):
+    _process(stores, [_get_body(1, 22.0, "2023-01-01T00:00:30"), _get_body(1, 20.0, "2023-01-01T00:00:00")])
+    assert json.loads(stores["redis"].get(1))["temperature"] == 22.0
+
+
+def test_bisected_batch_publishes_each_reading_once(stores):
+    broker = stores["publisher"].broker = FakeBroker()
+    channel = FakeSubscriber(broker).channel
+    declare_queues(channel)
+    channel.queue_declare(queue="live")
+    channel.queue_bind(queue="live", exchange=LIVE_EXCHANGE)
+
+    def write(messages):
+        if any(message.sensor_id == 3 for message in messages):
+            raise TypeError("can't store it")
+
+    stores["sinks"].append(Sink("poisoned", write, errors=()))
+    for sensor_id in range(1, 7):
+        channel.basic_publish(exchange="", routing_key=get_shard_queue(0),
+                              body=_get_body(sensor_id, 20.0, "2023-01-01T00:00:00"))
+    FakeSubscriber(broker).subscribe_lanes([Lane([get_shard_queue(0)], lambda bodies: _process(stores, bodies),
+                                                 batch_size=10, flush_interval=0)])
+    published = [reading.sensor_id for _, body, _ in broker.queues["live"]
+                 for reading in schemas.SensorDataBatch.parse_raw(body).readings]
+    assert sorted(published) == [1, 2, 4, 5, 6]
+    assert len(broker.queues[get_lane_queue(DEAD_LETTERS)]) == 1
+
+
+class RecordingRedisClient(FakeRedisClient):
+    # Keeps the keys of every write, with the mapping of each set_many
+    def __init__(self):
+        super().__init__()
+        self.writes = []
+        self.batches = []
+
+    def set(self, key, value, ex=None, nx=False):
+        self.writes.append(key)
+        return super().set(key, value, ex=ex, nx=nx)
+
+    def set_many(self, mapping, ex=None):
+        self.batches.append(list(mapping))
+        return super().set_many(mapping, ex=ex)
+
+
+def test_readings_of_a_sensor_in_a_batch_are_one_redis_write_of_the_newest(stores):
+    stores["redis"] = RecordingRedisClient()
+    _process(stores, [_get_body(1, 21.0, "2023-01-01T00:00:10"), _get_body(2, 30.0, "2023-01-01T00:00:00"),
+                      _get_body(1, 23.0, "2023-01-01T00:00:30"), _get_body(1, 20.0, "2023-01-01T00:00:00")])
+    assert stores["redis"].writes.count(1) == 1 and stores["redis"].writes.count(2) == 1
+    assert [1, 2] in stores["redis"].batches
+    assert json.loads(stores["redis"].get(1))["temperature"] == 23.0
+    assert json.loads(stores["redis"].get(2))["temperature"] == 30.0
@@ -0,0 +1,79 @@
+import threading
+
+from app.sensors.tests.fakes import FakeBroker, FakePublisher
+from shared.publisher import CONTROL, get_lane_queue
+from shared.sensors import schemas
+
+
+def _get_event(sensor_id: int) -> schemas.SensorEvent:
+    return schemas.SensorEvent(event="created", sensor_id=sensor_id, name=f"sensor_{sensor_id}")
+
+
+def _get_delivered(broker: FakeBroker) -> list:
+    return [schemas.SensorEvent.parse_raw(body).sensor_id for _, body, _ in broker.queues[get_lane_queue(CONTROL)]]
+
+
+def test_nothing_is_opened_before_the_first_publish():
+    publisher = FakePublisher()
+    assert publisher.connections == []
+    publisher.publish(_get_event(1), lane=CONTROL)
+    assert len(publisher.connections) == 1
+
+
+def test_every_thread_publishes_through_its_own_channel():
+    broker = FakeBroker()
+    publisher = FakePublisher(broker)
+    # All the threads hold their channel at the same time, so none can get one another thread let go
+    started = threading.Barrier(4)
+    channels = {}
+
+    def publish(index):
+        publisher.publish(_get_event(index), lane=CONTROL)
+        channel = publisher._get_channel()
+        started.wait()
+        publisher.publish(_get_event(index), lane=CONTROL)
+        channels[index] = (channel, publisher._get_channel())
+
+    threads = [threading.Thread(target=publish, args=(index,)) for index in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert all(first is second for first, second in channels.values())
+    assert len({id(first) for first, _ in channels.values()}) == 4
+    assert len(publisher.connections) == 4
+    assert sorted(_get_delivered(broker)) == [0, 0, 1, 1, 2, 2, 3, 3]
+
+
+def test_a_closed_connection_is_replaced():
+    broker = FakeBroker()
+    publisher = FakePublisher(broker)
+    publisher.publish(_get_event(1), lane=CONTROL)
+    dropped = publisher.local.conn
+    dropped.close()
+    publisher.publish(_get_event(2), lane=CONTROL)
+    assert publisher.local.conn is not dropped
+    assert publisher.connections == [publisher.local.conn]
+    assert _get_delivered(broker) == [1, 2]
+
+
+def test_a_publish_that_loses_the_connection_reconnects(monkeypatch):
+    broker = FakeBroker()
+    publisher = FakePublisher(broker)
+    publisher.publish(_get_event(1), lane=CONTROL)
+    dropped = publisher.local.conn
+    attempts = []
+
+    def backoff(attempt):
+        # The broker is back by the next attempt
+        attempts.append(attempt)
+        broker.down = False
+        return 0.0
+
+    monkeypatch.setattr("shared.publisher.backoff", backoff)
+    broker.down = True
+    publisher.publish(_get_event(2), lane=CONTROL)
+    assert attempts == [0]
+    assert dropped.is_closed
+    assert publisher.connections == [publisher.local.conn]
+    assert _get_delivered(broker) == [1, 2]
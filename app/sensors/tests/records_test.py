@@ -0,0 +1,75 @@
+import pytest
+
+from app.sensors.tests.fakes import (FakeElasticsearchClient, FakeMongoDBClient, FakePublisher, FakeRedisClient,
+                                     fake_session_factory)
+from consumer.processor import process_control
+from shared.sensors import records, repository, schemas
+
+
+def _get_mongo() -> FakeMongoDBClient:
+    mongo = FakeMongoDBClient()
+    mongo.getDatabase("sensors")
+    records.ensure_indexes(mongo)
+    return mongo
+
+
+@pytest.fixture
+def stores():
+    db = fake_session_factory()()
+    mongo = _get_mongo()
+    yield {"db": db, "mongo": mongo, "es": FakeElasticsearchClient(), "redis": FakeRedisClient(),
+           "publisher": FakePublisher()}
+    db.close()
+
+
+def _create_sensor(stores, name: str) -> schemas.Sensor:
+    return repository.create_sensor(
+        mongo_client=stores["mongo"], db=stores["db"], es=stores["es"], publisher=stores["publisher"],
+        sensor=schemas.SensorCreate(name=name, latitude=1.0, longitude=2.0, type="Temperatura",
+                                    mac_address="00:00:00:00:00:01", manufacturer="Dummy", model="Dummy",
+                                    serie_number="1", firmware_version="1.0", description="Dummy"))
+
+
+def _get_record(sensor: schemas.Sensor) -> dict:
+    return records.to_record(sensor, None)
+
+
+def test_upsert_replaces_the_record_of_a_reused_name():
+    mongo = _get_mongo()
+    old = schemas.Sensor.construct(id=1, name="sensor_1", type="Temperatura")
+    new = schemas.Sensor.construct(id=2, name="sensor_1", type="Velocitat")
+    records.upsert(mongo, _get_record(old))
+    records.upsert(mongo, _get_record(new))
+    assert list(records.find_by_names(mongo, ["sensor_1"]).keys()) == ["sensor_1"]
+    assert records.find_by_names(mongo, ["sensor_1"])["sensor_1"].id == 2
+    assert records.find_by_ids(mongo, [1]) == {}
+
+
+def test_upsert_is_idempotent():
+    mongo = _get_mongo()
+    sensor = schemas.Sensor.construct(id=1, name="sensor_1", type="Temperatura")
+    records.upsert(mongo, _get_record(sensor))
+    records.upsert(mongo, _get_record(sensor))
+    assert mongo.getCollection(records.SENSOR_RECORDS).count_documents({}) == 1
+
+
+def test_delete_sensor_deletes_its_record_right_away(stores):
+    sensor = _create_sensor(stores, "sensor_1")
+    records.upsert(stores["mongo"], _get_record(sensor))
+    repository.delete_sensor(db=stores["db"], redis=stores["redis"], mongo_client=stores["mongo"],
+                             sensor_id=sensor.id, publisher=stores["publisher"])
+    assert records.find_by_ids(stores["mongo"], [sensor.id]) == {}
+
+
+def test_late_deleted_event_keeps_the_record_of_a_reused_name(stores):
+    old = _create_sensor(stores, "sensor_1")
+    # Postgres doesn't reuse ids, SQLite does for the last row
+    _create_sensor(stores, "sensor_2")
+    repository.delete_sensor(db=stores["db"], redis=stores["redis"], mongo_client=stores["mongo"],
+                             sensor_id=old.id, publisher=stores["publisher"])
+    new = _create_sensor(stores, "sensor_1")
+    created = schemas.SensorEvent(event=repository.SENSOR_CREATED, sensor_id=new.id, name=new.name, sensor=new)
+    deleted = schemas.SensorEvent(event=repository.SENSOR_DELETED, sensor_id=old.id, name=old.name)
+    process_control([created.json().encode(), deleted.json().encode()], redis=stores["redis"],
+                    mongo_client=stores["mongo"])
+    assert records.find_by_names(stores["mongo"], ["sensor_1"])["sensor_1"].id == new.id
@@ -0,0 +1,129 @@
+import json
+import uuid
+from datetime import datetime, timedelta
+
+import numpy as np
+import pytest
+
+pytest.importorskip("pytest_benchmark")
+
+from app.sensors.tests.fakes import (FakeBroker, FakeCassandraClient, FakeElasticsearchClient, FakeMongoDBClient,
+                                     FakePublisher, FakeRedisClient, FakeSubscriber, FakeTimescale,
+                                     fake_session_factory)
+from consumer.processor import process_batch, process_control
+from consumer.sinks import Sink
+from consumer.spill import SpillFile
+from shared import cassandra_client, timescale as timescale_client
+from shared.publisher import CONTROL, get_lane_queue
+from shared.sensors import downsampling, repository, schemas
+from shared.subscriber import Lane
+
+# Benchmarks of our own code in the repository and the consumer over the in-memory fakes, so they run without
+# docker-compose and the I/O doesn't hide CPU regressions. Run them with pytest --benchmark-only.
+SENSORS = 500
+BATCH_SIZE = 500
+
+
+@pytest.fixture(scope="module")
+def stores(tmp_path_factory):
+    db = fake_session_factory()()
+    mongo = FakeMongoDBClient()
+    mongo.getDatabase("sensors")
+    es = FakeElasticsearchClient()
+    broker = FakeBroker()
+    publisher = FakePublisher(broker)
+    for index in range(SENSORS):
+        sensor_type = "Temperatura" if index % 2 == 0 else "Velocitat"
+        repository.create_sensor(mongo_client=mongo, db=db, es=es, publisher=publisher, sensor=schemas.SensorCreate(
+            name=f"sensor_{index}", latitude=1.0 + index / 1000, longitude=2.0 + index / 1000, type=sensor_type,
+            mac_address=f"00:00:00:00:{index // 256:02x}:{index % 256:02x}", manufacturer="Dummy",
+            model=f"Dummy {sensor_type}", serie_number=str(index), firmware_version="1.0",
+            description=f"Sensor {sensor_type} number {index}"))
+    redis = FakeRedisClient()
+    # The consumer fills the read model from the created events
+    FakeSubscriber(broker).subscribe_lanes([Lane([get_lane_queue(CONTROL)],
+                                                 lambda bodies: process_control(bodies, redis=redis, mongo_client=mongo),
+                                                 batch_size=50, flush_interval=0)])
+    cassandra = FakeCassandraClient()
+    cassandra.create_tables()
+    timescale = FakeTimescale()
+    spill = tmp_path_factory.mktemp("spill")
+    sinks = [Sink("timescale", lambda messages: repository.store_in_timescale(timescale, messages),
+                  errors=timescale_client.ERRORS, spill=SpillFile(str(spill / "timescale"))),
+             Sink("cassandra", lambda messages: repository.store_in_cassandra(cassandra, messages),
+                  errors=cassandra_client.ERRORS, spill=SpillFile(str(spill / "cassandra")))]
+    yield {"db": db, "mongo": mongo, "es": es, "publisher": publisher, "redis": redis, "cassandra": cassandra,
+           "timescale": timescale, "sinks": sinks}
+    db.close()
+
+
+def _get_bodies(start: datetime) -> list:
+    bodies = []
+    for index in range(BATCH_SIZE):
+        sensor_id = index % SENSORS + 1
+        last_seen = (start + timedelta(milliseconds=index)).isoformat()
+        if sensor_id % 2 == 1:
+            data = {"temperature": 20.0 + index % 10, "humidity": 50.0, "battery_level": 0.1 + index % 9 / 10,
+                    "last_seen": last_seen}
+            sensor_type = "Temperatura"
+        else:
+            data = {"velocity": 40.0 + index % 10, "battery_level": 0.1 + index % 9 / 10, "last_seen": last_seen}
+            sensor_type = "Velocitat"
+        bodies.append(json.dumps({"message_id": str(uuid.uuid4()), "sensor_id": sensor_id,
+                                  "name": f"sensor_{sensor_id - 1}", "type": sensor_type, "time": last_seen,
+                                  "data": data}).encode())
+    return bodies
+
+
+def test_record_data(benchmark, stores):
+    data = schemas.SensorDataTemperature(temperature=21.5, humidity=48.0, battery_level=0.9,
+                                         last_seen="2023-01-01T00:00:00.000Z")
+    sensor = benchmark(repository.record_data, publisher=stores["publisher"], mongo_client=stores["mongo"],
+                       db=stores["db"], sensor_id=1, data=data)
+    assert sensor.temperature == 21.5
+
+
+def test_get_sensors_near(benchmark, stores):
+    sensors = benchmark(repository.get_sensors_near, db=stores["db"], redis=stores["redis"],
+                        mongo_client=stores["mongo"], latitude=1.1, longitude=2.1, radius=5)
+    assert sensors
+
+
+def test_search_sensors(benchmark, stores):
+    sensors = benchmark(repository.search_sensors, db=stores["db"], mongo_client=stores["mongo"], es=stores["es"],
+                        query=json.dumps({"description": "Velocitat"}), size=50, search_type="match")
+    assert len(sensors) == 50
+
+
+def test_process_batch(benchmark, stores):
+    starts = iter(datetime(2023, 1, 1) + timedelta(minutes=minute) for minute in range(10 ** 6))
+
+    def setup():
+        return (_get_bodies(next(starts)),), {"sinks": stores["sinks"], "redis": stores["redis"],
+                                              "publisher": stores["publisher"]}
+
+    benchmark.pedantic(process_batch, setup=setup, rounds=20)
+    assert stores["timescale"].tables["sensor_data"]
+
+
+def test_create_sensors(benchmark, stores):
+    batches = iter(range(10 ** 6))
+
+    def setup():
+        batch = next(batches)
+        sensors = [schemas.SensorCreate(name=f"batch_{batch}_{index}", latitude=3.0, longitude=4.0, type="Temperatura",
+                                        mac_address="00:00:00:00:00:00", manufacturer="Dummy", model="Dummy Temperatura",
+                                        serie_number=str(index), firmware_version="1.0", description="Batch sensor")
+                   for index in range(BATCH_SIZE)]
+        return (), {"mongo_client": stores["mongo"], "db": stores["db"], "sensors": sensors, "es": stores["es"],
+                    "publisher": stores["publisher"]}
+
+    results = benchmark.pedantic(repository.create_sensors, setup=setup, rounds=5)
+    assert all(result.created for result in results)
+
+
+def test_lttb(benchmark):
+    x = np.arange(10 ** 6, dtype=np.float64)
+    y = np.sin(x / 1000) + np.random.default_rng(0).random(10 ** 6)
+    selected = benchmark(downsampling.lttb, x, y, 1000)
+    assert len(selected) == 1000 and selected[0] == 0 and selected[-1] == 10 ** 6 - 1
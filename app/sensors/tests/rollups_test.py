@@ -0,0 +1,93 @@
+import uuid
+
+import pytest
+
+from app.sensors.tests.fakes import FakeCassandraClient, FakeTimescale
+from shared.sensors import repository, rollups, schemas
+
+
+@pytest.fixture(autouse=True)
+def windows(monkeypatch):
+    monkeypatch.setitem(rollups.ROLLUP_WINDOWS, "Temperatura", 60)
+
+
+def _get_message(name: str, temperature: float, last_seen: str) -> schemas.SensorDataMessage:
+    return schemas.SensorDataMessage(
+        message_id=str(uuid.uuid5(uuid.NAMESPACE_URL, f"{name}:{last_seen}")), sensor_id=1, name=name,
+        type="Temperatura", time=last_seen,
+        data=schemas.SensorDataTemperature(temperature=temperature, humidity=50.0, battery_level=0.9,
+                                           last_seen=last_seen))
+
+
+def _get_window(timescale: FakeTimescale, name: str) -> dict:
+    windows = [row for row in timescale.tables["sensor_data_rollup"].values() if row["name"] == name]
+    assert len(windows) == 1
+    return windows[0]
+
+
+def test_window_of_a_batch():
+    timescale = FakeTimescale()
+    repository.store_in_timescale(timescale, [_get_message("sensor_1", 20.0, "2023-01-01T00:00:10"),
+                                              _get_message("sensor_1", 24.0, "2023-01-01T00:00:50")])
+    window = _get_window(timescale, "sensor_1")
+    assert window["count"] == 2
+    assert window["temperature_min"] == 20.0
+    assert window["temperature_max"] == 24.0
+    assert window["temperature_sum"] == 44.0
+    assert window["temperature_last"] == 24.0
+
+
+def test_redelivered_batch_is_counted_once():
+    timescale = FakeTimescale()
+    messages = [_get_message("sensor_1", 20.0, "2023-01-01T00:00:10"),
+                _get_message("sensor_1", 24.0, "2023-01-01T00:00:50")]
+    repository.store_in_timescale(timescale, messages)
+    repository.store_in_timescale(timescale, messages)
+    window = _get_window(timescale, "sensor_1")
+    assert window["count"] == 2
+    assert window["temperature_sum"] == 44.0
+
+
+def test_partly_applied_batch_adds_only_the_new_readings():
+    timescale = FakeTimescale()
+    first = _get_message("sensor_1", 20.0, "2023-01-01T00:00:10")
+    repository.store_in_timescale(timescale, [first])
+    repository.store_in_timescale(timescale, [first, _get_message("sensor_1", 24.0, "2023-01-01T00:00:50")])
+    window = _get_window(timescale, "sensor_1")
+    assert window["count"] == 2
+    assert window["temperature_sum"] == 44.0
+    assert window["temperature_last"] == 24.0
+
+
+def test_chunk_imported_twice_is_counted_once():
+    timescale = FakeTimescale()
+    cassandra = FakeCassandraClient()
+    cassandra.create_tables()
+    messages = [_get_message("sensor_1", 20.0, "2023-01-01T00:00:10")]
+    repository.import_data(timescale, cassandra, messages)
+    repository.import_data(timescale, cassandra, messages)
+    assert _get_window(timescale, "sensor_1")["count"] == 1
+
+
+def test_types_without_window_have_no_rollups():
+    timescale = FakeTimescale()
+    message = schemas.SensorDataMessage(
+        message_id=str(uuid.uuid4()), sensor_id=2, name="sensor_2", type="Velocitat", time="2023-01-01T00:00:10",
+        data=schemas.SensorDataVelocity(velocity=40.0, battery_level=0.9, last_seen="2023-01-01T00:00:10"))
+    repository.store_in_timescale(timescale, [message])
+    assert not timescale.tables["sensor_data_rollup"]
+    assert len(timescale.tables["sensor_data"]) == 1
+
+
+def test_retention_columns_are_those_of_the_windowed_types():
+    assert rollups.get_windowed_columns() == ["temperature"]
+
+
+def test_reading_older_than_its_window_is_taken_as_applied():
+    timescale = FakeTimescale()
+    repository.store_in_timescale(timescale, [_get_message("sensor_1", 24.0, "2023-01-01T00:00:50")])
+    repository.store_in_timescale(timescale, [_get_message("sensor_1", 20.0, "2023-01-01T00:00:10"),
+                                              _get_message("sensor_1", 22.0, "2023-01-01T00:01:10")])
+    # The reading of the first window is dropped, the one of the next window is added
+    assert [(row["count"], row["temperature_sum"]) for row in timescale.tables["sensor_data_rollup"].values()] == [
+        (1, 24.0), (1, 22.0)]
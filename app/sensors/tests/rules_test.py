@@ -0,0 +1,59 @@
+import json
+import uuid
+
+import pytest
+from pydantic import ValidationError
+
+from consumer.rules import Rule, RuleEngine, load_rules
+from shared.sensors import schemas
+
+
+def _get_message(sensor_id: int, velocity: float, battery_level: float, last_seen: str) -> schemas.SensorDataMessage:
+    return schemas.SensorDataMessage(
+        message_id=str(uuid.uuid4()), sensor_id=sensor_id, name=f"sensor_{sensor_id}", type="Velocitat",
+        time=last_seen, data=schemas.SensorDataVelocity(velocity=velocity, battery_level=battery_level,
+                                                        last_seen=last_seen))
+
+
+@pytest.mark.parametrize("rule", [
+    {"name": "hot", "kind": "threshold", "field": "temperature"},
+    {"name": "fast", "kind": "rate", "field": "velocity"},
+    {"name": "quiet", "kind": "silence"},
+    {"name": "wet", "kind": "threshold", "field": "rain", "value": 1},
+])
+def test_incomplete_rules_are_refused(rule):
+    with pytest.raises(ValidationError):
+        Rule.parse_obj(rule)
+
+
+def test_rules_file_with_an_incomplete_rule_fails_to_load(tmp_path):
+    path = tmp_path / "rules.json"
+    path.write_text(json.dumps([{"name": "fast", "kind": "rate", "field": "velocity"}]))
+    with pytest.raises(ValidationError):
+        load_rules(str(path))
+
+
+def test_threshold_alert_is_raised_once_until_it_clears():
+    engine = RuleEngine(load_rules())
+    assert [alert.alert for alert in engine.evaluate(_get_message(1, 40.0, 0.1, "2023-01-01T00:00:00"))] == \
+           ["low_battery"]
+    assert engine.evaluate(_get_message(1, 40.0, 0.1, "2023-01-01T00:00:01")) == []
+    assert engine.evaluate(_get_message(1, 40.0, 0.9, "2023-01-01T00:00:02")) == []
+    assert len(engine.evaluate(_get_message(1, 40.0, 0.1, "2023-01-01T00:00:03"))) == 1
+
+
+def test_rate_alert_uses_the_time_between_readings():
+    engine = RuleEngine([Rule(name="fast", kind="rate", field="velocity", max_per_second=10)])
+    assert engine.evaluate(_get_message(1, 40.0, 0.9, "2023-01-01T00:00:00Z")) == []
+    # 20 in 1 second, the second reading is in another time zone
+    alerts = engine.evaluate(_get_message(1, 60.0, 0.9, "2023-01-01T01:00:01+01:00"))
+    assert [(alert.alert, alert.value) for alert in alerts] == [("fast", 60.0)]
+    # 20 in 10 seconds
+    assert engine.evaluate(_get_message(1, 80.0, 0.9, "2023-01-01T00:00:11")) == []
+
+
+def test_silent_sensors_are_reported_once():
+    engine = RuleEngine([Rule(name="quiet", kind="silence", seconds=0)])
+    engine.evaluate(_get_message(1, 40.0, 0.9, "2023-01-01T00:00:00"))
+    assert [alert.sensor_id for alert in engine.check_silence()] == [1]
+    assert engine.check_silence() == []
@@ -0,0 +1,35 @@
+from shared import sharding
+from shared.publisher import get_shard_queue
+
+
+def test_every_sensor_has_a_shard_and_keeps_it():
+    shards = [sharding.get_shard(sensor_id) for sensor_id in range(1, 10001)]
+    assert set(shards) == set(range(sharding.SHARDS))
+    assert shards == [sharding.get_shard(sensor_id) for sensor_id in range(1, 10001)]
+
+
+def test_shards_are_balanced():
+    counts = [0] * sharding.SHARDS
+    for sensor_id in range(1, 16001):
+        counts[sharding.get_shard(sensor_id)] += 1
+    assert min(counts) > 1000 * 0.8
+    assert max(counts) < 1000 * 1.2
+
+
+def test_adding_a_bucket_only_moves_keys_to_it():
+    keys = range(10000)
+    before = [sharding.jump_hash(key, 10) for key in keys]
+    after = [sharding.jump_hash(key, 11) for key in keys]
+    moved = [new for old, new in zip(before, after) if old != new]
+    assert set(moved) == {10}
+    assert 10000 / 11 * 0.8 < len(moved) < 10000 / 11 * 1.2
+
+
+def test_consumers_own_every_shard_once():
+    for count in (1, 2, 3, 5):
+        owned = [shard for index in range(count) for shard in sharding.get_owned_shards(index, count)]
+        assert sorted(owned) == list(range(sharding.SHARDS))
+
+
+def test_readings_of_a_sensor_go_to_its_shard_queue():
+    assert get_shard_queue(sharding.get_shard(42)) == f"test.{sharding.get_shard(42)}"
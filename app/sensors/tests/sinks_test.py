@@ -0,0 +1,115 @@
+import os
+import uuid
+
+import pytest
+
+from consumer.sinks import CLOSED, OPEN, CircuitBreaker, Sink
+from consumer.spill import QUARANTINE, SpillFile, SpillFull
+from shared.sensors import schemas
+
+
+class StoreDown(Exception):
+    pass
+
+
+class Store:
+    # Keeps the names of the readings written while it's up
+    def __init__(self):
+        self.up = True
+        self.error = StoreDown
+        self.names = []
+
+    def write(self, messages):
+        if not self.up:
+            raise self.error("down")
+        self.names.extend(message.name for message in messages)
+
+
+def _get_messages(count: int, start: int = 0) -> list:
+    return [schemas.SensorDataMessage(
+        message_id=str(uuid.uuid4()), sensor_id=index, name=f"sensor_{index}", type="Velocitat",
+        time="2023-01-01T00:00:00",
+        data=schemas.SensorDataVelocity(velocity=40.0, battery_level=0.9, last_seen="2023-01-01T00:00:00"))
+        for index in range(start, start + count)]
+
+
+@pytest.fixture
+def store():
+    return Store()
+
+
+@pytest.fixture
+def sink(tmp_path, store):
+    # The breaker is tried again right away, so the tests don't wait for it
+    return Sink("store", store.write, errors=(StoreDown,), spill=SpillFile(str(tmp_path / "store")),
+                breaker=CircuitBreaker(failure_threshold=2, reset_timeout=0))
+
+
+def test_breaker_opens_after_the_threshold():
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=60)
+    breaker.failed()
+    assert breaker.allow()
+    breaker.failed()
+    assert breaker.state == OPEN
+    assert not breaker.allow()
+
+
+def test_breaker_closes_after_a_write_once_the_timeout_passes():
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0)
+    breaker.failed()
+    assert breaker.allow()
+    breaker.succeeded()
+    assert breaker.state == CLOSED
+
+
+def test_readings_of_a_store_that_is_down_are_replayed_once_its_back(sink, store):
+    store.up = False
+    sink.write(_get_messages(3))
+    sink.write(_get_messages(2, start=3))
+    assert store.names == []
+    store.up = True
+    while len(sink.spill):
+        sink.replay()
+    assert sorted(store.names) == [f"sensor_{index}" for index in range(5)]
+    assert sink.breaker.state == CLOSED
+
+
+def test_replay_stops_while_the_store_is_still_down(sink, store):
+    store.up = False
+    sink.write(_get_messages(3))
+    sink.replay()
+    assert len(sink.spill) == 1
+    assert store.names == []
+
+
+def test_segment_that_fails_with_another_error_is_quarantined(sink, store, tmp_path):
+    store.up = False
+    sink.write(_get_messages(3))
+    store.error = TypeError
+    sink.replay()
+    assert len(sink.spill) == 0
+    assert len(os.listdir(tmp_path / "store" / QUARANTINE)) == 1
+
+
+def test_spill_file_refuses_what_goes_over_its_size(tmp_path):
+    spill = SpillFile(str(tmp_path / "spill"), segment_size=1024, max_bytes=2048)
+    spill.append([b"x" * 600])
+    spill.append([b"x" * 600])
+    with pytest.raises(SpillFull):
+        spill.append([b"x" * 600])
+    # Replaying a segment makes room again
+    spill.remove_oldest()
+    spill.append([b"x" * 600])
+    assert spill.size == 2048
+
+
+def test_spill_file_is_read_back_by_a_new_run(tmp_path):
+    spill = SpillFile(str(tmp_path / "spill"), segment_size=64)
+    spill.append([b"first", b"second" * 10, b"third"])
+    spill.close()
+    spill = SpillFile(str(tmp_path / "spill"), segment_size=64)
+    records = []
+    while len(spill):
+        records.extend(spill.oldest())
+        spill.remove_oldest()
+    assert records == [b"first", b"second" * 10, b"third"]
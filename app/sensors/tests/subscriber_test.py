@@ -0,0 +1,74 @@
+import time
+
+from app.sensors.tests.fakes import FakeBroker, FakePublisher, FakeSubscriber
+from shared.publisher import CONTROL, DEAD_LETTERS, get_lane_queue
+from shared.subscriber import Lane
+
+
+def _publish(broker: FakeBroker, bodies: list):
+    channel = FakePublisher(broker)._get_channel()
+    for body in bodies:
+        channel.basic_publish(exchange='', routing_key=get_lane_queue(CONTROL), body=body)
+
+
+def _get_queue(broker: FakeBroker, lane: str) -> list:
+    return [body for _, body, _ in broker.queues[get_lane_queue(lane)]]
+
+
+def test_batch_is_acked_once_handled():
+    broker = FakeBroker()
+    _publish(broker, [b"1", b"2", b"3"])
+    handled = []
+    FakeSubscriber(broker).subscribe_lanes([Lane([get_lane_queue(CONTROL)], handled.extend, batch_size=10,
+                                                 flush_interval=0)])
+    assert handled == [b"1", b"2", b"3"]
+    assert _get_queue(broker, CONTROL) == []
+
+
+def test_failing_messages_are_dead_lettered_and_the_rest_handled():
+    broker = FakeBroker()
+    _publish(broker, [b"1", b"poison", b"3", b"4", b"poison too", b"6"])
+    handled = []
+
+    def callback(bodies):
+        if any(body.startswith(b"poison") for body in bodies):
+            raise TypeError("can't handle it")
+        handled.extend(bodies)
+
+    subscriber = FakeSubscriber(broker)
+    subscriber.subscribe_lanes([Lane([get_lane_queue(CONTROL)], callback, batch_size=10, flush_interval=0)])
+    assert sorted(handled) == [b"1", b"3", b"4", b"6"]
+    assert _get_queue(broker, CONTROL) == []
+    assert _get_queue(broker, DEAD_LETTERS) == [b"poison", b"poison too"]
+    assert not subscriber.conn.channels[-1].unacked
+
+
+def test_batch_is_tried_again_while_a_service_is_down(monkeypatch):
+    monkeypatch.setattr("shared.subscriber.backoff", lambda attempt: 0.0)
+    broker = FakeBroker()
+    _publish(broker, [b"1", b"2"])
+    handled = []
+    attempts = []
+
+    def callback(bodies):
+        attempts.append(bodies)
+        if len(attempts) < 3:
+            raise ConnectionRefusedError("service down")
+        handled.extend(bodies)
+
+    lane = Lane([get_lane_queue(CONTROL)], callback, batch_size=10, flush_interval=0,
+                retry_errors=(ConnectionRefusedError,))
+    FakeSubscriber(broker).subscribe_lanes([lane])
+    assert attempts == [[b"1", b"2"]] * 3
+    assert handled == [b"1", b"2"]
+    assert lane.attempt == 0
+    assert _get_queue(broker, CONTROL) == []
+    assert _get_queue(broker, DEAD_LETTERS) == []
+
+
+def test_batch_waits_for_its_backoff():
+    lane = Lane([get_lane_queue(CONTROL)], lambda bodies: None, batch_size=1, flush_interval=0)
+    lane.batch = [(1, b"1", None, 0)]
+    lane.retry_at = time.monotonic() + 60
+    assert not lane.is_due()
+    assert 59 < lane.get_wait() <= 60
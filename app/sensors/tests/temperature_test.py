@@ -0,0 +1,102 @@
+from datetime import datetime
+
+import pytest
+from fastapi.testclient import TestClient
+
+from app.main import app
+from app.sensors import controller
+from app.sensors.tests.fakes import (FakeCassandraClient, FakeElasticsearchClient, FakeMongoDBClient, FakePublisher,
+                                     fake_session_factory)
+from backfill.migrate_temperature_data import migrate
+from shared.sensors import repository, schemas
+
+# Three readings of sensor_1 a day, from the first to the third of January, and one of sensor_3
+_READINGS = [("sensor_1", datetime(2020, 1, day, hour), 10.0 * day + hour) for day in (1, 2, 3) for hour in (0, 12, 23)]
+_READINGS.append(("sensor_3", datetime(2020, 1, 2, 12), 99.0))
+
+
+@pytest.fixture
+def cassandra():
+    cassandra = FakeCassandraClient()
+    cassandra.create_tables()
+    return cassandra
+
+
+@pytest.fixture
+def client(cassandra, monkeypatch):
+    db = fake_session_factory()()
+    mongo = FakeMongoDBClient()
+    mongo.getDatabase("sensors")
+    for index, sensor_type in ((1, "Temperatura"), (2, "Velocitat")):
+        repository.create_sensor(mongo_client=mongo, db=db, es=FakeElasticsearchClient(), publisher=FakePublisher(),
+                                 sensor=schemas.SensorCreate(
+                                     name=f"sensor_{index}", latitude=1.0, longitude=2.0, type=sensor_type,
+                                     mac_address=f"00:00:00:00:00:0{index}", manufacturer="Dummy", model="Dummy",
+                                     serie_number=str(index), firmware_version="1.0", description="Dummy"))
+    repository.import_temperature_data(cassandra=cassandra, rows=_READINGS)
+
+    def get_cassandra_client():
+        yield cassandra
+
+    monkeypatch.setattr(controller, "get_cassandra_client", get_cassandra_client)
+    app.dependency_overrides[controller.get_db] = lambda: db
+    app.dependency_overrides[controller.get_mongodb_client] = lambda: mongo
+    yield TestClient(app)
+    app.dependency_overrides.clear()
+    db.close()
+
+
+def test_temperature_data_reads_the_days_of_the_range_newest_first(cassandra):
+    repository.import_temperature_data(cassandra=cassandra, rows=_READINGS)
+    rows = repository.get_temperature_data(cassandra=cassandra, name="sensor_1", from_time=datetime(2020, 1, 1, 12),
+                                           to_time=datetime(2020, 1, 3, 0))
+    assert rows == [(datetime(2020, 1, 3, 0), 30.0), (datetime(2020, 1, 2, 23), 43.0),
+                    (datetime(2020, 1, 2, 12), 32.0), (datetime(2020, 1, 2, 0), 20.0),
+                    (datetime(2020, 1, 1, 23), 33.0), (datetime(2020, 1, 1, 12), 22.0)]
+
+
+def test_temperature_stats_cover_every_day(cassandra):
+    repository.import_temperature_data(cassandra=cassandra, rows=_READINGS)
+    maximum, minimum, average = repository._get_temperature_stats(cassandra=cassandra, name="sensor_1")
+    temperatures = [temperature for name, _, temperature in _READINGS if name == "sensor_1"]
+    assert (maximum, minimum) == (max(temperatures), min(temperatures))
+    assert average == pytest.approx(sum(temperatures) / len(temperatures))
+    assert repository._get_temperature_stats(cassandra=cassandra, name="sensor_9") is None
+
+
+def test_get_temperature_data(client):
+    response = client.get("/sensors/1/temperature?from=2020-01-03T00:00:00Z&to=2020-01-03T12:00:00Z")
+    assert response.status_code == 200
+    assert response.json() == [{"time": "2020-01-03T12:00:00", "temperature": 42.0},
+                               {"time": "2020-01-03T00:00:00", "temperature": 30.0}]
+
+
+@pytest.mark.parametrize("query,status_code", [
+    ("", 400),
+    ("?from=2020-01-03T00:00:00Z", 400),
+    ("?from=yesterday&to=2020-01-03T00:00:00Z", 400),
+    ("?from=2019-01-01T00:00:00Z&to=2020-01-03T00:00:00Z", 400),
+])
+def test_get_temperature_data_with_a_bad_range(client, query, status_code):
+    assert client.get(f"/sensors/1/temperature{query}").status_code == status_code
+
+
+def test_get_temperature_data_of_a_sensor_of_another_type_or_missing(client):
+    query = "?from=2020-01-01T00:00:00Z&to=2020-01-02T00:00:00Z"
+    assert client.get(f"/sensors/2/temperature{query}").status_code == 409
+    assert client.get(f"/sensors/9/temperature{query}").status_code == 404
+
+
+def test_migrate_copies_the_old_table_by_day(cassandra):
+    cassandra.tables["temperature_data"] = {
+        (time, name): {"time": time, "name": name, "temperature": temperature} for name, time, temperature in _READINGS}
+    assert migrate(cassandra, chunk_size=4) == len(_READINGS)
+    assert sorted(cassandra.tables["temperature_data_by_day"]) == sorted(
+        (name, time.date(), time) for name, time, _ in _READINGS)
+    assert sorted(cassandra.tables["temperature_days"]) == [
+        ("sensor_1", datetime(2020, 1, day).date()) for day in (1, 2, 3)] + [("sensor_3", datetime(2020, 1, 2).date())]
+
+
+def test_migrate_without_the_old_table(cassandra):
+    assert migrate(cassandra) == 0
+    assert cassandra.tables["temperature_data_by_day"] == {}
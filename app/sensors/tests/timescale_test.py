@@ -0,0 +1,70 @@
+import psycopg2
+import psycopg2.errors
+import pytest
+
+from shared.timescale import Timescale
+
+
+class Connection:
+    # Like psycopg2, after an error every statement fails until the transaction is rolled back
+    closed = 0
+
+    def __init__(self):
+        self.aborted = False
+        self.rollbacks = 0
+
+    def cursor(self, name=None):
+        return Cursor(self)
+
+    def commit(self):
+        if self.aborted:
+            raise psycopg2.errors.InFailedSqlTransaction("current transaction is aborted")
+
+    def rollback(self):
+        self.aborted = False
+        self.rollbacks += 1
+
+
+class Cursor:
+    def __init__(self, conn):
+        self.conn = conn
+        self.rows = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def execute(self, query, values=None):
+        if self.conn.aborted:
+            raise psycopg2.errors.InFailedSqlTransaction("current transaction is aborted")
+        if "too long" in query:
+            self.conn.aborted = True
+            raise psycopg2.errors.StringDataRightTruncation("value too long for type character varying(255)")
+        self.rows = [(1,)]
+
+
+@pytest.fixture
+def timescale():
+    timescale = Timescale.__new__(Timescale)
+    timescale.conn = Connection()
+    timescale.cursor = timescale.conn.cursor()
+    return timescale
+
+
+def test_a_failed_statement_is_rolled_back(timescale):
+    with pytest.raises(psycopg2.DataError):
+        timescale.execute("INSERT INTO sensor_data VALUES ('too long')")
+    assert timescale.conn.rollbacks == 1
+    timescale.execute("INSERT INTO sensor_data VALUES ('sensor_1')")
+
+
+def test_a_failed_stream_is_rolled_back(timescale):
+    with pytest.raises(psycopg2.DataError):
+        list(timescale.stream("SELECT 'too long'"))
+    assert timescale.conn.rollbacks == 1
+    assert list(timescale.stream("SELECT 1")) == [(1,)]
@@ -0,0 +1,68 @@
+import contextvars
+import json
+import re
+
+import pytest
+from fastapi.testclient import TestClient
+
+from app.main import app
+from app.sensors import controller
+from app.sensors.tests.fakes import FakeRedisClient
+from shared import timing
+from shared.sensors import cache
+
+
+@timing.timed("redis")
+class TimedRedisClient(FakeRedisClient):
+    def get(self, key):
+        return super().get(key)
+
+    def set(self, key, value, ex=None, nx=False):
+        # Its own get isn't counted again
+        return super().set(key, value, ex=ex, nx=nx)
+
+
+@pytest.fixture
+def client():
+    redis = TimedRedisClient()
+    FakeRedisClient.set(redis, f"cache:{cache.QUANTITY_BY_TYPE}:0", '{"sensors": []}')
+    app.dependency_overrides[controller.get_redis_client] = lambda: redis
+    yield TestClient(app)
+    app.dependency_overrides.clear()
+
+
+def _get_log_lines(output: str) -> list:
+    return [json.loads(line) for line in output.splitlines() if line.startswith("{")]
+
+
+def test_backend_calls_of_a_route_run_in_the_threadpool_are_in_the_header_and_the_log(client, capsys):
+    # The route is a plain function, so it runs in the threadpool and its redis calls are recorded from there:
+    # the version and the cached value
+    response = client.get("/sensors/quantity_by_type")
+    assert response.status_code == 200
+    assert re.fullmatch(r'redis;desc="2 calls";dur=\d+\.\d', response.headers["Server-Timing"])
+    log_line, = _get_log_lines(capsys.readouterr().out)
+    assert log_line["method"] == "GET" and log_line["path"] == "/sensors/quantity_by_type"
+    assert log_line["status"] == 200 and log_line["ms"] >= 0
+    assert list(log_line["backends"]) == ["redis"] and log_line["backends"]["redis"]["calls"] == 2
+
+
+def test_a_request_without_backend_calls_has_no_header(client, capsys):
+    response = client.get("/")
+    assert "Server-Timing" not in response.headers
+    log_line, = _get_log_lines(capsys.readouterr().out)
+    assert log_line["path"] == "/" and log_line["backends"] == {}
+
+
+def test_calls_are_recorded_only_inside_of_a_request():
+    redis = TimedRedisClient()
+    redis.set("key", 1)
+
+    def request():
+        timings = timing.start()
+        redis.set("key", 2, nx=True)
+        redis.get("key")
+        return timings
+
+    timings = contextvars.copy_context().run(request)
+    assert {backend: calls for backend, (calls, _) in timings.items()} == {"redis": 2}
@@ -0,0 +1,101 @@
+import pytest
+from fastapi.testclient import TestClient
+
+from app.main import app
+from app.sensors import controller
+from app.sensors.tests.fakes import (FakeBroker, FakeElasticsearchClient, FakeMongoDBClient, FakePublisher,
+                                     FakeSubscriber, fake_session_factory)
+from shared import tracing
+from shared.sensors import repository, schemas
+from shared.subscriber import Lane
+
+_TRACE_ID = "4bf92f3577b34da6a3ce929d0e0e4736"
+_CALLER_SPAN_ID = "00f067aa0ba902b7"
+
+
+class SpanList(list):
+    # Keeps the spans instead of sending them
+    def add(self, span):
+        self.append(span)
+
+
+@pytest.fixture
+def spans(monkeypatch):
+    spans = SpanList()
+    monkeypatch.setattr(tracing, "_exporter", spans)
+    return spans
+
+
+def _get_span(spans: list, name: str) -> dict:
+    span, = [span for span in spans if span["name"] == name]
+    return span
+
+
+@pytest.mark.parametrize("traceparent,parent", [
+    (f"00-{_TRACE_ID}-{_CALLER_SPAN_ID}-01", tracing.SpanContext(_TRACE_ID, _CALLER_SPAN_ID)),
+    (f"00-{_TRACE_ID}-{_CALLER_SPAN_ID}-00", None),
+    (f"00-{_TRACE_ID}-{_CALLER_SPAN_ID}", None),
+    (f"00-{_TRACE_ID[:-1]}-{_CALLER_SPAN_ID}-01", None),
+    ("", None),
+])
+def test_parse_traceparent(traceparent, parent):
+    assert tracing.parse_traceparent(traceparent) == parent
+
+
+def test_a_trace_is_started_without_a_traceparent(spans):
+    with tracing.start_trace("work"):
+        headers = tracing.inject()
+    parent = tracing.parse_traceparent(headers[tracing.TRACEPARENT])
+    span, = spans
+    assert (parent.trace_id, parent.span_id) == (span["traceId"], span["spanId"])
+    assert "parentSpanId" not in span
+    assert tracing.inject() == {}
+
+
+def test_nothing_is_traced_without_an_exporter(monkeypatch):
+    monkeypatch.setattr(tracing, "_exporter", None)
+    with tracing.start_trace("work", f"00-{_TRACE_ID}-{_CALLER_SPAN_ID}-01"):
+        assert tracing.inject() == {}
+
+
+def test_trace_goes_from_the_api_through_the_message_to_the_consumer(spans, monkeypatch):
+    db = fake_session_factory()()
+    mongo = FakeMongoDBClient()
+    mongo.getDatabase("sensors")
+    repository.create_sensor(mongo_client=mongo, db=db, es=FakeElasticsearchClient(), publisher=FakePublisher(),
+                             sensor=schemas.SensorCreate(
+                                 name="sensor_1", latitude=1.0, longitude=2.0, type="Temperatura",
+                                 mac_address="00:00:00:00:00:01", manufacturer="Dummy", model="Dummy",
+                                 serie_number="1", firmware_version="1.0", description="Dummy"))
+    spans.clear()
+    broker = FakeBroker()
+    monkeypatch.setattr(controller, "publisher", FakePublisher(broker))
+    app.dependency_overrides[controller.get_db] = lambda: db
+    app.dependency_overrides[controller.get_mongodb_client] = lambda: mongo
+    try:
+        response = TestClient(app).post(
+            "/sensors/1/data", headers={tracing.TRACEPARENT: f"00-{_TRACE_ID}-{_CALLER_SPAN_ID}-01"},
+            json={"temperature": 20.0, "humidity": 50.0, "battery_level": 0.9, "last_seen": "2020-01-01T00:00:00"})
+    finally:
+        app.dependency_overrides.clear()
+        db.close()
+    assert response.status_code == 200
+    queue, = [queue for queue, messages in broker.queues.items() if messages]
+    (_, _, properties), = broker.queues[queue]
+    handled = []
+
+    def callback(bodies):
+        with tracing.span("store"):
+            handled.extend(bodies)
+
+    FakeSubscriber(broker).subscribe_lanes([Lane([queue], callback, batch_size=10, flush_interval=0)])
+    assert len(handled) == 1
+    assert {span["traceId"] for span in spans} == {_TRACE_ID}
+    request = _get_span(spans, "POST /sensors/1/data")
+    publish = _get_span(spans, "publish")
+    assert request["parentSpanId"] == _CALLER_SPAN_ID
+    assert publish["parentSpanId"] == request["spanId"]
+    assert properties.headers[tracing.TRACEPARENT] == f"00-{_TRACE_ID}-{publish['spanId']}-01"
+    for name in ("queue wait", "batch wait", "process batch"):
+        assert _get_span(spans, name)["parentSpanId"] == publish["spanId"]
+    assert _get_span(spans, "store")["parentSpanId"] == _get_span(spans, "process batch")["spanId"]
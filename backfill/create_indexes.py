@@ -0,0 +1,20 @@
+import os
+
+from shared.mongodb_client import MongoDBClient
+from shared.sensors import repository
+
+
+def main():
+    # Indexes of the sensors collection and of the read model, creating them again does nothing. Run before the
+    # API starts, like the migrations, so the API doesn't wait for Mongo to start.
+    mongodb = MongoDBClient(host=os.environ.get("MONGO_HOST", "mongodb"))
+    mongodb.getDatabase('sensors')
+    try:
+        repository.ensure_indexes(mongodb)
+        print("Indexes of the sensors collection and of the read model created")
+    finally:
+        mongodb.close()
+
+
+if __name__ == "__main__":
+    main()
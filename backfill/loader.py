@@ -0,0 +1,150 @@
+import csv
+import json
+import os
+import time
+import uuid
+from typing import Dict, Iterator, List, Optional
+
+from sqlalchemy.orm import Session
+
+from shared.cassandra_client import CassandraClient
+from shared.mongodb_client import MongoDBClient
+from shared.sensors import repository, schemas
+from shared.timescale import Timescale
+
+# Namespace of the message ids of imported readings, so importing a file twice gives the same ids
+_BACKFILL_NAMESPACE = uuid.UUID('5b0c3f4e-8a0e-4b8f-9d3a-2f1b6c7e9a10')
+
+
+def read_records(path: str, file_format: str) -> Iterator[Dict]:
+    if file_format == 'csv':
+        with open(path, newline='') as file:
+            yield from csv.DictReader(file)
+    elif file_format == 'ndjson':
+        with open(path) as file:
+            for line in file:
+                if line.strip():
+                    yield json.loads(line)
+    elif file_format == 'parquet':
+        try:
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ValueError("Reading parquet files needs pyarrow installed")
+        for batch in pq.ParquetFile(path).iter_batches():
+            yield from batch.to_pylist()
+    else:
+        raise ValueError(f"Unknown format {file_format}")
+
+
+def guess_format(path: str) -> str:
+    extension = os.path.splitext(path)[1].lower()
+    if extension == '.csv':
+        return 'csv'
+    if extension in ('.ndjson', '.jsonl', '.json'):
+        return 'ndjson'
+    if extension == '.parquet':
+        return 'parquet'
+    raise ValueError(f"Can't guess the format of {path}, use --format")
+
+
+class Loader:
+    def __init__(self, db: Session, mongo_client: MongoDBClient, timescale: Timescale, cassandra: CassandraClient,
+                 checkpoint_path: str, chunk_size: int = 10000):
+        self.db = db
+        self.mongo_client = mongo_client
+        self.timescale = timescale
+        self.cassandra = cassandra
+        self.checkpoint_path = checkpoint_path
+        self.chunk_size = chunk_size
+        self.sensors = {}
+        self.skipped = 0
+
+    def load(self, records: Iterator[Dict]):
+        done = self._read_checkpoint()
+        if done:
+            print(f"Resuming after {done} records")
+        self._started = time.monotonic()
+        self._resumed_at = done
+        chunk = []
+        pending = 0
+        for position, record in enumerate(records):
+            if position < done:
+                continue
+            message = self._to_message(record)
+            if message is None:
+                self.skipped += 1
+                print(f"Skipped record {position}: {record}")
+            else:
+                chunk.append(message)
+            pending += 1
+            if pending >= self.chunk_size:
+                done = self._flush(chunk, done + pending)
+                chunk = []
+                pending = 0
+        if pending:
+            done = self._flush(chunk, done + pending)
+        print(f"Finished: {done} records read, {self.skipped} skipped")
+
+    def _flush(self, chunk: List[schemas.SensorDataMessage], position: int) -> int:
+        if chunk:
+            repository.import_data(timescale=self.timescale, cassandra=self.cassandra, messages=chunk)
+        self._write_checkpoint(position)
+        elapsed = time.monotonic() - self._started
+        rate = (position - self._resumed_at) / elapsed if elapsed else 0
+        print(f"{position} records loaded ({rate:.0f} records/s)")
+        return position
+
+    def _to_message(self, record: Dict) -> Optional[schemas.SensorDataMessage]:
+        # None for a record that can't be imported, with the same checks as the consumer
+        sensor = self._get_sensor(record.get('name'))
+        if sensor is None:
+            return None
+        last_seen = _as_text(record.get('last_seen'))
+        time_received = _as_text(record.get('time')) or last_seen
+        message_id = str(uuid.uuid5(_BACKFILL_NAMESPACE, f"{sensor.name}:{time_received}"))
+        try:
+            match sensor.type:
+                case 'Temperatura':
+                    data = schemas.SensorDataTemperature(temperature=record.get('temperature'),
+                                                         humidity=record.get('humidity'),
+                                                         battery_level=record.get('battery_level'),
+                                                         last_seen=last_seen)
+                case 'Velocitat':
+                    data = schemas.SensorDataVelocity(velocity=record.get('velocity'),
+                                                      battery_level=record.get('battery_level'),
+                                                      last_seen=last_seen)
+                case _:
+                    return None
+            message = schemas.SensorDataMessage(message_id=message_id, sensor_id=sensor.id, name=sensor.name,
+                                                type=sensor.type, time=time_received, data=data)
+            repository.check_times(message)
+        except ValueError:
+            # ValidationError is a ValueError too
+            return None
+        return message
+
+    def _get_sensor(self, name: Optional[str]) -> Optional[schemas.Sensor]:
+        if name not in self.sensors:
+            self.sensors[name] = repository.get_sensor_schema_by_name(db=self.db, mongo_client=self.mongo_client,
+                                                                       sensor_name=name) if name else None
+        return self.sensors[name]
+
+    def _read_checkpoint(self) -> int:
+        if not os.path.exists(self.checkpoint_path):
+            return 0
+        with open(self.checkpoint_path) as file:
+            return int(file.read().strip() or 0)
+
+    def _write_checkpoint(self, position: int):
+        temporary_path = self.checkpoint_path + '.tmp'
+        with open(temporary_path, 'w') as file:
+            file.write(str(position))
+        os.replace(temporary_path, self.checkpoint_path)
+
+
+def _as_text(value) -> Optional[str]:
+    if value is None or value == '':
+        return None
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    return str(value)
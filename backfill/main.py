@@ -0,0 +1,44 @@
+import argparse
+import os
+
+from backfill.loader import Loader, guess_format, read_records
+from shared.cassandra_client import CassandraClient
+from shared.database import SessionLocal
+from shared.mongodb_client import MongoDBClient
+from shared.timescale import Timescale
+
+_SENSORS = 'sensors'
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load historical sensor readings into Timescale and Cassandra")
+    parser.add_argument("path", help="CSV, NDJSON or Parquet file with one reading per row")
+    parser.add_argument("--format", choices=["csv", "ndjson", "parquet"], help="Format of the file")
+    parser.add_argument("--chunk-size", type=int, default=10000, help="Readings sent in each COPY")
+    parser.add_argument("--restart", action="store_true", help="Ignore the checkpoint and load from the start")
+    args = parser.parse_args()
+
+    checkpoint_path = args.path + ".checkpoint"
+    if args.restart and os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+
+    db = SessionLocal()
+    mongodb = MongoDBClient(host=os.environ.get("MONGO_HOST", "mongodb"))
+    mongodb.getDatabase(_SENSORS)
+    timescale = Timescale()
+    timescale.create_table()
+    cassandra = CassandraClient(hosts=[os.environ.get("CASSANDRA_HOST", "cassandra")])
+    cassandra.create_tables()
+    try:
+        loader = Loader(db=db, mongo_client=mongodb, timescale=timescale, cassandra=cassandra,
+                        checkpoint_path=checkpoint_path, chunk_size=args.chunk_size)
+        loader.load(read_records(args.path, args.format or guess_format(args.path)))
+    finally:
+        cassandra.close()
+        timescale.close()
+        mongodb.close()
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,45 @@
+import os
+
+from cassandra.query import SimpleStatement
+
+from shared.cassandra_client import KEY_SPACE, CassandraClient
+from shared.sensors import repository
+
+_CHUNK_SIZE = 5000
+
+
+def migrate(cassandra: CassandraClient, chunk_size: int = _CHUNK_SIZE) -> int:
+    # Copies the rows of the old temperature_data table, keyed only by time, to temperature_data_by_day
+    tables = cassandra.execute(
+        "SELECT table_name FROM system_schema.tables WHERE keyspace_name = %s AND table_name = %s",
+        (KEY_SPACE, "temperature_data"))
+    if tables.one() is None:
+        print("There is no temperature_data table to migrate")
+        return 0
+    statement = SimpleStatement("SELECT time, name, temperature FROM temperature_data", fetch_size=chunk_size)
+    copied = 0
+    rows = []
+    for time, name, temperature in cassandra.get_session().execute(statement):
+        rows.append((name, time, temperature))
+        if len(rows) >= chunk_size:
+            repository.import_temperature_data(cassandra=cassandra, rows=rows)
+            copied += len(rows)
+            rows = []
+            print(f"{copied} rows copied")
+    repository.import_temperature_data(cassandra=cassandra, rows=rows)
+    copied += len(rows)
+    print(f"Finished: {copied} rows copied, temperature_data can be dropped")
+    return copied
+
+
+def main():
+    cassandra = CassandraClient(hosts=[os.environ.get("CASSANDRA_HOST", "cassandra")])
+    cassandra.create_tables()
+    try:
+        migrate(cassandra)
+    finally:
+        cassandra.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,41 @@
+import os
+
+from shared.database import SessionLocal
+from shared.mongodb_client import MongoDBClient
+from shared.sensors import records, repository
+
+_CHUNK_SIZE = 1000
+_REBUILD = records.SENSOR_RECORDS + '_rebuild'
+
+
+def main():
+    # Builds the read model of the sensors again from Postgres and the sensors collection, in a collection of
+    # its own that then replaces sensor_records, so the API keeps reading the old one until it's done
+    db = SessionLocal()
+    mongodb = MongoDBClient(host=os.environ.get("MONGO_HOST", "mongodb"))
+    database = mongodb.getDatabase('sensors')
+    try:
+        database.drop_collection(_REBUILD)
+        records.ensure_indexes(mongodb, _REBUILD)
+        rebuild = mongodb.getCollection(_REBUILD)
+        copied = 0
+        after_id = 0
+        while True:
+            db_sensors = repository.get_sensors_after(db=db, after_id=after_id, limit=_CHUNK_SIZE)
+            if not db_sensors:
+                break
+            page = repository.get_sensor_records(mongo_client=mongodb, db_sensors=db_sensors)
+            if page:
+                rebuild.insert_many(page)
+            copied += len(page)
+            after_id = db_sensors[-1].id
+            print(f"{copied} sensors copied")
+        rebuild.rename(records.SENSOR_RECORDS, dropTarget=True)
+        print(f"Finished: {copied} sensors in {records.SENSOR_RECORDS}")
+    finally:
+        mongodb.close()
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,41 @@
+import json
+import os
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Stand-in for an OpenTelemetry collector: it takes the OTLP JSON that the API and the consumer send to
+# /v1/traces, appends every span as a JSON line to COLLECTOR_FILE and prints how long it took
+PORT = int(os.environ.get("COLLECTOR_PORT", "4318"))
+COLLECTOR_FILE = os.environ.get("COLLECTOR_FILE", "spans.jsonl")
+
+
+class TraceHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        if self.path != "/v1/traces":
+            self.send_error(404)
+            return
+        payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+        lines = []
+        for resource_spans in payload.get("resourceSpans", []):
+            service = next((attribute["value"]["stringValue"]
+                            for attribute in resource_spans.get("resource", {}).get("attributes", [])
+                            if attribute["key"] == "service.name"), "")
+            for scope_spans in resource_spans.get("scopeSpans", []):
+                for span in scope_spans.get("spans", []):
+                    span["service"] = service
+                    lines.append(json.dumps(span))
+                    duration = (int(span["endTimeUnixNano"]) - int(span["startTimeUnixNano"])) / 1e6
+                    print("%s %s %s: %.1f ms" % (span["traceId"][:8], service, span["name"], duration))
+        with open(COLLECTOR_FILE, "a") as file:
+            file.write("".join(line + "\n" for line in lines))
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.end_headers()
+        self.wfile.write(b"{}")
+
+    def log_message(self, format, *args):
+        pass
+
+
+if __name__ == "__main__":
+    print("Collecting traces on port", PORT)
+    ThreadingHTTPServer(("", PORT), TraceHandler).serve_forever()
@@ -1,13 +1,64 @@
-import json
+import os
 
-from shared.subscriber import Subscriber
+from consumer.processor import (check_silence, enforce_retention, process_alerts, process_batch, process_control,
+                                replay_spilled)
+from consumer.sinks import Sink
+from consumer.spill import SpillFull
+from shared import cassandra_client, mongodb_client, redis_client, timescale as timescale_client
+from shared.cassandra_client import CassandraClient
+from shared.mongodb_client import MongoDBClient
+from shared.publisher import ALERTS, CONNECTION_ERRORS, CONTROL, Publisher, get_lane_queue, get_shard_queue
+from shared.redis_client import RedisClient
+from shared.sensors import repository
+from shared.sharding import get_owned_shards
+from shared.subscriber import Lane, Subscriber
+from shared.timescale import Timescale
 
-subscriber = Subscriber()
+subscriber = Subscriber(host=os.environ.get("RABBITMQ_HOST", "localhost"))
+publisher = Publisher(host=os.environ.get("RABBITMQ_HOST", "localhost"))
 
+timescale = Timescale()
+timescale.create_table()
+redis = RedisClient(host=os.environ.get("REDIS_HOST", "localhost"))
+cassandra = CassandraClient(hosts=[os.environ.get("CASSANDRA_HOST", "localhost")])
+cassandra.create_tables()
+mongodb = MongoDBClient(host=os.environ.get("MONGO_HOST", "localhost"))
+mongodb.getDatabase('sensors')
+repository.ensure_indexes(mongodb)
 
-def callback(ch, method, properties, body):
-    data = json.loads(body)
-    print("Received data:", data)
+# If one of them is down its readings wait in a local spill file while the rest of the batch goes on
+timescale_sink = Sink("timescale", lambda messages: repository.store_in_timescale(timescale, messages),
+                      errors=timescale_client.ERRORS, reconnect=timescale.reconnect)
+cassandra_sink = Sink("cassandra", lambda messages: repository.store_in_cassandra(cassandra, messages),
+                      errors=cassandra_client.ERRORS)
+sinks = [timescale_sink, cassandra_sink]
+# A batch that fails with one of these is tried again whole after a backoff, any other error dead-letters the
+# messages that cause it. A full spill file keeps the readings in the broker until the sink is back.
+retry_errors = CONNECTION_ERRORS + redis_client.ERRORS + mongodb_client.ERRORS + (SpillFull,)
 
 
-subscriber.subscribe(callback)
+def callback(bodies):
+    process_batch(bodies, sinks=sinks, redis=redis, publisher=publisher)
+    print("Stored %d messages" % len(bodies))
+    enforce_retention(timescale, timescale_sink)
+
+
+def tick():
+    check_silence(publisher)
+    replay_spilled(sinks)
+
+
+# Each consumer reads the shards that CONSUMER_INDEX owns among CONSUMER_COUNT consumers. To rebalance, start
+# the consumers with the new count and then stop the old ones: every shard queue allows a single active
+# consumer, so a shard only moves to its new owner once the previous one has gone and order is kept.
+shards = get_owned_shards(int(os.environ.get("CONSUMER_INDEX", "0")), int(os.environ.get("CONSUMER_COUNT", "1")))
+print("Consuming shards", shards)
+# Control events and alerts are few and small: they are handled as soon as they arrive and several of their
+# batches go before each batch of readings, so a readings backlog doesn't delay them
+subscriber.subscribe_lanes([
+    Lane([get_lane_queue(CONTROL)], lambda bodies: process_control(bodies, redis=redis, mongo_client=mongodb),
+         batch_size=50, flush_interval=0, weight=4, retry_errors=retry_errors),
+    Lane([get_lane_queue(ALERTS)], process_alerts, batch_size=50, flush_interval=0, weight=4,
+         retry_errors=retry_errors),
+    Lane([get_shard_queue(shard) for shard in shards], callback, retry_errors=retry_errors),
+], tick=tick)
@@ -0,0 +1,145 @@
+import os
+import time
+from typing import List
+
+import orjson
+from pydantic import ValidationError
+
+from consumer.rules import RuleEngine, load_rules
+from consumer.sinks import Sink
+from shared import tracing
+from shared.mongodb_client import MongoDBClient
+from shared.publisher import ALERTS, LIVE, Publisher
+from shared.redis_client import RedisClient
+from shared.sensors import cache, records, repository, rollups, schemas
+from shared.timescale import Timescale
+
+# Ids of the messages already written are remembered for this many seconds
+SEEN_WINDOW = 60 * 60
+_SEEN_PREFIX = 'seen:'
+# Seconds between two deletions of the raw readings older than RAW_RETENTION
+RETENTION_INTERVAL = 60 * 60
+_next_retention = 0.0
+
+# Sensors whose type is already counted in type_sensor, only new ones change the quantity by type
+_known_sensor_ids = set()
+rule_engine = RuleEngine(load_rules(os.environ.get("RULES_FILE")))
+
+
+def process_batch(bodies: List[bytes], sinks: List[Sink], redis: RedisClient, publisher: Publisher):
+    with tracing.span("decode"):
+        messages = _decode(bodies)
+    with tracing.span("drop already seen"):
+        messages = _drop_already_seen(redis, messages)
+    if not messages:
+        return
+    # A sink that is down keeps the readings in its spill file, so the batch goes on and is acked
+    for sink in sinks:
+        sink.write(messages)
+    with tracing.span("redis write"):
+        repository.store_latest_values(redis=redis, messages=messages)
+    # Only mark the ids once every sink has the data, otherwise a crash here would lose the batch
+    with tracing.span("mark seen"):
+        redis.set_many({_seen_key(message.message_id): 1 for message in messages}, ex=SEEN_WINDOW)
+    cache.bump(redis, _get_changed_aggregates(messages))
+    publisher.publish(schemas.SensorDataBatch.construct(readings=messages), lane=LIVE)
+    for message in messages:
+        for alert in rule_engine.evaluate(message):
+            publisher.publish(alert, lane=ALERTS)
+
+
+def check_silence(publisher: Publisher):
+    for alert in rule_engine.check_silence():
+        publisher.publish(alert, lane=ALERTS)
+
+
+def replay_spilled(sinks: List[Sink]):
+    for sink in sinks:
+        sink.replay()
+
+
+def enforce_retention(timescale: Timescale, sink: Sink):
+    global _next_retention
+    if not rollups.RAW_RETENTION or time.monotonic() < _next_retention:
+        return
+    _next_retention = time.monotonic() + RETENTION_INTERVAL
+    sink.call(lambda: repository.delete_expired_data(timescale, rollups.RAW_RETENTION))
+
+
+def process_control(bodies: List[bytes], redis: RedisClient, mongo_client: MongoDBClient):
+    for event in _decode_events(bodies):
+        if event.event == repository.SENSOR_CREATED and event.sensor is not None:
+            records.upsert(mongo_client, records.to_record(event.sensor, event.joined_at))
+        if event.event == repository.SENSOR_DELETED:
+            # Already done by the API, unless it failed in between
+            records.delete(mongo_client, event.sensor_id)
+            # A reading still in the telemetry lane may have written the latest value after the API deleted it
+            redis.delete(event.sensor_id)
+            _known_sensor_ids.discard(event.sensor_id)
+            rule_engine.forget(event.sensor_id)
+            cache.bump(redis, cache.ALL)
+        print("Sensor %s: %s" % (event.event, event.name))
+
+
+def process_alerts(bodies: List[bytes]):
+    for body in bodies:
+        try:
+            alert = schemas.SensorAlert.parse_raw(body)
+        except ValidationError:
+            print("Discarded alert:", body)
+            continue
+        print("ALERT %s on %s: %s at %s" % (alert.alert, alert.name, alert.value, alert.last_seen))
+
+
+def _decode_events(bodies: List[bytes]) -> List[schemas.SensorEvent]:
+    # A batch registration sends all its events in one message
+    events = []
+    for body in bodies:
+        try:
+            content = orjson.loads(body)
+            if isinstance(content, dict) and 'events' in content:
+                events.extend(schemas.SensorEventBatch.parse_obj(content).events)
+            else:
+                events.append(schemas.SensorEvent.parse_obj(content))
+        except ValueError:
+            # ValidationError and JSONDecodeError are ValueErrors too
+            print("Discarded event:", body)
+    return events
+
+
+def _decode(bodies: List[bytes]) -> List[schemas.SensorDataMessage]:
+    messages = {}
+    for body in bodies:
+        try:
+            message = schemas.SensorDataMessage.parse_raw(body)
+            repository.check_times(message)
+        except ValueError:
+            # ValidationError is a ValueError too
+            print("Discarded message:", body)
+            continue
+        messages[message.message_id] = message
+    return list(messages.values())
+
+
+def _drop_already_seen(redis: RedisClient, messages: List[schemas.SensorDataMessage]) -> List[schemas.SensorDataMessage]:
+    if not messages:
+        return messages
+    seen = redis.mget([_seen_key(message.message_id) for message in messages])
+    return [message for message, already_seen in zip(messages, seen) if already_seen is None]
+
+
+def _get_changed_aggregates(messages: List[schemas.SensorDataMessage]) -> set:
+    changed = set()
+    for message in messages:
+        if message.type == 'Temperatura':
+            changed.add(cache.TEMPERATURE_VALUES)
+        if message.data.battery_level <= repository.LOW_BATTERY_LEVEL:
+            changed.add(cache.LOW_BATTERY)
+        if message.sensor_id not in _known_sensor_ids:
+            _known_sensor_ids.add(message.sensor_id)
+            changed.add(cache.QUANTITY_BY_TYPE)
+    return changed
+
+
+def _seen_key(message_id: str) -> str:
+    return _SEEN_PREFIX + message_id
@@ -0,0 +1,154 @@
+import json
+import operator
+import time
+from collections import OrderedDict
+from datetime import datetime
+from typing import Dict, List, Literal, Optional
+
+from pydantic import BaseModel, root_validator
+
+from shared.sensors import rollups, schemas
+from shared.sensors.repository import LOW_BATTERY_LEVEL, _to_datetime
+
+THRESHOLD = 'threshold'
+RATE = 'rate'
+SILENCE = 'silence'
+
+_OPERATORS = {'<': operator.lt, '<=': operator.le, '>': operator.gt, '>=': operator.ge}
+# The fields each kind of rule needs
+_REQUIRED = {THRESHOLD: ('field', 'value'), RATE: ('field', 'max_per_second'), SILENCE: ('seconds',)}
+
+
+class Rule(BaseModel):
+    # threshold: field op value, for example battery_level <= 0.2
+    # rate: the field changes more than max_per_second between two readings
+    # silence: no reading for seconds
+    name: str
+    kind: Literal['threshold', 'rate', 'silence']
+    type: Optional[str] = None
+    field: Optional[str] = None
+    op: Literal['<', '<=', '>', '>='] = '>'
+    value: Optional[float] = None
+    max_per_second: Optional[float] = None
+    seconds: Optional[float] = None
+
+    @root_validator(skip_on_failure=True)
+    def check_kind_fields(cls, values):
+        # A rule without them would only fail on the first reading it's checked against
+        missing = [field for field in _REQUIRED[values['kind']] if values.get(field) is None]
+        if missing:
+            raise ValueError(f"{values['kind']} rules need {', '.join(missing)}")
+        if values.get('field') is not None and values['field'] not in rollups.FIELDS:
+            raise ValueError(f"field must be one of {', '.join(rollups.FIELDS)}")
+        return values
+
+
+# Rules used when RULES_FILE isn't set, the low battery one replaces the scan of /sensors/low_battery
+DEFAULT_RULES = [
+    {'name': 'low_battery', 'kind': THRESHOLD, 'field': 'battery_level', 'op': '<=', 'value': LOW_BATTERY_LEVEL},
+]
+
+
+def load_rules(path: Optional[str] = None) -> List[Rule]:
+    # RULES_FILE holds a JSON list of rules with the same fields as DEFAULT_RULES
+    if not path:
+        return [Rule.parse_obj(rule) for rule in DEFAULT_RULES]
+    with open(path) as file:
+        return [Rule.parse_obj(rule) for rule in json.load(file)]
+
+
+class _SensorState:
+    __slots__ = ('name', 'values', 'last_seen')
+
+    def __init__(self, name: str):
+        self.name = name
+        self.values = {}
+        self.last_seen = None
+
+
+class RuleEngine:
+    # Each reading is checked against the rules of its type with the previous values of its sensor only, so the
+    # cost per reading doesn't depend on how many sensors or readings there are. An alert is raised when its
+    # condition starts and raised again only after the condition has cleared.
+
+    def __init__(self, rules: List[Rule]):
+        self.rules = rules
+        self.sensors: Dict[int, _SensorState] = {}
+        self.active = set()
+        # Sensors by arrival of their last reading for each silence rule, the oldest first
+        self.arrivals = {rule.name: OrderedDict() for rule in rules if rule.kind == SILENCE}
+
+    def evaluate(self, message: schemas.SensorDataMessage) -> List[schemas.SensorAlert]:
+        state = self.sensors.get(message.sensor_id)
+        if state is None:
+            state = self.sensors[message.sensor_id] = _SensorState(message.name)
+        last_seen = _to_datetime(message.data.last_seen)
+        alerts = []
+        for rule in self.rules:
+            if rule.type is not None and rule.type != message.type:
+                continue
+            if rule.kind == SILENCE:
+                arrivals = self.arrivals[rule.name]
+                arrivals[message.sensor_id] = time.monotonic()
+                arrivals.move_to_end(message.sensor_id)
+                continue
+            value = getattr(message.data, rule.field, None)
+            if value is None:
+                continue
+            if rule.kind == THRESHOLD:
+                triggered = _OPERATORS[rule.op](value, rule.value)
+            else:
+                triggered = self._is_too_fast(rule, state, value, last_seen)
+            alert = self._update(rule, message.sensor_id, state.name, triggered, value, message.data.last_seen)
+            if alert is not None:
+                alerts.append(alert)
+        if state.last_seen is None or last_seen >= state.last_seen:
+            state.last_seen = last_seen
+            for field in ('temperature', 'humidity', 'velocity', 'battery_level'):
+                value = getattr(message.data, field, None)
+                if value is not None:
+                    state.values[field] = value
+        return alerts
+
+    def check_silence(self) -> List[schemas.SensorAlert]:
+        # Only the sensors that have been silent longer than a rule allows are visited. They leave the rule
+        # until their next reading, so each silence is reported once.
+        now = time.monotonic()
+        alerts = []
+        for rule in self.rules:
+            if rule.kind != SILENCE:
+                continue
+            arrivals = self.arrivals[rule.name]
+            while arrivals:
+                sensor_id, arrival = next(iter(arrivals.items()))
+                if now - arrival < rule.seconds:
+                    break
+                arrivals.popitem(last=False)
+                state = self.sensors[sensor_id]
+                alerts.append(schemas.SensorAlert(alert=rule.name, sensor_id=sensor_id, name=state.name,
+                                                  value=now - arrival, last_seen=state.last_seen.isoformat()))
+        return alerts
+
+    def forget(self, sensor_id: int):
+        self.sensors.pop(sensor_id, None)
+        for arrivals in self.arrivals.values():
+            arrivals.pop(sensor_id, None)
+        self.active = {key for key in self.active if key[1] != sensor_id}
+
+    def _is_too_fast(self, rule: Rule, state: _SensorState, value: float, last_seen: datetime) -> bool:
+        previous = state.values.get(rule.field)
+        if previous is None or state.last_seen is None or last_seen <= state.last_seen:
+            return False
+        elapsed = (last_seen - state.last_seen).total_seconds()
+        return abs(value - previous) / elapsed > rule.max_per_second
+
+    def _update(self, rule: Rule, sensor_id: int, name: str, triggered: bool, value: float,
+                last_seen: str) -> Optional[schemas.SensorAlert]:
+        key = (rule.name, sensor_id)
+        if not triggered:
+            self.active.discard(key)
+            return None
+        if key in self.active:
+            return None
+        self.active.add(key)
+        return schemas.SensorAlert(alert=rule.name, sensor_id=sensor_id, name=name, value=value, last_seen=last_seen)
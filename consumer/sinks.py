@@ -0,0 +1,129 @@
+import os
+import time
+from typing import List
+
+from pydantic import ValidationError
+
+from consumer.spill import SpillFile
+from shared import tracing
+from shared.sensors import schemas
+
+# Failed writes in a row after which a sink is left alone and its readings go to its spill file
+FAILURE_THRESHOLD = int(os.environ.get("SINK_FAILURE_THRESHOLD", "3"))
+# Seconds an open sink waits before it's tried again
+RESET_TIMEOUT = float(os.environ.get("SINK_RESET_TIMEOUT", "30"))
+# A write that takes longer than this counts as a failure, even if it got through
+SLOW_WRITE = float(os.environ.get("SINK_SLOW_WRITE", "5"))
+# Readings replayed from the spill file in each write
+REPLAY_BATCH = 5000
+SPILL_DIR = os.environ.get("SPILL_DIR", "spill")
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold: int = FAILURE_THRESHOLD, reset_timeout: float = RESET_TIMEOUT):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+
+    def allow(self) -> bool:
+        # An open breaker lets one write through after the timeout, its result closes or opens it again
+        if self.state == OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+            self.state = HALF_OPEN
+        return self.state != OPEN
+
+    def succeeded(self):
+        self.state = CLOSED
+        self.failures = 0
+
+    def failed(self):
+        self.failures += 1
+        if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+            self.state = OPEN
+            self.opened_at = time.monotonic()
+
+
+class Sink:
+    # A store the readings are written to. While its breaker is open the readings are appended to its spill
+    # file instead, so the batch is still acked and the other sinks keep going. They are replayed in batches of
+    # REPLAY_BATCH once it takes writes again.
+    def __init__(self, name: str, write, errors: tuple, reconnect=None, spill: SpillFile | None = None,
+                 breaker: CircuitBreaker | None = None):
+        self.name = name
+        self.write_messages = write
+        self.errors = errors
+        self.reconnect = reconnect
+        self.spill = spill if spill is not None else SpillFile(os.path.join(SPILL_DIR, name))
+        self.breaker = breaker if breaker is not None else CircuitBreaker()
+
+    def write(self, messages: List[schemas.SensorDataMessage]):
+        with tracing.span(f"{self.name} write", readings=len(messages)):
+            if self.breaker.allow() and self._try(messages):
+                return
+            self.spill.append([message.to_json().encode() for message in messages])
+            print("Sink %s is %s, spilled %d readings" % (self.name, self.breaker.state, len(messages)))
+
+    def call(self, function) -> bool:
+        # Runs an operation on the store other than writing readings, unless the breaker is open
+        if not self.breaker.allow():
+            return False
+        try:
+            function()
+        except self.errors as e:
+            self._fail(e)
+            return False
+        return True
+
+    def replay(self):
+        # One segment of the spill file at a time, deleted once all of its readings are written. A segment that
+        # fails with an error other than those of a store that is down would fail forever, it's quarantined.
+        if not len(self.spill) or not self.breaker.allow():
+            return
+        records = self.spill.oldest()
+        for start in range(0, len(records), REPLAY_BATCH):
+            try:
+                if not self._try(_decode(records[start:start + REPLAY_BATCH])):
+                    return
+            except Exception as e:
+                self.spill.quarantine_oldest()
+                print("Sink %s quarantined a spilled segment of %d readings: %s" % (self.name, len(records), e))
+                return
+        self.spill.remove_oldest()
+        print("Sink %s replayed %d readings, %d segments left" % (self.name, len(records), len(self.spill)))
+
+    def _try(self, messages) -> bool:
+        started = time.monotonic()
+        try:
+            self.write_messages(messages)
+        except self.errors as e:
+            self._fail(e)
+            return False
+        if time.monotonic() - started > SLOW_WRITE:
+            self.breaker.failed()
+        else:
+            self.breaker.succeeded()
+        return True
+
+    def _fail(self, error):
+        self.breaker.failed()
+        print("Sink %s failed: %s" % (self.name, error))
+        if self.reconnect is not None:
+            try:
+                self.reconnect()
+            except self.errors:
+                pass
+
+
+def _decode(records: List[bytes]) -> List[schemas.SensorDataMessage]:
+    messages = []
+    for record in records:
+        try:
+            messages.append(schemas.SensorDataMessage.parse_raw(record))
+        except ValidationError:
+            print("Discarded spilled reading:", record)
+    return messages
@@ -0,0 +1,113 @@
+import mmap
+import os
+import struct
+
+# Records that a sink couldn't take, kept on local disk until it's back. They are appended to segment files of
+# SEGMENT_SIZE bytes, named by their sequence number and written through a memory map. Each record is its
+# length in 4 bytes followed by its bytes, a length of 0 marks the end of what was written to the segment.
+SEGMENT_SIZE = int(os.environ.get("SPILL_SEGMENT_SIZE", str(4 * 1024 * 1024)))
+# Bytes of segments a spill file holds at most, past that appending fails
+MAX_BYTES = int(os.environ.get("SPILL_MAX_BYTES", str(1024 * 1024 * 1024)))
+# Segments that can't be replayed are moved here, next to the others, to be looked at
+QUARANTINE = 'quarantine'
+_LENGTH = struct.Struct('>I')
+_SUFFIX = '.seg'
+
+
+class SpillFull(Exception):
+    pass
+
+
+class SpillFile:
+    def __init__(self, directory: str, segment_size: int = SEGMENT_SIZE, max_bytes: int = MAX_BYTES):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+        # Segments left by a previous run are replayed but not appended to
+        self.sealed = sorted(int(name[:-len(_SUFFIX)]) for name in os.listdir(directory) if name.endswith(_SUFFIX))
+        self.next_sequence = self.sealed[-1] + 1 if self.sealed else 0
+        self.size = sum(os.path.getsize(self._get_path(sequence)) for sequence in self.sealed)
+        self.current = None
+        self.current_map = None
+        self.offset = 0
+
+    def __len__(self):
+        # Segments waiting to be replayed, counting the one being written
+        return len(self.sealed) + (self.current is not None)
+
+    def append(self, records):
+        # The whole batch is refused if it doesn't fit, so none of it is spilled
+        needed = sum(_LENGTH.size + len(record) for record in records) + _LENGTH.size
+        available = len(self.current_map) - self.offset if self.current is not None else 0
+        if needed > available and self.size + max(needed - available, self.segment_size) > self.max_bytes:
+            raise SpillFull("The spill file %s holds %d bytes" % (self.directory, self.size))
+        for record in records:
+            size = _LENGTH.size + len(record)
+            # Room is always left for the end mark
+            if self.current is None or self.offset + size + _LENGTH.size > len(self.current_map):
+                self._start_segment(size + _LENGTH.size)
+            self.current_map[self.offset:self.offset + size] = _LENGTH.pack(len(record)) + record
+            self.offset += size
+        if self.current_map is not None:
+            self.current_map.flush()
+
+    def oldest(self) -> list:
+        # The records of the oldest segment, the one being written is closed first if it's the only one
+        if not self.sealed and self.current is not None:
+            self._seal()
+        if not self.sealed:
+            return []
+        with open(self._get_path(self.sealed[0]), 'rb') as file:
+            data = file.read()
+        records = []
+        offset = 0
+        while offset + _LENGTH.size <= len(data):
+            length, = _LENGTH.unpack_from(data, offset)
+            if length == 0:
+                break
+            offset += _LENGTH.size
+            records.append(data[offset:offset + length])
+            offset += length
+        return records
+
+    def remove_oldest(self):
+        # Once its records are in the sink
+        path = self._get_path(self.sealed.pop(0))
+        self.size -= os.path.getsize(path)
+        os.remove(path)
+
+    def quarantine_oldest(self):
+        # Instead of removing it, when the sink refuses its records. Quarantined segments don't count in the size.
+        path = self._get_path(self.sealed.pop(0))
+        self.size -= os.path.getsize(path)
+        os.makedirs(os.path.join(self.directory, QUARANTINE), exist_ok=True)
+        os.replace(path, os.path.join(self.directory, QUARANTINE, os.path.basename(path)))
+
+    def close(self):
+        if self.current is not None:
+            self._seal()
+
+    def _start_segment(self, min_size):
+        if self.current is not None:
+            self._seal()
+        self.current = self.next_sequence
+        self.next_sequence += 1
+        size = max(self.segment_size, min_size)
+        self.size += size
+        with open(self._get_path(self.current), 'wb') as file:
+            # The file is created with its final size, full of zeros, which is also the end mark
+            file.truncate(size)
+        with open(self._get_path(self.current), 'r+b') as file:
+            self.current_map = mmap.mmap(file.fileno(), size)
+        self.offset = 0
+
+    def _seal(self):
+        self.current_map.flush()
+        self.current_map.close()
+        self.sealed.append(self.current)
+        self.current = None
+        self.current_map = None
+
+    def _get_path(self, sequence):
+        return os.path.join(self.directory, f"{sequence:010d}{_SUFFIX}")
@@ -1,12 +1,27 @@
-from cassandra.cluster import Cluster
+from cassandra import OperationTimedOut, Unavailable, WriteTimeout
+from cassandra.cluster import Cluster, NoHostAvailable
+from cassandra.concurrent import execute_concurrent
+from cassandra.protocol import OverloadedErrorMessage
+from cassandra.query import BatchStatement, BatchType
+
+from shared.timing import timed
 
 KEY_SPACE = "sensor"
+# Requests sent to the cluster at the same time by execute_concurrent
+MAX_IN_FLIGHT = 64
+# Rows in each unlogged batch, big batches are rejected by the coordinator
+BATCH_SIZE = 100
+# Errors of an unreachable or overloaded cluster, the driver reconnects by itself once it's back. Other errors,
+# like an invalid query, would fail again however many times the write is retried.
+ERRORS = (NoHostAvailable, OperationTimedOut, Unavailable, WriteTimeout, OverloadedErrorMessage)
 
 
+@timed("cassandra")
 class CassandraClient:
     def __init__(self, hosts):
         self.cluster = Cluster(hosts, protocol_version=4)
         self.session = self.cluster.connect()
+        self.prepared = {}
 
     def create_tables(self):
         replication_config = {'class': 'SimpleStrategy', 'replication_factor': 1}
@@ -17,8 +32,12 @@ class CassandraClient:
             "CREATE TABLE IF NOT EXISTS low_battery (battery_level float,name text,PRIMARY KEY (battery_level, name));")
         self.session.execute(
             "CREATE TABLE IF NOT EXISTS type_sensor (sensor_type text, id int, PRIMARY KEY (sensor_type, id));")
+        # One partition per sensor and day, newest readings first, so a time range only reads its days
+        self.session.execute(
+            "CREATE TABLE IF NOT EXISTS temperature_data_by_day (name text, day_bucket date, time timestamp, "
+            "temperature float, PRIMARY KEY ((name, day_bucket), time)) WITH CLUSTERING ORDER BY (time DESC);")
         self.session.execute(
-            "CREATE TABLE IF NOT EXISTS temperature_data ( time timestamp, name text, temperature float, PRIMARY KEY (time, name));")
+            "CREATE TABLE IF NOT EXISTS temperature_days (name text, day_bucket date, PRIMARY KEY (name, day_bucket));")
 
     def get_session(self):
         return self.session
@@ -30,4 +49,35 @@ class CassandraClient:
         if values:
             return self.session.execute(query, values)
         else:
-            return self.session.execute(query)
\ No newline at end of file
+            return self.session.execute(query)
+
+    def prepare(self, query):
+        # Statements are parsed by the cluster once per client and then only the values are sent
+        statement = self.prepared.get(query)
+        if statement is None:
+            statement = self.session.prepare(query)
+            self.prepared[query] = statement
+        return statement
+
+    def execute_prepared(self, query, values=None):
+        return self.session.execute(self.prepare(query), values)
+
+    def execute_async(self, query, values=None):
+        return self.session.execute_async(self.prepare(query), values)
+
+    def execute_concurrent(self, statements_and_values, concurrency=MAX_IN_FLIGHT):
+        # Each item is a (query, values) pair, queries are prepared, batches are sent as they are
+        statements = [(statement, values or ()) if isinstance(statement, BatchStatement)
+                      else (self.prepare(statement), values)
+                      for statement, values in statements_and_values]
+        return execute_concurrent(self.session, statements, concurrency=concurrency, raise_on_first_error=True)
+
+    def unlogged_batches(self, query, rows, size=BATCH_SIZE):
+        statement = self.prepare(query)
+        batches = []
+        for start in range(0, len(rows), size):
+            batch = BatchStatement(batch_type=BatchType.UNLOGGED)
+            for values in rows[start:start + size]:
+                batch.add(statement, values)
+            batches.append(batch)
+        return batches
@@ -1,6 +1,9 @@
-from elasticsearch import Elasticsearch
+from elasticsearch import Elasticsearch, helpers
 
+from shared.timing import timed
 
+
+@timed("elasticsearch")
 class ElasticsearchClient:
     def __init__(self, host="localhost", port="9200"):
         self.host = host
@@ -31,4 +34,13 @@ class ElasticsearchClient:
         return self.client.search(index=index_name, body=query)
 
     def index_document(self, index_name, document):
-        return self.client.index(index=index_name, document=document)
\ No newline at end of file
+        return self.client.index(index=index_name, document=document)
+
+    def bulk_index(self, index_name, documents):
+        # All the documents in one _bulk request. Returns the error of each document in their order, None for
+        # the ones indexed, and every document fails if the request does.
+        results = helpers.streaming_bulk(self.client, ({"_index": index_name, "_source": document}
+                                                       for document in documents),
+                                         chunk_size=len(documents) or 1, raise_on_error=False,
+                                         raise_on_exception=False)
+        return [None if ok else item for ok, item in results]
\ No newline at end of file
@@ -1,11 +1,17 @@
 from pymongo import MongoClient
+from pymongo.errors import ConnectionFailure
+
+from shared.timing import MongoCommandTimer
+
+# Errors of a lost or unreachable server, the client connects again by itself on the next operation
+ERRORS = (ConnectionFailure,)
 
 
 class MongoDBClient:
     def __init__(self, host="localhost", port=27017):
         self.host = host
         self.port = port
-        self.client = MongoClient(host, port)
+        self.client = MongoClient(host, port, event_listeners=[MongoCommandTimer("mongo")])
         self.database = None
         self.collection = None
 
@@ -24,4 +30,14 @@ class MongoDBClient:
         return self.collection
 
     def clearDb(self, database):
-        self.client.drop_database(database)
\ No newline at end of file
+        self.client.drop_database(database)
+
+    def create_indexes(self, collection, indexes):
+        # indexes are (keys, options) pairs, creating an index that already exists does nothing
+        target = self.getCollection(collection)
+        return [target.create_index(keys, **options) for keys, options in indexes]
+
+    def find_by_names(self, collection, names, projection=None):
+        # The documents of all the names in one query, by name
+        documents = self.getCollection(collection).find({'name': {'$in': list(names)}}, projection)
+        return {document['name']: document for document in documents}
\ No newline at end of file
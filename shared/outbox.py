@@ -0,0 +1,131 @@
+import json
+import os
+import sqlite3
+import threading
+
+# Messages the publisher couldn't hand to the broker wait here, in a local SQLite file, until the relay of the
+# publisher sends them. Without OUTBOX_PATH there is no outbox and a failed publish raises as before.
+OUTBOX_PATH = os.environ.get("OUTBOX_PATH", "")
+# Bytes of message bodies the outbox holds at most, past that publishing fails. The dead letters don't count.
+MAX_BYTES = int(os.environ.get("OUTBOX_MAX_BYTES", str(256 * 1024 * 1024)))
+
+
+class OutboxFull(Exception):
+    pass
+
+
+class _Group:
+    # Messages committed together, with a single fsync, by whichever thread was first to append
+    def __init__(self):
+        self.rows = []
+        self.done = threading.Event()
+        self.error = None
+
+
+class Outbox:
+    def __init__(self, path: str, max_bytes: int = MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=FULL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS outbox (id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                          "exchange TEXT NOT NULL, routing_key TEXT NOT NULL, body BLOB NOT NULL, "
+                          "message_id TEXT, headers TEXT)")
+        # Messages the broker refused even after the queues were declared again, kept to be looked at
+        self.conn.execute("CREATE TABLE IF NOT EXISTS dead_letters (id INTEGER PRIMARY KEY, exchange TEXT NOT NULL, "
+                          "routing_key TEXT NOT NULL, body BLOB NOT NULL, message_id TEXT, headers TEXT)")
+        self.size, self.count = self.conn.execute(
+            "SELECT COALESCE(SUM(LENGTH(body)), 0), COUNT(*) FROM outbox").fetchone()
+        # Held for every statement, the connection is shared by the API threads and the relay
+        self.db_lock = threading.Lock()
+        self.lock = threading.Lock()
+        self.group = None
+        self.committing = False
+        self.appended = threading.Event()
+
+    def __len__(self):
+        return self.count
+
+    def append(self, exchange: str, routing_key: str, body: str | bytes, message_id: str | None,
+               headers: dict | None):
+        # Returns once the message is on disk. Threads that append while a commit is running wait for the next
+        # one, which takes all of them at once.
+        row = (exchange, routing_key, body.encode() if isinstance(body, str) else body, message_id,
+               json.dumps(headers) if headers else None)
+        with self.lock:
+            if self.size + len(row[2]) > self.max_bytes:
+                raise OutboxFull("The outbox holds %d bytes" % self.size)
+            self.size += len(row[2])
+            self.count += 1
+            if self.group is None:
+                self.group = _Group()
+            group = self.group
+            group.rows.append(row)
+            leader = not self.committing
+            if leader:
+                self.committing = True
+        if leader:
+            self._commit_groups()
+        group.done.wait()
+        if group.error is not None:
+            raise group.error
+        self.appended.set()
+
+    def peek(self, limit: int) -> list:
+        # The oldest messages, as (id, exchange, routing_key, body, message_id, headers) tuples
+        with self.db_lock:
+            rows = self.conn.execute("SELECT id, exchange, routing_key, body, message_id, headers FROM outbox "
+                                     "ORDER BY id LIMIT ?", (limit,)).fetchall()
+        return [(id, exchange, routing_key, body, message_id, json.loads(headers) if headers else None)
+                for id, exchange, routing_key, body, message_id, headers in rows]
+
+    def remove(self, rows: list, refused: list = ()):
+        # Once the relay has sent them, those of them the broker refused are moved to the dead letters
+        with self.db_lock:
+            self.conn.execute("BEGIN")
+            self.conn.executemany("INSERT INTO dead_letters SELECT * FROM outbox WHERE id = ?",
+                                  [(row[0],) for row in refused])
+            self.conn.execute("DELETE FROM outbox WHERE id <= ?", (rows[-1][0],))
+            self.conn.execute("COMMIT")
+        with self.lock:
+            self.size -= sum(len(row[3]) for row in rows)
+            self.count -= len(rows)
+
+    def dead_letters(self) -> list:
+        with self.db_lock:
+            return self.conn.execute("SELECT exchange, routing_key, body, message_id FROM dead_letters "
+                                     "ORDER BY id").fetchall()
+
+    def wait(self, timeout: float):
+        self.appended.wait(timeout)
+        self.appended.clear()
+
+    def _commit_groups(self):
+        while True:
+            with self.lock:
+                group = self.group
+                self.group = None
+                if group is None:
+                    self.committing = False
+                    return
+            try:
+                with self.db_lock:
+                    self.conn.execute("BEGIN")
+                    self.conn.executemany("INSERT INTO outbox (exchange, routing_key, body, message_id, headers) "
+                                          "VALUES (?, ?, ?, ?, ?)", group.rows)
+                    self.conn.execute("COMMIT")
+            except sqlite3.Error as e:
+                with self.db_lock:
+                    if self.conn.in_transaction:
+                        self.conn.execute("ROLLBACK")
+                with self.lock:
+                    self.size -= sum(len(row[2]) for row in group.rows)
+                    self.count -= len(group.rows)
+                group.error = e
+            group.done.set()
+
+
+def get_outbox() -> Outbox | None:
+    if OUTBOX_PATH:
+        return Outbox(OUTBOX_PATH)
+    return None
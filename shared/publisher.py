@@ -1,34 +1,280 @@
+import random
+import threading
+
 import pika
 import time
+from pika.exceptions import AMQPError, NackError, UnroutableError
+
+from shared import tracing
+from shared.outbox import Outbox
+from shared.sharding import SHARDS, get_shard
 
 QUEUE_NAME = 'test'
+# Lanes keep the few operational messages out of the queues that hold the readings backlog
+TELEMETRY = 'telemetry'
+CONTROL = 'control'
+ALERTS = 'alerts'
+# Alerts are published to a topic exchange with the name of their rule as routing key, so anything else that
+# wants them binds its own queue. The alerts lane of the consumer gets all of them.
+ALERTS_EXCHANGE = 'sensor_alerts'
+# The readings of every stored batch are fanned out to the live feeds of the API processes
+LIVE = 'live'
+LIVE_EXCHANGE = 'sensor_readings'
+# Messages the consumer can't handle are rejected to this exchange and kept in its queue to be looked at
+DEAD_LETTER_EXCHANGE = 'sensor_dead_letters'
+DEAD_LETTERS = 'dead'
+# Seconds between heartbeats, a dead connection is noticed after about two of them
+HEARTBEAT = 30
+_PUBLISH_ATTEMPTS = 5
+_BACKOFF_BASE = 0.05
+_BACKOFF_MAX = 2.0
+# Messages the relay takes from the outbox and publishes in a single transaction before deleting them
+_RELAY_BATCH = 1000
+
+# Errors after which the connection can't be used anymore and has to be opened again
+CONNECTION_ERRORS = (AMQPError, OSError)
+# A message the broker refused (NackError) or couldn't route to a queue (UnroutableError). They are AMQPErrors
+# too, so they have to be caught before CONNECTION_ERRORS: sending the message again is likely to fail again.
+REFUSED_ERRORS = (NackError, UnroutableError)
+
+
+def get_parameters(host):
+    credentials = pika.PlainCredentials('guest', 'guest')
+    return pika.ConnectionParameters(host,
+                                     5672,
+                                     '/',
+                                     credentials,
+                                     heartbeat=HEARTBEAT,
+                                     blocked_connection_timeout=HEARTBEAT)
+
+
+def get_shard_queue(shard):
+    return f"{QUEUE_NAME}.{shard}"
 
-class Publisher:
 
-    channel = None
-    conn = None
+def get_lane_queue(lane):
+    return f"{QUEUE_NAME}.{lane}"
 
-    def __init__(self):
-        credentials = pika.PlainCredentials('guest', 'guest')
-        parameters = pika.ConnectionParameters('rabbitmq',
-                                       5672,
-                                       '/',
-                                       credentials)
+
+def declare_queues(channel):
+    # A single active consumer per queue keeps the readings of a sensor in order, also while consumers
+    # are being added or removed. The arguments of a queue can't change once declared: queues declared
+    # before the dead letter exchange existed have to be deleted, or given it with a policy.
+    channel.exchange_declare(exchange=DEAD_LETTER_EXCHANGE, exchange_type='fanout')
+    channel.queue_declare(queue=get_lane_queue(DEAD_LETTERS))
+    channel.queue_bind(queue=get_lane_queue(DEAD_LETTERS), exchange=DEAD_LETTER_EXCHANGE)
+    for shard in range(SHARDS):
+        channel.queue_declare(queue=get_shard_queue(shard), arguments={'x-single-active-consumer': True,
+                                                                      'x-dead-letter-exchange': DEAD_LETTER_EXCHANGE})
+    for lane in (CONTROL, ALERTS):
+        channel.queue_declare(queue=get_lane_queue(lane), arguments={'x-dead-letter-exchange': DEAD_LETTER_EXCHANGE})
+    channel.exchange_declare(exchange=ALERTS_EXCHANGE, exchange_type='topic')
+    channel.queue_bind(queue=get_lane_queue(ALERTS), exchange=ALERTS_EXCHANGE, routing_key='#')
+    channel.exchange_declare(exchange=LIVE_EXCHANGE, exchange_type='fanout')
+
+
+def backoff(attempt):
+    # Full jitter, so the workers that lost the broker at the same time don't come back at the same time
+    return random.uniform(0, min(_BACKOFF_MAX, _BACKOFF_BASE * 2 ** attempt))
+
+
+def connect(parameters, attempts):
+    for attempt in range(attempts):
         try:
-            self.conn = pika.BlockingConnection(parameters)
-        except Exception as e:
-            time.sleep(10)
-            self.conn = pika.BlockingConnection(parameters)
+            return pika.BlockingConnection(parameters)
+        except CONNECTION_ERRORS:
+            if attempt == attempts - 1:
+                raise
+            time.sleep(backoff(attempt))
+
 
-        self.channel = self.conn.channel()
-        self.channel.queue_declare(queue=QUEUE_NAME)
+class Publisher:
+    # pika connections can't be shared between threads, so every thread of the API threadpool publishes
+    # through its own connection and channel
 
+    def __init__(self, host='rabbitmq', outbox: Outbox | None = None):
+        # Nothing is opened here, the connection is made by the first publish of each thread
+        self.parameters = get_parameters(host)
+        self.local = threading.local()
+        self.connections = []
+        self.lock = threading.Lock()
+        # With an outbox, messages that can't be published right away are kept in it and a relay thread
+        # publishes them once the broker is back, instead of failing the request
+        self.outbox = outbox
+        self.relay = None
+        if outbox is not None and len(outbox):
+            self._start_relay()
 
-    
-    def publish(self, message):
-        self.channel.basic_publish(exchange='', routing_key=QUEUE_NAME, body=message.to_json())
-        print(" [x] Sent %r" % message)
+    def publish(self, message, lane=TELEMETRY):
+        body = message.to_json()
+        exchange = ''
+        if lane == TELEMETRY:
+            # All the readings of a sensor go through the same queue
+            routing_key = get_shard_queue(get_shard(getattr(message, 'sensor_id', 0)))
+        elif lane == ALERTS:
+            exchange = ALERTS_EXCHANGE
+            routing_key = message.alert
+        elif lane == LIVE:
+            exchange = LIVE_EXCHANGE
+            routing_key = ''
+        else:
+            routing_key = get_lane_queue(lane)
+        with tracing.span("publish", destination=routing_key or exchange):
+            # The consumer continues the trace of the request from the headers
+            properties = pika.BasicProperties(message_id=getattr(message, 'message_id', None),
+                                              headers=tracing.inject() or None)
+            if self.outbox is None:
+                self._publish_with_retries(exchange, routing_key, body, properties)
+            elif len(self.outbox):
+                # Messages wait behind the ones already in the outbox, so they keep their order
+                self._append_to_outbox(exchange, routing_key, body, properties)
+            else:
+                self._publish_or_append(exchange, routing_key, body, properties)
+        # Only the kind of message, a batch of readings is too long for the log
+        print(" [x] Sent %s to %s" % (type(message).__name__, routing_key or exchange))
     #     este publish lo llamare en los post del controllador, i lo que habia ahi lo eliminamos,el delete también lo podriamos enviar
-    
+
+    def _publish_or_append(self, exchange, routing_key, body, properties):
+        # No lock is held while the broker confirms, each thread waits on its own channel. The outbox orders what
+        # a thread sends: once one of its messages is in the outbox, the next ones find it there and follow it.
+        # Messages of different threads are published concurrently and have no order between them anyway.
+        try:
+            self._basic_publish(exchange, routing_key, body, properties)
+            return
+        except REFUSED_ERRORS:
+            # The relay declares the queues again and dead-letters the message if it's refused once more
+            self._reset()
+        except CONNECTION_ERRORS:
+            self._reset()
+        self._append_to_outbox(exchange, routing_key, body, properties)
+
+    def _publish_with_retries(self, exchange, routing_key, body, properties):
+        for attempt in range(_PUBLISH_ATTEMPTS):
+            try:
+                self._basic_publish(exchange, routing_key, body, properties)
+                return
+            except REFUSED_ERRORS:
+                # The queues are declared again by the next connection, a message refused after that is lost
+                self._reset()
+                if attempt:
+                    raise
+            except CONNECTION_ERRORS:
+                self._reset()
+                if attempt == _PUBLISH_ATTEMPTS - 1:
+                    raise
+                time.sleep(backoff(attempt))
+
+    def _append_to_outbox(self, exchange, routing_key, body, properties):
+        self.outbox.append(exchange, routing_key, body, properties.message_id, properties.headers)
+        if self.relay is None:
+            self._start_relay()
+
+    def _start_relay(self):
+        with self.lock:
+            if self.relay is None:
+                self.relay = threading.Thread(target=self._relay, name="outbox-relay", daemon=True)
+                self.relay.start()
+
+    def _relay(self):
+        # Publishes the outbox in batches through a connection of its own, oldest first. A blocking channel waits
+        # for the confirm of every message, so the relay commits each batch in a transaction instead: the broker
+        # answers the commit once the whole batch is routed. Messages it couldn't route are sent once more through
+        # a new connection, which declares the queues again, and then go to the dead letters of the outbox.
+        attempt = 0
+        while True:
+            rows = self.outbox.peek(_RELAY_BATCH)
+            if not rows:
+                self.outbox.wait(timeout=1.0)
+                continue
+            try:
+                returned = self._relay_batch(rows)
+                if returned:
+                    self._reset()
+                    returned = self._relay_batch([row for row in rows if row[0] in returned])
+            except CONNECTION_ERRORS as e:
+                self._reset()
+                print("Could not relay %d messages: %s" % (len(rows), e))
+                time.sleep(backoff(attempt))
+                attempt += 1
+                continue
+            attempt = 0
+            refused = [row for row in rows if row[0] in returned]
+            self.outbox.remove(rows, refused)
+            if refused:
+                print("Moved %d messages nobody could receive to the dead letters of the outbox" % len(refused))
+            print(" [x] Relayed %d messages, %d left in the outbox" % (len(rows) - len(refused), len(self.outbox)))
+
+    def _relay_batch(self, rows) -> set:
+        # The ids of the rows the broker returned. The id of each row goes with it as correlation id.
+        channel = self._get_channel(transactional=True)
+        self.local.returned = set()
+        for id, exchange, routing_key, body, message_id, headers in rows:
+            channel.basic_publish(exchange=exchange, routing_key=routing_key, body=body,
+                                  properties=pika.BasicProperties(message_id=message_id, headers=headers,
+                                                                  correlation_id=str(id)),
+                                  mandatory=exchange != LIVE_EXCHANGE)
+        channel.tx_commit()
+        # The broker sends the returned messages before answering the commit, this hands them to _on_returned
+        self.local.conn.process_data_events(time_limit=0)
+        return self.local.returned
+
+    def _on_returned(self, channel, method, properties, body):
+        self.local.returned.add(int(properties.correlation_id))
+
+    def _basic_publish(self, exchange, routing_key, body, properties):
+        # Returns once the broker has confirmed the message. The live feeds are the only destination that may
+        # have nobody listening, a message for any other that reaches no queue is refused.
+        self._get_channel().basic_publish(exchange=exchange, routing_key=routing_key, body=body,
+                                          properties=properties, mandatory=exchange != LIVE_EXCHANGE)
+
+    def _get_channel(self, transactional=False):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None or conn.is_closed:
+            if conn is not None:
+                # Closed by the broker or for missed heartbeats, it isn't kept for close()
+                self._reset()
+            conn = self._connect()
+            self.local.conn = conn
+            self.local.channel = conn.channel()
+            if transactional:
+                self.local.channel.tx_select()
+                self.local.channel.add_on_return_callback(self._on_returned)
+            else:
+                self.local.channel.confirm_delivery()
+            declare_queues(self.local.channel)
+            with self.lock:
+                self.connections.append(conn)
+        else:
+            # Answers the heartbeats the broker sent while the connection was idle
+            conn.process_data_events(time_limit=0)
+        return self.local.channel
+
+    def _connect(self):
+        return pika.BlockingConnection(self.parameters)
+
+    def _reset(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is not None:
+            _close_quietly(conn)
+            with self.lock:
+                if conn in self.connections:
+                    self.connections.remove(conn)
+        self.local.conn = None
+        self.local.channel = None
+
     def close(self):
-        self.conn.close()
\ No newline at end of file
+        # Only safe once no other thread is publishing
+        with self.lock:
+            connections = self.connections
+            self.connections = []
+        for conn in connections:
+            _close_quietly(conn)
+        self.local = threading.local()
+
+
+def _close_quietly(conn):
+    if conn.is_open:
+        try:
+            conn.close()
+        except CONNECTION_ERRORS:
+            pass
@@ -1,12 +1,21 @@
 import redis
 
+from shared.timing import timed
 
+# Errors of a lost or unreachable server, the client connects again by itself on the next command
+ERRORS = (redis.ConnectionError, redis.TimeoutError)
+# Deletes the key only while it still holds the value, the get and the del run as one step on the server
+_DELETE_IF_EQUAL = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('del', KEYS[1]) else return 0 end"
+
+
+@timed("redis")
 class RedisClient:
     def __init__(self, host='localhost', port=6379, db=0):
         self._host = host
         self._port = port
         self._db = db
         self._client = redis.Redis(host=self._host, port=self._port, db=self._db)
+        self._delete_if_equal = self._client.register_script(_DELETE_IF_EQUAL)
 
     def close(self):
         self._client.close()
@@ -17,12 +26,27 @@ class RedisClient:
     def get(self, key):
         return self._client.get(key)
 
-    def set(self, key, value):
-        return self._client.set(key, value)
+    def set(self, key, value, ex=None, nx=False):
+        return self._client.set(key, value, ex=ex, nx=nx)
+
+    def incr(self, key):
+        return self._client.incr(key)
+
+    def mget(self, keys):
+        return self._client.mget(keys)
+
+    def set_many(self, mapping, ex=None):
+        pipeline = self._client.pipeline(transaction=False)
+        for key, value in mapping.items():
+            pipeline.set(key, value, ex=ex)
+        return pipeline.execute()
 
     def delete(self, key):
         return self._client.delete(key)
 
+    def delete_if_equal(self, key, value):
+        return self._delete_if_equal(keys=[key], args=[value])
+
     def keys(self, pattern):
         return self._client.keys(pattern)
 
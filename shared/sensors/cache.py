@@ -0,0 +1,62 @@
+import time
+import uuid
+from typing import Callable, Iterable
+
+from pydantic import BaseModel
+
+from shared.redis_client import RedisClient
+
+TEMPERATURE_VALUES = 'temperature_values'
+QUANTITY_BY_TYPE = 'quantity_by_type'
+LOW_BATTERY = 'low_battery'
+ALL = (TEMPERATURE_VALUES, QUANTITY_BY_TYPE, LOW_BATTERY)
+
+# Seconds a cached response is served even if nobody bumps its version
+CACHE_TTL = 10
+# A value that takes longer than it is cached to compute isn't worth waiting for: past the TTL of the lock the
+# holder is taken as gone, and a waiter reads the stores itself instead of holding its thread any longer
+_LOCK_TTL = CACHE_TTL
+_MAX_WAIT = _LOCK_TTL
+_WAIT_STEP = 0.05
+
+
+def get_or_compute(redis: RedisClient, name: str, compute: Callable[[], BaseModel]) -> bytes | str:
+    key = _get_key(redis, name)
+    cached = redis.get(key)
+    if cached is not None:
+        return cached
+    lock = key + ':lock'
+    # Only the client that takes the lock recomputes, the others wait for its result. The lock holds a token
+    # of its own, so a holder whose lock expired can't release the lock another client took since.
+    token = uuid.uuid4().hex
+    if redis.set(lock, token, ex=_LOCK_TTL, nx=True):
+        try:
+            value = compute().json()
+            redis.set(key, value, ex=CACHE_TTL)
+            return value
+        finally:
+            redis.delete_if_equal(lock, token)
+    deadline = time.monotonic() + _MAX_WAIT
+    while time.monotonic() < deadline:
+        time.sleep(_WAIT_STEP)
+        cached = redis.get(key)
+        if cached is not None:
+            return cached
+        if redis.get(lock) is None:
+            break
+    return compute().json()
+
+
+def bump(redis: RedisClient, names: Iterable[str]):
+    # A new version makes every client miss, the old entries just expire
+    for name in names:
+        redis.incr(_version_key(name))
+
+
+def _get_key(redis: RedisClient, name: str) -> str:
+    version = redis.get(_version_key(name))
+    return f"cache:{name}:{int(version or 0)}"
+
+
+def _version_key(name: str) -> str:
+    return f"cache:{name}:version"
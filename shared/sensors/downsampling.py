@@ -0,0 +1,30 @@
+import numpy as np
+
+
+def lttb(x: np.ndarray, y: np.ndarray, max_points: int) -> np.ndarray:
+    # Indices of the max_points points kept by Largest-Triangle-Three-Buckets. The first and last points are
+    # kept, the rest are split in max_points - 2 buckets and from each one the point that makes the largest
+    # triangle with the point kept before it and the average of the next bucket is kept.
+    n = len(x)
+    if max_points >= n or max_points < 3:
+        return np.arange(n)
+    edges = np.linspace(1, n - 1, max_points - 1).astype(np.int64)
+    starts, ends = edges[:-1], edges[1:]
+    # Averages of every bucket from cumulative sums, the one after the last bucket is the last point
+    sums_x = np.concatenate(([0.0], np.cumsum(x)))
+    sums_y = np.concatenate(([0.0], np.cumsum(np.nan_to_num(y))))
+    counts = ends - starts
+    next_x = np.append(((sums_x[ends] - sums_x[starts]) / counts)[1:], x[-1])
+    next_y = np.append(((sums_y[ends] - sums_y[starts]) / counts)[1:], y[-1])
+    selected = np.empty(max_points, dtype=np.int64)
+    selected[0] = 0
+    selected[-1] = n - 1
+    kept = 0
+    # Each bucket depends on the point kept in the one before, only the points inside a bucket are vectorized
+    for bucket in range(max_points - 2):
+        start, end = starts[bucket], ends[bucket]
+        areas = np.abs((x[kept] - next_x[bucket]) * (y[start:end] - y[kept])
+                       - (x[kept] - x[start:end]) * (next_y[bucket] - y[kept]))
+        kept = start + int(np.argmax(np.nan_to_num(areas, nan=-1.0)))
+        selected[bucket + 1] = kept
+    return selected
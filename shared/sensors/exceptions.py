@@ -1,4 +1,10 @@
 class NotCompatible(Exception):
     def __init__(self, message: str):
         self.message = message
-        super().__init__(self.message)
\ No newline at end of file
+        super().__init__(self.message)
+
+
+class InvalidParameter(Exception):
+    def __init__(self, message: str):
+        self.message = message
+        super().__init__(self.message)
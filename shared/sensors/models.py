@@ -15,7 +15,7 @@ class Sensor(Base):
 class SensorData(Base):
     __tablename__ = "sensor_data"
     time = Column(DateTime, primary_key=True, index=True)
-    name = Column(String, index=True)
+    name = Column(String, primary_key=True, index=True)
     temperature = Column(Float, nullable=True)
     humidity = Column(Float, nullable=True)
     velocity = Column(Float, nullable=True)
@@ -0,0 +1,54 @@
+from typing import Dict, Iterable
+
+from pymongo.errors import DuplicateKeyError
+
+from shared.mongodb_client import MongoDBClient
+from shared.sensors import schemas
+
+# One document per sensor with the id and joined_at of Postgres and the fields of the sensors collection, so a
+# complete sensor is read in a single call. The consumer keeps it current from the created and deleted events,
+# and backfill.rebuild_sensor_records builds it again from Postgres and Mongo.
+SENSOR_RECORDS = 'sensor_records'
+_PROJECTION = {'_id': 0, 'joined_at': 0}
+
+
+def ensure_indexes(mongo_client: MongoDBClient, collection: str = SENSOR_RECORDS):
+    records = mongo_client.getCollection(collection)
+    records.create_index('id', unique=True)
+    records.create_index('name', unique=True)
+
+
+def to_record(sensor: schemas.Sensor, joined_at: str | None) -> dict:
+    record = sensor.dict()
+    record['joined_at'] = joined_at
+    return record
+
+
+def upsert(mongo_client: MongoDBClient, record: dict):
+    records = mongo_client.getCollection(SENSOR_RECORDS)
+    try:
+        records.replace_one({'id': record['id']}, record, upsert=True)
+    except DuplicateKeyError:
+        # The name belonged to a sensor that was deleted and whose record is still here, its deleted event may
+        # not have been processed yet
+        records.delete_one({'name': record['name'], 'id': {'$ne': record['id']}})
+        records.replace_one({'id': record['id']}, record, upsert=True)
+
+
+def delete(mongo_client: MongoDBClient, sensor_id: int):
+    mongo_client.getCollection(SENSOR_RECORDS).delete_one({'id': sensor_id})
+
+
+def find_by_ids(mongo_client: MongoDBClient, sensor_ids: Iterable[int]) -> Dict[int, schemas.Sensor]:
+    documents = mongo_client.getCollection(SENSOR_RECORDS).find({'id': {'$in': list(sensor_ids)}}, _PROJECTION)
+    return {document['id']: _to_sensor(document) for document in documents}
+
+
+def find_by_names(mongo_client: MongoDBClient, names: Iterable[str]) -> Dict[str, schemas.Sensor]:
+    documents = mongo_client.getCollection(SENSOR_RECORDS).find({'name': {'$in': list(names)}}, _PROJECTION)
+    return {document['name']: _to_sensor(document) for document in documents}
+
+
+def _to_sensor(document: dict) -> schemas.Sensor:
+    # Written by us from validated sensors
+    return schemas.Sensor.construct(**document)
@@ -1,12 +1,16 @@
 import json
-from datetime import datetime
-from typing import List, Optional
+import re
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import Iterator, List, Optional
 
+import numpy as np
+from sqlalchemy import delete, insert
 from sqlalchemy.orm import Session
 
 from shared.cassandra_client import CassandraClient
 
-from .exceptions import NotCompatible
+from .exceptions import InvalidParameter, NotCompatible
 from .schemas import SensorDataSearch, SensorSet, TemperatureValues, SensorsSetTemperatureItem, SensorsSetQuantityItem, \
     SensorsSetLowBatteryItem
 from shared.elasticsearch_client import ElasticsearchClient
@@ -16,21 +20,112 @@ from sqlalchemy.orm import Session
 from typing import List, Optional
 from datetime import datetime
 
+from shared import tracing
 from shared.mongodb_client import MongoDBClient
+from shared.publisher import CONTROL, Publisher
 from shared.redis_client import RedisClient
-from shared.sensors import models, schemas
+from shared.sensors import cache, downsampling, models, records, rollups, schemas
 from shared.timescale import Timescale
 _SENSORS = 'sensors'
+# Every read of the sensors collection goes through one of these
+SENSOR_INDEXES = [
+    ('name', {'unique': True}),
+    ('type', {}),
+    # The box of get_sensors_near is a range on both
+    ([('latitude', 1), ('longitude', 1)], {}),
+]
+# Only the fields of a sensor are brought back, not the _id
+_SENSOR_PROJECTION = dict({'_id': 0}, **{name: 1 for name in schemas.SensorCreate.__fields__})
+SENSOR_CREATED = 'created'
+SENSOR_DELETED = 'deleted'
+LOW_BATTERY_LEVEL = 0.2
+_SENSOR_DATA_COLUMNS = ('time', 'name', 'temperature', 'humidity', 'velocity', 'battery_level', 'last_seen')
+
+_INSERT_TEMPERATURE_DATA = "INSERT INTO temperature_data_by_day (name, day_bucket, time, temperature) VALUES (?, ?, ?, ?)"
+_INSERT_TEMPERATURE_DAY = "INSERT INTO temperature_days (name, day_bucket) VALUES (?, ?)"
+_SELECT_TEMPERATURE_DAYS = "SELECT day_bucket FROM temperature_days WHERE name = ?"
+_SELECT_TEMPERATURE_STATS = "SELECT MAX(temperature), MIN(temperature), SUM(temperature), COUNT(temperature) " \
+                            "FROM temperature_data_by_day WHERE name = ? AND day_bucket = ?"
+_SELECT_TEMPERATURE_RANGE = "SELECT time, temperature FROM temperature_data_by_day " \
+                            "WHERE name = ? AND day_bucket = ? AND time >= ? AND time <= ?"
+_INSERT_TYPE_SENSOR = "INSERT INTO type_sensor (sensor_type, id) VALUES (?, ?)"
+_INSERT_BATTERY_LEVEL = "INSERT INTO low_battery (battery_level, name) VALUES (?, ?)"
+_ROLLUP_COLUMNS = ('bucket', 'name', 'count') + tuple(f"{field}_{stat}" for field in rollups.FIELDS
+                                                      for stat in ('min', 'max', 'sum', 'last')) + ('last_seen',)
+# A window written again adds the new readings to the ones it already had. Only readings newer than the last one
+# a window has are added, so a redelivered batch or a chunk imported twice isn't counted twice. The windows are
+# locked until the batch commits.
+_SELECT_ROLLUP_LAST_SEEN = """
+    SELECT sensor_data_rollup.name, sensor_data_rollup.bucket, sensor_data_rollup.last_seen
+    FROM sensor_data_rollup
+    JOIN (VALUES %s) AS windows (name, bucket)
+        ON sensor_data_rollup.name = windows.name AND sensor_data_rollup.bucket = windows.bucket
+    FOR UPDATE OF sensor_data_rollup
+"""
+_MERGE_ROLLUP_FIELD = """
+        {field}_min = LEAST(sensor_data_rollup.{field}_min, EXCLUDED.{field}_min),
+        {field}_max = GREATEST(sensor_data_rollup.{field}_max, EXCLUDED.{field}_max),
+        {field}_sum = sensor_data_rollup.{field}_sum + EXCLUDED.{field}_sum,
+        {field}_last = CASE WHEN EXCLUDED.last_seen >= sensor_data_rollup.last_seen
+                            THEN EXCLUDED.{field}_last ELSE sensor_data_rollup.{field}_last END,"""
+_UPSERT_ROLLUP = f"""
+    INSERT INTO sensor_data_rollup ({', '.join(_ROLLUP_COLUMNS)})
+    VALUES %s
+    ON CONFLICT (name, bucket) DO UPDATE SET
+        count = sensor_data_rollup.count + EXCLUDED.count,{''.join(_MERGE_ROLLUP_FIELD.format(field=field)
+                                                                   for field in rollups.FIELDS)}
+        last_seen = GREATEST(sensor_data_rollup.last_seen, EXCLUDED.last_seen)
+"""
+
+# Buckets of any size, like "15 minutes" or "5m", besides hour, day, week, month and year
+_INTERVAL = re.compile(r"^\s*(\d+)\s*([a-z]+)\s*$")
+_INTERVAL_UNITS = {
+    's': 'seconds', 'sec': 'seconds', 'second': 'seconds', 'seconds': 'seconds',
+    'm': 'minutes', 'min': 'minutes', 'minute': 'minutes', 'minutes': 'minutes',
+    'h': 'hours', 'hour': 'hours', 'hours': 'hours',
+    'd': 'days', 'day': 'days', 'days': 'days',
+    'w': 'weeks', 'week': 'weeks', 'weeks': 'weeks',
+    'mon': 'months', 'month': 'months', 'months': 'months',
+    'y': 'years', 'year': 'years', 'years': 'years',
+}
+# Days of temperatures one read of a sensor may cover, each day is a partition
+_MAX_TEMPERATURE_DAYS = 366
+# Without a bucket, a downsampled range is first bucketed in this many buckets per point asked for, so only a
+# few rows per point are read however long the range is
+_BUCKETS_PER_POINT = 4
+
 
 class DataCommand():
-    def __init__(self, from_time, to_time, bucket):
+    def __init__(self, from_time, to_time, bucket, after=None, limit=None, max_points=None):
         if not from_time or not to_time:
             raise ValueError("from_time and to_time must be provided")
+        # Parsed here, so a wrong time is refused before the query runs
+        from_time = _parse_time(from_time, 'from')
+        to_time = _parse_time(to_time, 'to')
+        after = _parse_time(after, 'after') if after else None
+        if max_points is not None and max_points < 3:
+            raise InvalidParameter("max_points must be at least 3")
         if not bucket:
-            bucket = 'day'
+            bucket = _get_bucket_for_points(from_time, to_time, max_points) if max_points else 'day'
+        _get_interval(bucket)
         self.from_time = from_time
         self.to_time = to_time
         self.bucket = bucket
+        # Keyset pagination: only buckets later than after, at most limit of them. Once read, next_after is the
+        # after of the next page, None when this page was the last one.
+        self.after = after
+        self.limit = limit
+        self.next_after = None
+        # The buckets are downsampled to this many points with LTTB
+        self.max_points = max_points
+
+
+def _parse_time(value: str, parameter: str) -> datetime:
+    # The tables hold UTC times without a time zone
+    try:
+        return _to_datetime(value).replace(tzinfo=None)
+    except ValueError:
+        raise InvalidParameter(f"{parameter} must be a date and time in ISO 8601 format")
 
 
 def get_sensor(db: Session, sensor_id: int) -> Optional[models.Sensor]:
@@ -43,11 +138,39 @@ def get_sensor(db: Session, sensor_id: int) -> Optional[models.Sensor]:
 def get_sensor_by_name(db: Session, name: str) -> Optional[models.Sensor]:
     return db.query(models.Sensor).filter(models.Sensor.name == name).first()
 
+def get_sensor_schema_by_name(db: Session, mongo_client: MongoDBClient, sensor_name: str) -> Optional[schemas.Sensor]:
+    if get_sensor_by_name(db, sensor_name) is None:
+        return None
+    return _get_sensor_from_sensor_name(db=db, mongo_client=mongo_client, sensor_name=sensor_name)
+
+def get_sensor_schema(db: Session, mongo_client: MongoDBClient, sensor_id: int) -> schemas.Sensor:
+    sensor = records.find_by_ids(mongo_client, [sensor_id]).get(sensor_id)
+    if sensor is None:
+        return _get_sensor_from_sensor_id(db=db, mongo_client=mongo_client, sensor_id=sensor_id)
+    return sensor
+
+
+def get_sensors_after(db: Session, after_id: int, limit: int) -> List[models.Sensor]:
+    return db.query(models.Sensor).filter(models.Sensor.id > after_id).order_by(models.Sensor.id).limit(limit).all()
+
+
+def ensure_indexes(mongo_client: MongoDBClient):
+    mongo_client.create_indexes(_SENSORS, SENSOR_INDEXES)
+    records.ensure_indexes(mongo_client)
+
+
+def get_sensor_records(mongo_client: MongoDBClient, db_sensors: List[models.Sensor]) -> List[dict]:
+    # The read model of the given sensors, joined from Postgres and the sensors collection
+    sensors = _join_sensors(mongo_client=mongo_client, db_sensors=db_sensors)
+    return [records.to_record(sensors[db_sensor.name], db_sensor.joined_at.isoformat())
+            for db_sensor in db_sensors if db_sensor.name in sensors]
+
+
 def get_sensors(db: Session, skip: int = 0, limit: int = 100) -> List[models.Sensor]:
     return db.query(models.Sensor).offset(skip).limit(limit).all()
 
 def create_sensor(mongo_client: MongoDBClient, db: Session, sensor: schemas.SensorCreate,
-                  es: ElasticsearchClient) -> schemas.Sensor:
+                  es: ElasticsearchClient, publisher: Publisher) -> schemas.Sensor:
     name = sensor.name
     # Create in mySQL
     db_sensor = _add_sensor_to_postgres(db, sensor)
@@ -57,58 +180,429 @@ def create_sensor(mongo_client: MongoDBClient, db: Session, sensor: schemas.Sens
     # Create in ElasticSearch
     es_data = SensorDataSearch(name=name, type=sensor.type, description=sensor.description)
     es.index_document(_SENSORS, es_data.dict())
-    return _get_sensor_from_db_sensor_and_sensor_create(db_sensor=db_sensor, sensor_create=sensor)
+    created = _get_sensor_from_db_sensor_and_sensor_create(db_sensor=db_sensor, sensor_create=sensor)
+    publisher.publish(schemas.SensorEvent(event=SENSOR_CREATED, sensor_id=db_sensor.id, name=name, sensor=created,
+                                          joined_at=db_sensor.joined_at.isoformat()), lane=CONTROL)
+    return created
+
+
+def create_sensors(mongo_client: MongoDBClient, db: Session, sensors: List[schemas.SensorCreate],
+                   es: ElasticsearchClient, publisher: Publisher) -> List[schemas.SensorBatchResult]:
+    # Like create_sensor for many sensors at once: one query for the names already taken, one insert for
+    # Postgres, one for Mongo and one bulk request to ElasticSearch, instead of four round trips per sensor
+    names = [sensor.name for sensor in sensors]
+    taken = {name for name, in db.query(models.Sensor.name).filter(models.Sensor.name.in_(set(names)))}
+    new_sensors = {}
+    for sensor in sensors:
+        if sensor.name not in taken and sensor.name not in new_sensors:
+            new_sensors[sensor.name] = sensor
+    created = {}
+    not_indexed = set()
+    if new_sensors:
+        date = datetime.now()
+        inserted = db.execute(insert(models.Sensor).returning(models.Sensor.id, models.Sensor.name),
+                              [{'name': name, 'joined_at': date} for name in new_sensors])
+        ids = {name: sensor_id for sensor_id, name in inserted}
+        db.commit()
+        collection = mongo_client.getCollection(_SENSORS)
+        collection.insert_many([sensor.dict() for sensor in new_sensors.values()])
+        errors = es.bulk_index(_SENSORS, [SensorDataSearch(name=sensor.name, type=sensor.type,
+                                                           description=sensor.description).dict()
+                                          for sensor in new_sensors.values()])
+        # The sensors that couldn't be indexed are taken out again, so sending them again registers them
+        not_indexed = {name for name, error in zip(new_sensors, errors) if error is not None}
+        if not_indexed:
+            print("Could not index %d sensors: %s" % (len(not_indexed), next(error for error in errors if error)))
+            db.execute(delete(models.Sensor).where(models.Sensor.name.in_(not_indexed)))
+            db.commit()
+            collection.delete_many({'name': {'$in': list(not_indexed)}})
+        for name, sensor in new_sensors.items():
+            if name not in not_indexed:
+                created[name] = _get_sensor_from_db_sensor_and_sensor_create(
+                    db_sensor=models.Sensor(id=ids[name], name=name, joined_at=date), sensor_create=sensor)
+        # One event for the whole batch
+        if created:
+            publisher.publish(schemas.SensorEventBatch(events=[
+                schemas.SensorEvent(event=SENSOR_CREATED, sensor_id=sensor.id, name=name, sensor=sensor,
+                                    joined_at=date.isoformat()) for name, sensor in created.items()]), lane=CONTROL)
+    results = []
+    for sensor in sensors:
+        if sensor.name in taken:
+            results.append(schemas.SensorBatchResult(name=sensor.name, created=False,
+                                                     detail="Sensor with same name already registered"))
+        elif sensor.name in created:
+            results.append(schemas.SensorBatchResult(name=sensor.name, created=True, sensor=created.pop(sensor.name)))
+        elif sensor.name in not_indexed:
+            not_indexed.discard(sensor.name)
+            results.append(schemas.SensorBatchResult(name=sensor.name, created=False,
+                                                     detail="Sensor could not be indexed for search, try again"))
+        else:
+            results.append(schemas.SensorBatchResult(name=sensor.name, created=False,
+                                                     detail="Sensor with same name earlier in the batch"))
+    return results
 
 
-def record_data(timescale: Timescale, redis: RedisClient, mongo_client: MongoDBClient, db: Session,
-                sensor_id: int, cassandra: CassandraClient,
+def record_data(publisher: Publisher, mongo_client: MongoDBClient, db: Session, sensor_id: int,
                 data: schemas.SensorDataTemperature | schemas.SensorDataVelocity) -> schemas.Sensor:
-    redis.set(sensor_id, data.json())
     sensor = _from_id_and_data_to_sensor(
         sensor=_get_sensor_from_sensor_id(mongo_client=mongo_client, db=db, sensor_id=sensor_id),
         data=data)
+    # The id and the time are fixed here so a redelivered message writes exactly the same rows again
+    message = schemas.SensorDataMessage(message_id=str(uuid.uuid4()), sensor_id=sensor_id, name=sensor.name,
+                                        type=sensor.type, time=datetime.utcnow().isoformat(), data=data)
+    publisher.publish(message)
+    return sensor
+
+
+def store_data(timescale: Timescale, redis: RedisClient, cassandra: CassandraClient,
+               messages: List[schemas.SensorDataMessage]):
+    with tracing.span("cassandra write", readings=len(messages)):
+        store_in_cassandra(cassandra=cassandra, messages=messages)
+    with tracing.span("timescale write", readings=len(messages)):
+        store_in_timescale(timescale=timescale, messages=messages)
+    with tracing.span("redis write"):
+        store_latest_values(redis=redis, messages=messages)
 
+
+def store_in_timescale(timescale: Timescale, messages: List[schemas.SensorDataMessage]):
     query = """
-            INSERT INTO sensor_data (time,name, temperature, humidity, velocity, battery_level, last_seen) 
-            VALUES (%s,%s, %s, %s, %s, %s, %s)
+            INSERT INTO sensor_data (time, name, temperature, humidity, velocity, battery_level, last_seen)
+            VALUES %s
+            ON CONFLICT (name, time) DO UPDATE SET
+                temperature = EXCLUDED.temperature,
+                humidity = EXCLUDED.humidity,
+                velocity = EXCLUDED.velocity,
+                battery_level = EXCLUDED.battery_level,
+                last_seen = EXCLUDED.last_seen
         """
-    time = datetime.utcnow().isoformat()
-    if sensor.type == 'Temperatura':
-        values = (time, sensor.name, data.temperature, data.humidity, None, data.battery_level, data.last_seen)
-        _insert_temperature_data(cassandra=cassandra, time=time, name=sensor.name, temperature=data.temperature)
-    elif sensor.type == 'Velocitat':
-        values = (time, sensor.name, None, None, data.velocity, data.battery_level, data.last_seen)
+    rows = {}
+    for message in messages:
+        if rollups.keeps_raw(message.type):
+            rows[(message.name, message.time)] = _get_sensor_data_row(message)
+    if rows:
+        timescale.execute_values(query, list(rows.values()))
+    with tracing.span("rollup write"):
+        _store_rollups(timescale=timescale, messages=messages)
+
+
+def import_data(timescale: Timescale, cassandra: CassandraClient, messages: List[schemas.SensorDataMessage]):
+    # Bulk path for historical data: one COPY per chunk instead of an INSERT per reading, no Redis
+    timescale.copy_rows("sensor_data", _SENSOR_DATA_COLUMNS,
+                        [_get_sensor_data_row(message) for message in messages if rollups.keeps_raw(message.type)])
+    store_in_cassandra(cassandra=cassandra, messages=messages)
+    _store_rollups(timescale=timescale, messages=messages)
+
+
+def _store_rollups(timescale: Timescale, messages: List[schemas.SensorDataMessage]):
+    # Each window of the batch adds its readings to the row of that window, so a sensor that reports several
+    # times a second writes one row per window instead of one per reading
+    windowed = {message.message_id: message for message in messages if rollups.get_window(message.type)}
+    if not windowed:
+        return
+    readings = [(message.type, message.name, message.data, _last_seen(message.data))
+                for message in windowed.values()]
+    buckets = {(name, rollups.get_bucket(sensor_type, last_seen)) for sensor_type, name, _, last_seen in readings}
+    # The readings of a sensor arrive in order through its shard queue, so a reading that isn't newer than the last
+    # one of its window was already added to it. Only the rollup rows are written, one per window and batch.
+    applied = {(name, bucket): last_seen
+               for name, bucket, last_seen in timescale.fetch_values(_SELECT_ROLLUP_LAST_SEEN, list(buckets))}
+    new = []
+    for sensor_type, name, data, last_seen in readings:
+        window_last_seen = applied.get((name, rollups.get_bucket(sensor_type, last_seen)), datetime.min)
+        if last_seen.replace(tzinfo=None) > window_last_seen:
+            new.append((sensor_type, name, data, last_seen))
+    rows = rollups.aggregate(new)
+    if rows:
+        timescale.execute_values(_UPSERT_ROLLUP, rows)
+    else:
+        timescale.commit()
+
+
+def delete_expired_data(timescale: Timescale, retention: str):
+    # Only the raw readings of the types with a window, the others have nothing else left
+    columns = rollups.get_windowed_columns()
+    if not columns:
+        return
+    condition = " OR ".join(f"{column} IS NOT NULL" for column in columns)
+    timescale.execute(f"DELETE FROM sensor_data WHERE ({condition}) "
+                      "AND last_seen < (NOW() AT TIME ZONE 'UTC') - %s::interval", (retention,))
+
+
+def _get_sensor_data_row(message: schemas.SensorDataMessage) -> tuple:
+    data = message.data
+    if message.type == 'Temperatura':
+        return (message.time, message.name, data.temperature, data.humidity, None, data.battery_level,
+                data.last_seen)
+    elif message.type == 'Velocitat':
+        return (message.time, message.name, None, None, data.velocity, data.battery_level, data.last_seen)
     else:
         raise TypeError
-    _insert_type_sensor(cassandra=cassandra, sensor_id=sensor_id, sensor_type=sensor.type)
-    _insert_battery_level(cassandra=cassandra, name=sensor.name, battery_level=data.battery_level)
-    timescale.execute(query, values)
-    return sensor
 
-def get_data(timescale: Timescale, mongo_client: MongoDBClient, db: Session, sensor_id: int, dataCommand: DataCommand):
-    view = _getView(dataCommand.bucket)
+
+def store_in_cassandra(cassandra: CassandraClient, messages: List[schemas.SensorDataMessage]):
+    # All the writes of the batch are sent together instead of waiting for each one
+    temperatures = []
+    sensor_ids_by_type = {}
+    battery_levels = set()
+    for message in messages:
+        if message.type == 'Temperatura':
+            temperatures.append((message.name, _to_datetime(message.time), message.data.temperature))
+        sensor_ids_by_type.setdefault(message.type, set()).add(message.sensor_id)
+        battery_levels.add((message.data.battery_level, message.name))
+    statements = _get_temperature_statements(temperatures)
+    for sensor_type, sensor_ids in sensor_ids_by_type.items():
+        # Every row of a type goes to the same partition, so an unlogged batch is a single write
+        rows = [(sensor_type, sensor_id) for sensor_id in sensor_ids]
+        statements.extend((batch, None) for batch in cassandra.unlogged_batches(_INSERT_TYPE_SENSOR, rows))
+    statements.extend((_INSERT_BATTERY_LEVEL, values) for values in battery_levels)
+    if statements:
+        cassandra.execute_concurrent(statements)
+
+
+def import_temperature_data(cassandra: CassandraClient, rows: List[tuple]):
+    # rows are (name, time, temperature) tuples
+    statements = _get_temperature_statements(rows)
+    if statements:
+        cassandra.execute_concurrent(statements)
+
+
+def get_temperature_data(cassandra: CassandraClient, name: str, from_time: datetime,
+                         to_time: datetime) -> List[tuple]:
+    # Reads only the partitions of the days in the range, newest first
+    from_time = _as_utc(from_time)
+    to_time = _as_utc(to_time)
+    day = to_time.date()
+    days = []
+    while day >= from_time.date():
+        days.append(day)
+        day -= timedelta(days=1)
+    results = cassandra.execute_concurrent(
+        [(_SELECT_TEMPERATURE_RANGE, (name, day, from_time, to_time)) for day in days])
+    return [(row[0], row[1]) for success, result in results for row in result]
+
+
+def get_sensor_temperatures(db: Session, mongo_client: MongoDBClient, cassandra: CassandraClient, sensor_id: int,
+                            from_time: str | None, to_time: str | None) -> List[dict]:
+    # The temperatures of a sensor between from and to, newest first
+    if not from_time or not to_time:
+        raise InvalidParameter("from and to must be provided")
+    from_time = _parse_time(from_time, 'from')
+    to_time = _parse_time(to_time, 'to')
+    if (to_time - from_time).days >= _MAX_TEMPERATURE_DAYS:
+        raise InvalidParameter(f"from and to can be at most {_MAX_TEMPERATURE_DAYS} days apart")
     sensor = _get_sensor_from_sensor_id(db=db, mongo_client=mongo_client, sensor_id=sensor_id)
-    if sensor.type == 'Temperatura':
-        query = f"SELECT time, temperature, humidity, battery_level, last_seen  FROM sensor_data WHERE name = {sensor.name} AND bucket >= '{dataCommand.from_time}' AND bucket <= '{dataCommand.to_time}'"
-    elif sensor.type == 'Velocitat':
-        query = f"SELECT time, velocity battery_level, last_seen  FROM sensor_data WHERE name = {sensor.name} AND bucket >= '{dataCommand.from_time}' AND bucket <= '{dataCommand.to_time}'"
+    if sensor.type != 'Temperatura':
+        raise NotCompatible("Conflict - The sensor with the specific id is not of type temperature")
+    return [{'time': _get_data_value(time), 'temperature': temperature}
+            for time, temperature in get_temperature_data(cassandra=cassandra, name=sensor.name, from_time=from_time,
+                                                          to_time=to_time)]
+
+
+def _get_temperature_statements(rows: List[tuple]) -> List[tuple]:
+    statements = []
+    days = set()
+    for name, time, temperature in rows:
+        day_bucket = _as_utc(time).date()
+        statements.append((_INSERT_TEMPERATURE_DATA, (name, day_bucket, time, temperature)))
+        days.add((name, day_bucket))
+    statements.extend((_INSERT_TEMPERATURE_DAY, values) for values in days)
+    return statements
+
+
+def _get_temperature_stats(cassandra: CassandraClient, name: str) -> Optional[tuple]:
+    days = [row[0] for row in cassandra.execute_prepared(_SELECT_TEMPERATURE_DAYS, (name,))]
+    results = cassandra.execute_concurrent([(_SELECT_TEMPERATURE_STATS, (name, day)) for day in days])
+    maximum = minimum = None
+    total = 0.0
+    count = 0
+    for success, result in results:
+        day_maximum, day_minimum, day_total, day_count = result.one()
+        if not day_count:
+            continue
+        maximum = day_maximum if maximum is None else max(maximum, day_maximum)
+        minimum = day_minimum if minimum is None else min(minimum, day_minimum)
+        total += day_total
+        count += day_count
+    if not count:
+        return None
+    return maximum, minimum, total / count
+
+
+def store_latest_values(redis: RedisClient, messages: List[schemas.SensorDataMessage]):
+    # Only the newest reading of each sensor in the batch reaches Redis, and never one older than the stored one
+    latest = {}
+    for message in messages:
+        current = latest.get(message.sensor_id)
+        if current is None or _last_seen(current) <= _last_seen(message.data):
+            latest[message.sensor_id] = message.data
+    sensor_ids = list(latest.keys())
+    if not sensor_ids:
+        return
+    stored = redis.mget(sensor_ids)
+    newer = {}
+    for sensor_id, stored_data in zip(sensor_ids, stored):
+        data = latest[sensor_id]
+        if stored_data is not None and _last_seen(json.loads(stored_data)) > _last_seen(data):
+            continue
+        newer[sensor_id] = data.json()
+    if newer:
+        redis.set_many(newer)
+
+
+def check_times(message: schemas.SensorDataMessage):
+    # The stores parse both times, a reading with a wrong one would fail every batch it's in. Raises ValueError.
+    _to_datetime(message.time)
+    _to_datetime(message.data.last_seen)
+
+
+def _to_datetime(value: str) -> datetime:
+    return _as_utc(datetime.fromisoformat(value))
+
+
+def _as_utc(moment: datetime) -> datetime:
+    if moment.tzinfo is None:
+        return moment.replace(tzinfo=timezone.utc)
+    return moment.astimezone(timezone.utc)
+
+
+def _last_seen(data: schemas.SensorData | dict) -> datetime:
+    last_seen = data['last_seen'] if isinstance(data, dict) else data.last_seen
+    return _to_datetime(last_seen)
+
+
+def get_data(timescale: Timescale, mongo_client: MongoDBClient, db: Session, sensor_id: int,
+             dataCommand: DataCommand) -> Iterator[dict]:
+    interval = _get_interval(dataCommand.bucket)
+    sensor = _get_sensor_from_sensor_id(db=db, mongo_client=mongo_client, sensor_id=sensor_id)
+    columns = _get_data_columns(sensor.type)
+    query, moment = _get_bucket_query(columns, windowed=bool(rollups.get_window(sensor.type)), condition="name = %s")
+    values = [interval, sensor.name, dataCommand.from_time, dataCommand.to_time]
+    if dataCommand.after:
+        query += f" AND {moment} > %s GROUP BY period HAVING time_bucket(%s::interval, {moment}) > %s"
+        values += [dataCommand.after, interval, dataCommand.after]
+    else:
+        query += " GROUP BY period"
+    query += " ORDER BY period"
+    if dataCommand.limit:
+        query += " LIMIT %s"
+        values.append(dataCommand.limit)
+    keys = ('time',) + columns + ('battery_level', 'last_seen')
+    rows = timescale.stream(query, values)
+    if dataCommand.limit:
+        # A page is read whole to know if it's full, a page with fewer buckets than the limit is the last one
+        rows = list(rows)
+        if len(rows) == dataCommand.limit:
+            dataCommand.next_after = rows[-1][0]
+    if dataCommand.max_points:
+        rows = _downsample(list(rows), dataCommand.max_points)
+    return (_get_data_row(keys, row) for row in rows)
+
+
+def get_sensors_data(timescale: Timescale, mongo_client: MongoDBClient, db: Session, sensor_ids: List[int],
+                     dataCommand: DataCommand) -> dict:
+    # The buckets of several sensors at once, one column per value for each sensor. The sensors come from the
+    # read model in one call and their buckets from one query per table, instead of all of it per sensor.
+    interval = _get_interval(dataCommand.bucket)
+    sensors = _get_sensors_by_ids(db=db, mongo_client=mongo_client, sensor_ids=sensor_ids)
+    if len(sensors) < len(set(sensor_ids)):
+        raise FileNotFoundError
+    windowed = {}
+    for sensor in sensors.values():
+        windowed.setdefault(bool(rollups.get_window(sensor.type)), []).append(sensor.name)
+    columns = ('temperature', 'humidity', 'velocity')
+    rows_by_name = {}
+    for rollup, names in windowed.items():
+        query, _ = _get_bucket_query(columns, windowed=rollup, condition="name = ANY(%s)", by_name=True)
+        query += " GROUP BY name, period ORDER BY name, period"
+        for row in timescale.stream(query, [interval, names, dataCommand.from_time, dataCommand.to_time]):
+            rows_by_name.setdefault(row[0], []).append(row[1:])
+    result = {}
+    for sensor_id in sensor_ids:
+        sensor = sensors[sensor_id]
+        sensor_columns = _get_data_columns(sensor.type)
+        positions = [0] + [1 + columns.index(column) for column in sensor_columns] + [4, 5]
+        rows = [tuple(row[position] for position in positions) for row in rows_by_name.get(sensor.name, [])]
+        if dataCommand.max_points:
+            rows = _downsample(rows, dataCommand.max_points)
+        keys = ('time',) + sensor_columns + ('battery_level', 'last_seen')
+        result[str(sensor_id)] = dict({'name': sensor.name, 'type': sensor.type},
+                                      **{key: [_get_data_value(row[index]) for row in rows]
+                                         for index, key in enumerate(keys)})
+    return {'sensors': result}
+
+
+def _get_data_columns(sensor_type: str) -> tuple:
+    if sensor_type == 'Temperatura':
+        return ('temperature', 'humidity')
+    elif sensor_type == 'Velocitat':
+        return ('velocity',)
     else:
         raise TypeError
-    timescale.execute(query)
-    results = timescale.get_cursor().fetchall()
-    return results
 
 
-def delete_sensor(db: Session, redis: RedisClient, mongo_client: MongoDBClient, sensor_id: int):
+def _get_bucket_query(columns: tuple, windowed: bool, condition: str, by_name: bool = False) -> tuple:
+    # The select of the buckets of the sensors that match condition, and the moment of the rows it reads
+    name = "name, " if by_name else ""
+    if windowed:
+        # The averages of the windows weighted by their count are the averages of the readings. A window is in
+        # the range when any of its readings is, so the ends are as precise as the window.
+        averages = "".join(f"SUM({column}_sum) / SUM(count), " for column in columns + ('battery_level',))
+        return f"""
+            SELECT {name}time_bucket(%s::interval, bucket) AS period, {averages}MAX(last_seen)
+            FROM sensor_data_rollup
+            WHERE {condition} AND last_seen >= %s AND bucket <= %s
+        """, "bucket"
+    averages = "".join(f"AVG({column}), " for column in columns + ('battery_level',))
+    return f"""
+            SELECT {name}time_bucket(%s::interval, last_seen) AS period, {averages}MAX(last_seen)
+            FROM sensor_data
+            WHERE {condition} AND last_seen >= %s AND last_seen <= %s
+        """, "last_seen"
+
+
+def _get_sensors_by_ids(db: Session, mongo_client: MongoDBClient, sensor_ids: List[int]) -> dict:
+    # Like _get_sensors_by_names, by id
+    sensors = records.find_by_ids(mongo_client, sensor_ids)
+    missing = {sensor_id for sensor_id in sensor_ids if sensor_id not in sensors}
+    if missing:
+        db_sensors = db.query(models.Sensor).filter(models.Sensor.id.in_(missing)).all()
+        sensors.update({sensor.id: sensor for sensor in _join_sensors(mongo_client=mongo_client,
+                                                                      db_sensors=db_sensors).values()})
+    return sensors
+
+
+def _downsample(rows: List[tuple], max_points: int) -> List[tuple]:
+    # The points are chosen by the first value column, temperature or velocity, and whole rows are kept
+    if len(rows) <= max_points:
+        return rows
+    x = np.fromiter((row[0].timestamp() for row in rows), dtype=np.float64, count=len(rows))
+    y = np.array([row[1] for row in rows], dtype=np.float64)
+    return [rows[index] for index in downsampling.lttb(x, y, max_points)]
+
+
+def _get_data_row(keys: tuple, row: tuple) -> dict:
+    return {key: _get_data_value(value) for key, value in zip(keys, row)}
+
+
+def _get_data_value(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+
+def delete_sensor(db: Session, redis: RedisClient, mongo_client: MongoDBClient, sensor_id: int, publisher: Publisher):
     db_sensor = get_sensor(sensor_id=sensor_id, db=db)
     # Delete from mongo
     collection = mongo_client.getCollection(_SENSORS)
     collection.delete_one({"name": db_sensor.name})
+    # The record is deleted right away so its name can be reused, the deleted event only repairs it
+    records.delete(mongo_client, sensor_id)
     # Delete from redis
     redis.delete(sensor_id)
+    cache.bump(redis, cache.ALL)
     # Delete from SQL
     db.delete(db_sensor)
     db.commit()
+    publisher.publish(schemas.SensorEvent(event=SENSOR_DELETED, sensor_id=sensor_id, name=db_sensor.name),
+                      lane=CONTROL)
     return db_sensor
 
 
@@ -118,54 +612,60 @@ def get_sensors_near(db: Session, redis: RedisClient, mongo_client: MongoDBClien
     sensors = []
     collection = mongo_client.getCollection(_SENSORS)
     radius_in_degrees = radius / 111.12
-    sensors_dicts = collection.find({
+    names = [document['name'] for document in collection.find({
         'latitude': {'$gte': latitude - radius_in_degrees, '$lte': latitude + radius_in_degrees},
         'longitude': {'$gte': longitude - radius_in_degrees, '$lte': longitude + radius_in_degrees}
-    })
-    for sensor_dict in sensors_dicts:
-        sensor_create = schemas.SensorCreate(**sensor_dict)
-        db_sensor = db.query(models.Sensor).filter(models.Sensor.name == sensor_create.name).first()
-        sensor = _get_sensor_from_db_sensor_and_sensor_create(db_sensor=db_sensor, sensor_create=sensor_create)
-        try:
-            sensor_data = _get_data(redis=redis, sensor_id=db_sensor.id, type=sensor.type)
-        except ValueError:
+    }, {'_id': 0, 'name': 1})]
+    sensors_by_name = _get_sensors_by_names(db=db, mongo_client=mongo_client, names=names)
+    near = [sensors_by_name[name] for name in names if name in sensors_by_name]
+    # The latest values of all of them in one round trip
+    stored = redis.mget([sensor.id for sensor in near]) if near else []
+    for sensor, redis_data in zip(near, stored):
+        if redis_data is None:
             sensors.append(sensor)
         else:
-            sensor_with_data = _from_id_and_data_to_sensor(sensor=sensor, data=sensor_data)
-            sensors.append(sensor_with_data)
+            sensors.append(_from_id_and_data_to_sensor(sensor=sensor, data=_parse_data(redis_data, sensor.type)))
     return sensors
 
 
+def get_sensor_ids_in_box(db: Session, mongo_client: MongoDBClient, min_latitude: float, min_longitude: float,
+                          max_latitude: float, max_longitude: float) -> List[int]:
+    collection = mongo_client.getCollection(_SENSORS)
+    names = [document['name'] for document in collection.find({
+        'latitude': {'$gte': min_latitude, '$lte': max_latitude},
+        'longitude': {'$gte': min_longitude, '$lte': max_longitude}
+    }, {'name': 1})]
+    if not names:
+        return []
+    return [sensor_id for sensor_id, in db.query(models.Sensor.id).filter(models.Sensor.name.in_(names))]
+
+
 def search_sensors(db: Session, mongo_client: MongoDBClient, es: ElasticsearchClient, query: str, size: int = 10,
                    search_type: str = "match"):
     search_query = _get_query(query, size, search_type)
     result_search = es.search(_SENSORS, search_query)
-    results = []
-    for hit in result_search['hits']['hits']:
-        results.append(
-            _get_sensor_from_sensor_name(sensor_name=hit['_source']['name'], db=db, mongo_client=mongo_client))
-    return results
+    names = [hit['_source']['name'] for hit in result_search['hits']['hits']]
+    sensors_by_name = _get_sensors_by_names(db=db, mongo_client=mongo_client, names=names)
+    return [sensors_by_name[name] for name in names if name in sensors_by_name]
 
 
 def get_temperature_values(db: Session, mongo_client: MongoDBClient, cassandra: CassandraClient) -> SensorSet:
     sensor_set_items = []
     collection = mongo_client.getCollection(_SENSORS)
-    sensors_dicts = collection.find({"type": "Temperatura"})
-    for sensor_dict in sensors_dicts:
-        sensor = schemas.SensorCreate(**sensor_dict)
-        query = """
-            SELECT MAX(temperature), MIN(temperature), AVG(temperature)
-            FROM temperature_data
-            WHERE name  = %s
-            ALLOW FILTERING;
-        """
-        result = cassandra.execute(query, (sensor.name,))
-        max_temperature, min_temperature, avg_temperature = result.one()
-        values = TemperatureValues(max_temperature=max_temperature, min_temperature=min_temperature,
+    names = [document['name'] for document in collection.find({"type": "Temperatura"}, {'_id': 0, 'name': 1})]
+    sensors_by_name = _get_sensors_by_names(db=db, mongo_client=mongo_client, names=names)
+    for name in names:
+        sensor = sensors_by_name.get(name)
+        if sensor is None:
+            continue
+        stats = _get_temperature_stats(cassandra=cassandra, name=sensor.name)
+        if stats is None:
+            continue
+        max_temperature, min_temperature, avg_temperature = stats
+        values = TemperatureValues.construct(max_temperature=max_temperature, min_temperature=min_temperature,
                                    average_temperature=avg_temperature)
-        db_sensor = get_sensor_by_name(db=db, name=sensor.name)
         sensor_set_items.append(
-            SensorsSetTemperatureItem(id=db_sensor.id, name=sensor.name,
+            SensorsSetTemperatureItem.construct(id=sensor.id, name=sensor.name,
                                       latitude=sensor.latitude,
                                       longitude=sensor.longitude,
                                       type=sensor.type,
@@ -176,7 +676,7 @@ def get_temperature_values(db: Session, mongo_client: MongoDBClient, cassandra:
                                       firmware_version=sensor.firmware_version,
                                       description=sensor.description, values=values))
 
-    return SensorSet(sensors=sensor_set_items)
+    return SensorSet.construct(sensors=sensor_set_items)
 
 
 def get_sensors_quantity(cassandra: CassandraClient) -> SensorSet:
@@ -189,8 +689,8 @@ def get_sensors_quantity(cassandra: CassandraClient) -> SensorSet:
     """
     result = cassandra.execute(query)
     for item in result:
-        sensor_set_items.append(SensorsSetQuantityItem(quantity=item[1], type=item[0]))
-    return SensorSet(sensors=sensor_set_items)
+        sensor_set_items.append(SensorsSetQuantityItem.construct(quantity=item[1], type=item[0]))
+    return SensorSet.construct(sensors=sensor_set_items)
 
 
 def get_low_battery_sensors(db: Session, mongo_client: MongoDBClient, cassandra: CassandraClient) -> SensorSet:
@@ -198,14 +698,16 @@ def get_low_battery_sensors(db: Session, mongo_client: MongoDBClient, cassandra:
     query = """
         SELECT name,battery_level 
         FROM low_battery
-        WHERE battery_level <= 0.2
+        WHERE battery_level <= %s
         ALLOW FILTERING;
     """
-    result = cassandra.execute(query)
+    result = list(cassandra.execute(query, (LOW_BATTERY_LEVEL,)))
+    sensors_by_name = _get_sensors_by_names(db=db, mongo_client=mongo_client, names={item[0] for item in result})
     for item in result:
-        name = item[0]
-        sensor = _get_sensor_from_sensor_name(db=db, mongo_client=mongo_client, sensor_name=name)
-        sensor_set_items.append(SensorsSetLowBatteryItem(id=sensor.id, name=sensor.name,
+        sensor = sensors_by_name.get(item[0])
+        if sensor is None:
+            continue
+        sensor_set_items.append(SensorsSetLowBatteryItem.construct(id=sensor.id, name=sensor.name,
                                                          latitude=sensor.latitude,
                                                          longitude=sensor.longitude,
                                                          type=sensor.type,
@@ -216,31 +718,7 @@ def get_low_battery_sensors(db: Session, mongo_client: MongoDBClient, cassandra:
                                                          firmware_version=sensor.firmware_version,
                                                          description=sensor.description, battery_level=item[1]))
 
-    return SensorSet(sensors=sensor_set_items)
-
-
-def _insert_temperature_data(cassandra: CassandraClient, time, name, temperature):
-    insert_query = """
-        INSERT INTO temperature_data (time, name, temperature)
-        VALUES (%s, %s, %s)
-    """
-    cassandra.execute(insert_query, (time, name, temperature))
-
-
-def _insert_type_sensor(cassandra: CassandraClient, sensor_id: int, sensor_type: str):
-    insert_query = """
-            INSERT INTO type_sensor (sensor_type, id)
-            VALUES (%s, %s)
-        """
-    cassandra.execute(insert_query, (sensor_type, sensor_id))
-
-
-def _insert_battery_level(cassandra: CassandraClient, name: str, battery_level: float):
-    insert_query = """
-            INSERT INTO low_battery (battery_level, name)
-            VALUES (%s, %s)
-        """
-    cassandra.execute(insert_query, (battery_level, name))
+    return SensorSet.construct(sensors=sensor_set_items)
 
 
 def _get_query(query: str, size: int = 10, search_type: str = "match"):
@@ -277,19 +755,25 @@ def _get_data(redis: RedisClient, sensor_id: int, type: str) -> schemas.SensorDa
     redis_data = redis.get(sensor_id)
     if redis_data is None:
         raise ValueError
+    return _parse_data(redis_data, type)
+
+
+def _parse_data(redis_data: bytes, type: str) -> schemas.SensorData:
     # Parse json to dict
     data_dict = json.loads(redis_data)
     # get Sensor Data from dict
     match type:
         case 'Temperatura':
-            sensor_data = schemas.SensorDataTemperature(**data_dict)
+            sensor_data = schemas.SensorDataTemperature.construct(**data_dict)
         case 'Velocitat':
-            sensor_data = schemas.SensorDataVelocity(**data_dict)
+            sensor_data = schemas.SensorDataVelocity.construct(**data_dict)
         case _:
             raise TypeError
     return sensor_data
 
 
+# Everything built from here on comes from our own databases or from already validated requests, so the
+# models are created with construct() and skip validation
 def _from_id_and_data_to_sensor(sensor: schemas.Sensor, data: schemas.SensorData) -> schemas.Sensor:
     match sensor.type:
         case 'Temperatura':
@@ -297,7 +781,7 @@ def _from_id_and_data_to_sensor(sensor: schemas.Sensor, data: schemas.SensorData
                 raise NotCompatible(
                     "Conflict - The sensor with the specific id is of type temperature and you give data of velocity sensor")
 
-            return schemas.SensorTemperature(id=sensor.id, name=sensor.name, latitude=sensor.latitude,
+            return schemas.SensorTemperature.construct(id=sensor.id, name=sensor.name, latitude=sensor.latitude,
                                              longitude=sensor.longitude, type=sensor.type,
                                              mac_address=sensor.name, manufacturer=sensor.manufacturer,
                                              model=sensor.model, serie_number=sensor.serie_number,
@@ -308,7 +792,7 @@ def _from_id_and_data_to_sensor(sensor: schemas.Sensor, data: schemas.SensorData
             if type(data) is not schemas.SensorDataVelocity:
                 raise NotCompatible(
                     "Conflict - The sensor with the specific id is of type velocity and you give data of temperature sensor")
-            return schemas.SensorVelocity(id=sensor.id, name=sensor.name, latitude=sensor.latitude,
+            return schemas.SensorVelocity.construct(id=sensor.id, name=sensor.name, latitude=sensor.latitude,
                                           longitude=sensor.longitude, type=sensor.type,
                                           mac_address=sensor.name, manufacturer=sensor.manufacturer,
                                           model=sensor.model, serie_number=sensor.serie_number,
@@ -322,22 +806,47 @@ def _from_id_and_data_to_sensor(sensor: schemas.Sensor, data: schemas.SensorData
 def _get_sensor_from_sensor_id(db: Session, mongo_client: MongoDBClient, sensor_id: int) -> schemas.Sensor:
     db_sensor = get_sensor(sensor_id=sensor_id, db=db)
     collection = mongo_client.getCollection(_SENSORS)
-    sensor_dict = collection.find_one({"name": db_sensor.name})
-    sensor_create = schemas.SensorCreate(**sensor_dict)
+    sensor_dict = collection.find_one({"name": db_sensor.name}, _SENSOR_PROJECTION)
+    sensor_create = _get_sensor_create_from_document(sensor_dict)
     return _get_sensor_from_db_sensor_and_sensor_create(db_sensor=db_sensor, sensor_create=sensor_create)
 
 
 def _get_sensor_from_sensor_name(db: Session, mongo_client: MongoDBClient, sensor_name: str) -> schemas.Sensor:
     db_sensor = get_sensor_by_name(db, sensor_name)
     collection = mongo_client.getCollection(_SENSORS)
-    sensor_dict = collection.find_one({"name": sensor_name})
-    sensor_create = schemas.SensorCreate(**sensor_dict)
+    sensor_dict = collection.find_one({"name": sensor_name}, _SENSOR_PROJECTION)
+    sensor_create = _get_sensor_create_from_document(sensor_dict)
     return _get_sensor_from_db_sensor_and_sensor_create(db_sensor=db_sensor, sensor_create=sensor_create)
 
 
+def _get_sensors_by_names(db: Session, mongo_client: MongoDBClient, names) -> dict:
+    # Complete sensors from the read model in one call. A sensor created so recently that the consumer hasn't
+    # added it yet is joined from Postgres and the sensors collection as before.
+    sensors = records.find_by_names(mongo_client, names)
+    missing = {name for name in names if name not in sensors}
+    if missing:
+        db_sensors = db.query(models.Sensor).filter(models.Sensor.name.in_(missing)).all()
+        sensors.update(_join_sensors(mongo_client=mongo_client, db_sensors=db_sensors))
+    return sensors
+
+
+def _join_sensors(mongo_client: MongoDBClient, db_sensors: List[models.Sensor]) -> dict:
+    documents = mongo_client.find_by_names(_SENSORS, [db_sensor.name for db_sensor in db_sensors], _SENSOR_PROJECTION)
+    return {db_sensor.name: _get_sensor_from_db_sensor_and_sensor_create(
+                db_sensor=db_sensor, sensor_create=_get_sensor_create_from_document(documents[db_sensor.name]))
+            for db_sensor in db_sensors if db_sensor.name in documents}
+
+
+def _get_sensor_create_from_document(sensor_dict: dict) -> schemas.SensorCreate:
+    # The documents were validated before being inserted, so they are not validated again. Keys that are
+    # not fields, like _id, are left out
+    return schemas.SensorCreate.construct(
+        **{name: sensor_dict[name] for name in schemas.SensorCreate.__fields__ if name in sensor_dict})
+
+
 def _get_sensor_from_db_sensor_and_sensor_create(db_sensor: models.Sensor,
                                                  sensor_create: schemas.SensorCreate) -> schemas.Sensor:
-    return schemas.Sensor(id=db_sensor.id, name=sensor_create.name,
+    return schemas.Sensor.construct(id=db_sensor.id, name=sensor_create.name,
                           latitude=sensor_create.latitude,
                           longitude=sensor_create.longitude,
                           type=sensor_create.type,
@@ -360,16 +869,24 @@ def _add_sensor_to_postgres(db: Session, sensor: schemas.SensorCreate) -> models
     return db_sensor
 
 
-def _getView(bucket: str) -> str:
+def _get_interval(bucket: str) -> str:
     if bucket == 'year':
-        return 'sensor_data_yearly'
+        return '1 year'
     if bucket == 'month':
-        return 'sensor_data_monthly'
+        return '1 month'
     if bucket == 'week':
-        return 'sensor_data_weekly'
+        return '1 week'
     if bucket == 'day':
-        return 'sensor_data_daily'
+        return '1 day'
     elif bucket == 'hour':
-        return 'sensor_data_hourly'
-    else:
-        raise ValueError("Invalid bucket size")
\ No newline at end of file
+        return '1 hour'
+    match = _INTERVAL.match(bucket.lower())
+    if match is None or match.group(2) not in _INTERVAL_UNITS or int(match.group(1)) == 0:
+        raise InvalidParameter("bucket must be year, month, week, day, hour or a size like 15m or 2 hours")
+    # Sent as a bound parameter, only its parts are taken from the request
+    return f"{int(match.group(1))} {_INTERVAL_UNITS[match.group(2)]}"
+
+
+def _get_bucket_for_points(from_time: datetime, to_time: datetime, max_points: int) -> str:
+    seconds = (to_time - from_time).total_seconds()
+    return f"{max(1, int(seconds / (max_points * _BUCKETS_PER_POINT)))} seconds"
@@ -0,0 +1,94 @@
+import os
+from datetime import datetime, timezone
+
+# Readings of the listed types are also aggregated in windows of that many seconds, for example
+# ROLLUP_WINDOWS="Velocitat=10,Temperatura=60". Types that aren't listed only keep their raw readings.
+ROLLUP_WINDOWS = {sensor_type.strip(): int(seconds)
+                  for sensor_type, seconds in (item.split('=') for item in os.environ.get("ROLLUP_WINDOWS", "").split(',')
+                                               if item.strip())}
+# Types whose raw readings are still written to sensor_data, all of them by default. Once a type has a window
+# it can be left out of here to write only its windows.
+RAW_TYPES = {sensor_type.strip() for sensor_type in os.environ.get("RAW_TYPES", "Temperatura,Velocitat").split(',')
+             if sensor_type.strip()}
+# Raw readings older than this interval are deleted, they are kept forever when it's empty
+RAW_RETENTION = os.environ.get("RAW_RETENTION", "")
+
+FIELDS = ('temperature', 'humidity', 'velocity', 'battery_level')
+_FIELDS_BY_TYPE = {
+    'Temperatura': ('temperature', 'humidity', 'battery_level'),
+    'Velocitat': ('velocity', 'battery_level'),
+}
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+class Window:
+    __slots__ = ('bucket', 'name', 'count', 'stats', 'last_seen')
+
+    def __init__(self, bucket: datetime, name: str):
+        self.bucket = bucket
+        self.name = name
+        self.count = 0
+        # min, max, sum and last of each field
+        self.stats = {}
+        self.last_seen = None
+
+    def add(self, values: dict, last_seen: datetime):
+        is_last = self.last_seen is None or last_seen >= self.last_seen
+        for field, value in values.items():
+            stats = self.stats.get(field)
+            if stats is None:
+                self.stats[field] = [value, value, value, value]
+                continue
+            stats[0] = min(stats[0], value)
+            stats[1] = max(stats[1], value)
+            stats[2] += value
+            if is_last:
+                stats[3] = value
+        self.count += 1
+        if is_last:
+            self.last_seen = last_seen
+
+    def to_row(self) -> tuple:
+        row = [self.bucket, self.name, self.count]
+        for field in FIELDS:
+            row.extend(self.stats.get(field, (None, None, None, None)))
+        row.append(self.last_seen)
+        return tuple(row)
+
+
+def get_window(sensor_type: str) -> int | None:
+    return ROLLUP_WINDOWS.get(sensor_type)
+
+
+def get_bucket(sensor_type: str, last_seen: datetime) -> datetime | None:
+    # The start of the window of a reading, in UTC without time zone like the rollup table
+    window = get_window(sensor_type)
+    if not window:
+        return None
+    seconds = int((last_seen - _EPOCH).total_seconds())
+    return datetime.fromtimestamp(seconds - seconds % window, timezone.utc).replace(tzinfo=None)
+
+
+def get_windowed_columns() -> list:
+    # Raw rows have no type, a row is of a type when the first field of that type isn't null
+    return [_FIELDS_BY_TYPE[sensor_type][0] for sensor_type in ROLLUP_WINDOWS if sensor_type in _FIELDS_BY_TYPE]
+
+
+def keeps_raw(sensor_type: str) -> bool:
+    return sensor_type in RAW_TYPES or sensor_type not in ROLLUP_WINDOWS
+
+
+def aggregate(readings) -> list:
+    # Readings are (type, name, data, last_seen) with last_seen in UTC. The windows only hold the readings
+    # given here, the rollup table merges them with what a window already had.
+    windows = {}
+    for sensor_type, name, data, last_seen in readings:
+        bucket = get_bucket(sensor_type, last_seen)
+        if bucket is None:
+            continue
+        key = (name, bucket)
+        if key not in windows:
+            windows[key] = Window(bucket, name)
+        values = {field: getattr(data, field) for field in _FIELDS_BY_TYPE[sensor_type]}
+        windows[key].add(values, last_seen.replace(tzinfo=None))
+    return [window.to_row() for window in windows.values()]
@@ -1,6 +1,13 @@
+from typing import List, Optional
+
+import orjson
 from pydantic import BaseModel
 
 
+def _orjson_dumps(value, *, default):
+    return orjson.dumps(value, default=default).decode()
+
+
 class Sensor(BaseModel):
     id: int
     name: str
@@ -44,12 +51,22 @@ class SensorCreate(BaseModel):
     description: str
 
 
+class SensorBatchResult(BaseModel):
+    # The outcome of one of the sensors of a batch registration, in the order they were sent
+    name: str
+    created: bool
+    sensor: Optional[Sensor] = None
+    detail: Optional[str] = None
+
+
 class SensorData(BaseModel):
     battery_level: float
     last_seen: str
 
     class Config:
         orm_mode = True
+        json_loads = orjson.loads
+        json_dumps = _orjson_dumps
 
 
 class SensorDataTemperature(SensorData):
@@ -87,4 +104,63 @@ class SensorsSetQuantityItem(BaseModel):
 
 
 class SensorSet(BaseModel):
-    sensors: list[SensorsSetTemperatureItem | SensorsSetQuantityItem | SensorsSetLowBatteryItem]
\ No newline at end of file
+    sensors: list[SensorsSetTemperatureItem | SensorsSetQuantityItem | SensorsSetLowBatteryItem]
+
+    class Config:
+        json_dumps = _orjson_dumps
+
+class SensorDataMessage(BaseModel):
+    message_id: str
+    sensor_id: int
+    name: str
+    type: str
+    time: str
+    data: SensorDataTemperature | SensorDataVelocity
+
+    class Config:
+        json_loads = orjson.loads
+        json_dumps = _orjson_dumps
+
+    def to_json(self):
+        return self.json()
+
+
+class SensorDataBatch(BaseModel):
+    readings: List[SensorDataMessage]
+
+    class Config:
+        json_dumps = _orjson_dumps
+
+    def to_json(self):
+        return self.json()
+
+
+class SensorEvent(BaseModel):
+    event: str
+    sensor_id: int
+    name: str
+    # The whole sensor in created events, for the read model of the consumer
+    sensor: Optional[Sensor] = None
+    joined_at: Optional[str] = None
+
+    def to_json(self):
+        return self.json()
+
+
+class SensorEventBatch(BaseModel):
+    # The events of a batch registration, in one message
+    events: List[SensorEvent]
+
+    def to_json(self):
+        return self.json()
+
+
+class SensorAlert(BaseModel):
+    alert: str
+    sensor_id: int
+    name: str
+    value: float
+    last_seen: str
+
+    def to_json(self):
+        return self.json()
@@ -0,0 +1,32 @@
+import os
+
+# Readings are spread over this many queues by sensor. Changing it moves sensors between queues, so it is
+# only changed with the queues drained
+SHARDS = int(os.environ.get("QUEUE_SHARDS", "16"))
+
+_MASK = (1 << 64) - 1
+
+
+def jump_hash(key: int, buckets: int) -> int:
+    # Jump consistent hash: when buckets grows from n to n + 1 only 1/(n + 1) of the keys move
+    key &= _MASK
+    bucket, candidate = -1, 0
+    while candidate < buckets:
+        bucket = candidate
+        key = (key * 2862933555777941757 + 1) & _MASK
+        candidate = int((bucket + 1) * ((1 << 31) / ((key >> 33) + 1)))
+    return bucket
+
+
+def get_shard(sensor_id: int) -> int:
+    return jump_hash(_mix(sensor_id), SHARDS)
+
+
+def get_owned_shards(consumer_index: int, consumer_count: int) -> list[int]:
+    # The same hash assigns shards to consumers, so adding a consumer only takes shards from the others
+    return [shard for shard in range(SHARDS) if jump_hash(_mix(shard), consumer_count) == consumer_index]
+
+
+def _mix(value: int) -> int:
+    # Ids are consecutive, they are spread first so neighbours don't start the same hash sequence
+    return value * 0x9E3779B97F4A7C15
@@ -1,21 +1,16 @@
-import pika
 import time
 
-from shared.publisher import QUEUE_NAME
+from shared import tracing
+from shared.publisher import CONNECTION_ERRORS, QUEUE_NAME, backoff, connect, declare_queues, get_parameters
+
+# The consumer can wait for the broker much longer than a request can
+_CONNECT_ATTEMPTS = 20
+_IDLE_WAIT = 1.0
 
 class Subscriber:
-    def __init__(self):
-        credentials = pika.PlainCredentials('guest', 'guest')
+    def __init__(self, host='localhost'):
         # Change the host to rabbitmq
-        parameters = pika.ConnectionParameters('localhost',
-                                       5672,
-                                       '/',
-                                       credentials)
-        try:
-            self.conn = pika.BlockingConnection(parameters)
-        except Exception as e:
-            time.sleep(10)
-            self.conn = pika.BlockingConnection(parameters)
+        self.conn = connect(get_parameters(host), attempts=_CONNECT_ATTEMPTS)
         self.channel = self.conn.channel()
 
 
@@ -24,7 +19,137 @@ class Subscriber:
         self.channel.basic_consume(queue=QUEUE_NAME, on_message_callback=callback, auto_ack=True)
         self.channel.start_consuming()
 
+    def subscribe_lanes(self, lanes, tick=None):
+        # Every lane has its own channel, so its prefetch and its acks don't depend on the other lanes. In each
+        # round a lane flushes up to weight batches, lanes listed first go first. tick is called after every
+        # round, at least once a second.
+        for lane in lanes:
+            lane.open(self.conn)
+        while True:
+            self.conn.process_data_events(time_limit=min(lane.get_wait() for lane in lanes))
+            for lane in lanes:
+                for _ in range(lane.weight):
+                    if not lane.is_due():
+                        break
+                    lane.flush()
+                    self.conn.process_data_events(time_limit=0)
+            if tick is not None:
+                tick()
+
     def close(self):
         self.conn.close()
 
-    
\ No newline at end of file
+
+class Lane:
+    def __init__(self, queues, callback, batch_size=500, flush_interval=1.0, weight=1,
+                 retry_errors=CONNECTION_ERRORS):
+        # The callback receives the bodies of a whole batch, in delivery order for each queue. The batch is
+        # acked only once the callback returns, so if the consumer dies in the middle of a flush every message
+        # of the batch is redelivered. A batch that fails with one of retry_errors, the errors of a service that
+        # is down, stays unacked at the head of the lane and is flushed again after a backoff, while the other
+        # lanes go on. With any other error the messages that fail on their own are dead-lettered and the rest
+        # acked.
+        self.queues = queues
+        self.callback = callback
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.weight = weight
+        self.retry_errors = retry_errors
+        self.channel = None
+        self.batch = []
+        self.deadline = None
+        self.attempt = 0
+        self.retry_at = 0.0
+
+    def open(self, conn):
+        self.channel = conn.channel()
+        declare_queues(self.channel)
+        self.channel.basic_qos(prefetch_count=self.batch_size * 2)
+        for queue in self.queues:
+            self.channel.basic_consume(queue=queue, on_message_callback=self.on_message)
+
+    def on_message(self, channel, method, properties, body):
+        if not self.batch:
+            self.deadline = time.monotonic() + self.flush_interval
+        self.batch.append((method.delivery_tag, body, properties, time.time_ns()))
+
+    def get_wait(self):
+        # Waiting for events returns as soon as a message arrives, so an idle lane can wait long
+        if not self.batch:
+            return _IDLE_WAIT
+        if self.retry_at > time.monotonic():
+            return self.retry_at - time.monotonic()
+        return max(0.0, self.deadline - time.monotonic())
+
+    def is_due(self):
+        now = time.monotonic()
+        return bool(self.batch) and now >= self.retry_at and (len(self.batch) >= self.batch_size
+                                                              or now >= self.deadline)
+
+    def flush(self):
+        batch = self.batch[:self.batch_size]
+        del self.batch[:self.batch_size]
+        failed = []
+        try:
+            try:
+                with tracing.continue_traces(_get_trace_parents(batch)), \
+                        tracing.span("process batch", size=len(batch)):
+                    self.callback([body for _, body, _, _ in batch])
+            except self.retry_errors:
+                raise
+            except Exception as e:
+                print("Batch of %d messages failed, looking for the ones that fail it: %s" % (len(batch), e))
+                failed = self._find_failing(batch)
+        except self.retry_errors as e:
+            self.batch[:0] = batch
+            self.retry_at = time.monotonic() + backoff(self.attempt)
+            self.attempt += 1
+            print("Batch of %d messages failed, trying it again (attempt %d): %s" % (len(batch), self.attempt, e))
+            return
+        self.attempt = 0
+        # Without requeue they go to the dead letter exchange of their queue
+        for tag, body, _, _ in failed:
+            print("Dead-lettered message:", body)
+            self.channel.basic_nack(delivery_tag=tag, requeue=False)
+        failed_tags = {tag for tag, _, _, _ in failed}
+        acked = [tag for tag, _, _, _ in batch if tag not in failed_tags]
+        # Delivery tags are per channel, so one multiple ack covers the batch of every queue of the lane
+        if acked:
+            self.channel.basic_ack(delivery_tag=acked[-1], multiple=True)
+        self.deadline = time.monotonic() + self.flush_interval
+
+    def _find_failing(self, batch):
+        # Each half of a failed batch is run on its own, down to the messages that fail alone. The callback is
+        # idempotent, so running again the part of the batch that got through before the error does no harm:
+        # the consumer marks the readings it stored as seen before it publishes anything about them, and skips
+        # the seen ones, so the live feed and the alerts of a reading are published once.
+        if len(batch) == 1:
+            return batch
+        middle = len(batch) // 2
+        failed = []
+        for half in (batch[:middle], batch[middle:]):
+            try:
+                self.callback([body for _, body, _, _ in half])
+            except self.retry_errors:
+                raise
+            except Exception:
+                failed.extend(self._find_failing(half))
+        return failed
+
+
+def _get_trace_parents(batch):
+    # The time each traced message waited in the queue and then in the batch, in its own trace
+    if not tracing.is_enabled():
+        return []
+    flushed = time.time_ns()
+    parents = []
+    for _, _, properties, received in batch:
+        headers = properties.headers if properties is not None and properties.headers else {}
+        parent = tracing.parse_traceparent(headers.get(tracing.TRACEPARENT, ''))
+        if parent is None:
+            continue
+        if headers.get(tracing.PUBLISHED_AT):
+            tracing.record_span("queue wait", parent, headers[tracing.PUBLISHED_AT], received)
+        tracing.record_span("batch wait", parent, received, flushed)
+        parents.append(parent)
+    return parents
@@ -1,10 +1,37 @@
+import csv
+import functools
+import io
 import os
+import uuid
 
 import psycopg2
+from psycopg2.extras import execute_values
 
+from shared.timing import timed
 
+# Errors of a lost or refused connection, after them the connection has to be opened again
+ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError)
+
+
+def _rolled_back_on_error(method):
+    # Any error aborts the transaction and every statement after it would fail until it's rolled back, so it's
+    # rolled back before the error is seen by the caller, whatever kind it is
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        try:
+            return method(self, *args, **kwargs)
+        except Exception:
+            self.rollback()
+            raise
+    return wrapper
+
+
+@timed("timescale")
 class Timescale:
     def __init__(self):
+        self.connect()
+
+    def connect(self):
         self.conn = psycopg2.connect(
             host=os.environ.get("TS_HOST"),
             port=os.environ.get("TS_PORT"),
@@ -16,7 +43,7 @@ class Timescale:
     def create_table(self):
         query = """
         CREATE TABLE IF NOT EXISTS sensor_data (
-            time timestamp DEFAULT NOW() PRIMARY KEY ,
+            time timestamp NOT NULL DEFAULT NOW(),
             name VARCHAR(255) NOT NULL,
             temperature FLOAT,
             humidity FLOAT,
@@ -24,6 +51,42 @@ class Timescale:
             battery_level FLOAT NOT NULL,
             last_seen timestamp NOT NULL
         );
+        CREATE TABLE IF NOT EXISTS sensor_data_rollup (
+            bucket timestamp NOT NULL,
+            name VARCHAR(255) NOT NULL,
+            count INTEGER NOT NULL,
+            temperature_min FLOAT,
+            temperature_max FLOAT,
+            temperature_sum FLOAT,
+            temperature_last FLOAT,
+            humidity_min FLOAT,
+            humidity_max FLOAT,
+            humidity_sum FLOAT,
+            humidity_last FLOAT,
+            velocity_min FLOAT,
+            velocity_max FLOAT,
+            velocity_sum FLOAT,
+            velocity_last FLOAT,
+            battery_level_min FLOAT,
+            battery_level_max FLOAT,
+            battery_level_sum FLOAT,
+            battery_level_last FLOAT,
+            last_seen timestamp NOT NULL,
+            UNIQUE (name, bucket)
+        );
+        DROP TABLE IF EXISTS sensor_data_rollup_applied;
+        DO $$
+        BEGIN
+            IF EXISTS (SELECT 1 FROM pg_constraint WHERE conname = 'sensor_data_pkey') THEN
+                ALTER TABLE sensor_data DROP CONSTRAINT sensor_data_pkey;
+            END IF;
+            IF NOT EXISTS (SELECT 1 FROM pg_indexes WHERE indexname = 'sensor_data_name_time_key') THEN
+                CREATE UNIQUE INDEX sensor_data_name_time_key ON sensor_data (name, time);
+            END IF;
+            IF NOT EXISTS (SELECT 1 FROM pg_indexes WHERE indexname = 'sensor_data_name_last_seen_idx') THEN
+                CREATE INDEX sensor_data_name_last_seen_idx ON sensor_data (name, last_seen);
+            END IF;
+        END $$;
         """
         self.execute(query)
         self.conn.commit()
@@ -35,9 +98,23 @@ class Timescale:
         self.cursor.close()
         self.conn.close()
 
+    def reconnect(self):
+        if not self.conn.closed:
+            self.conn.close()
+        self.connect()
+
     def ping(self):
         return self.conn.ping()
 
+    def rollback(self):
+        # Errors of a lost connection are left to the caller, there is nothing to roll back
+        if not self.conn.closed:
+            try:
+                self.conn.rollback()
+            except ERRORS:
+                pass
+
+    @_rolled_back_on_error
     def execute(self, query, values=None):
         if values:
             self.cursor.execute(query, values)
@@ -45,6 +122,52 @@ class Timescale:
             self.cursor.execute(query)
         self.conn.commit()
 
+    @_rolled_back_on_error
+    def fetch_values(self, query, rows) -> list:
+        # The rows a statement over the given rows returns, without committing: the statement that commits next
+        # takes it along
+        return execute_values(self.cursor, query, rows, fetch=True)
+
+    @_rolled_back_on_error
+    def commit(self):
+        self.conn.commit()
+
+    def stream(self, query, values=None, itersize=2000):
+        # A named cursor keeps the result on the server and brings it itersize rows at a time
+        try:
+            with self.conn.cursor(name=f"stream_{uuid.uuid4().hex}") as cursor:
+                cursor.itersize = itersize
+                cursor.execute(query, values)
+                for row in cursor:
+                    yield row
+            self.conn.commit()
+        except Exception:
+            self.rollback()
+            raise
+
+    @_rolled_back_on_error
+    def execute_values(self, query, rows):
+        # Sends all the rows in one statement and commits once
+        execute_values(self.cursor, query, rows)
+        self.conn.commit()
+
+    @_rolled_back_on_error
+    def copy_rows(self, table, columns, rows):
+        # COPY goes through a temporary staging table so rows that already exist are skipped instead of
+        # aborting the whole chunk
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows(rows)
+        buffer.seek(0)
+        staging = f"{table}_staging"
+        column_list = ", ".join(columns)
+        self.cursor.execute(
+            f"CREATE TEMP TABLE IF NOT EXISTS {staging} (LIKE {table} INCLUDING DEFAULTS) ON COMMIT DELETE ROWS")
+        self.cursor.copy_expert(f"COPY {staging} ({column_list}) FROM STDIN WITH (FORMAT csv)", buffer)
+        self.cursor.execute(
+            f"INSERT INTO {table} ({column_list}) SELECT {column_list} FROM {staging} ON CONFLICT DO NOTHING")
+        self.conn.commit()
+
+    @_rolled_back_on_error
     def delete(self, table):
         self.cursor.execute("DELETE FROM " + table)
         self.conn.commit()
\ No newline at end of file
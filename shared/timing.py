@@ -0,0 +1,114 @@
+import functools
+import inspect
+import time
+from contextvars import ContextVar
+
+from pymongo import monitoring
+from sqlalchemy import event
+
+# Calls and seconds spent in each backend during the current request, None outside of a request
+_timings: ContextVar[dict | None] = ContextVar("backend_timings", default=None)
+# Set while a timed method runs, so the methods it calls on its own client aren't counted twice
+_inside: ContextVar[bool] = ContextVar("inside_timed_call", default=False)
+
+
+def start() -> dict:
+    # The dict is shared with the threads and tasks started from here, so what they record is seen here too
+    timings = {}
+    _timings.set(timings)
+    return timings
+
+
+def record(backend: str, seconds: float, calls: int = 1):
+    timings = _timings.get()
+    if timings is None:
+        return
+    totals = timings.get(backend)
+    if totals is None:
+        timings[backend] = [calls, seconds]
+    else:
+        totals[0] += calls
+        totals[1] += seconds
+
+
+def server_timing(timings: dict) -> str:
+    return ", ".join(f'{backend};desc="{calls} calls";dur={seconds * 1000:.1f}'
+                     for backend, (calls, seconds) in timings.items())
+
+
+def summary(timings: dict) -> dict:
+    return {backend: {"calls": calls, "ms": round(seconds * 1000, 1)} for backend, (calls, seconds) in timings.items()}
+
+
+def timed(backend: str):
+    # Class decorator: every public method and the constructor, which connects, record their calls and time
+    # under backend
+    def decorate(cls):
+        for name, method in list(vars(cls).items()):
+            if (name == "__init__" or not name.startswith("_")) and inspect.isfunction(method):
+                setattr(cls, name, _wrap(backend, method))
+        return cls
+    return decorate
+
+
+def _wrap(backend: str, method):
+    if inspect.isgeneratorfunction(method):
+        # Results read lazily are timed while they are read, that's when the backend is waited for
+        @functools.wraps(method)
+        def generator_wrapper(*args, **kwargs):
+            iterator = method(*args, **kwargs)
+            record(backend, 0.0)
+            try:
+                while True:
+                    try:
+                        item = _call(backend, next, iterator, calls=0)
+                    except StopIteration:
+                        return
+                    yield item
+            finally:
+                iterator.close()
+        return generator_wrapper
+
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        return _call(backend, method, *args, **kwargs)
+    return wrapper
+
+
+def _call(backend: str, function, *args, calls: int = 1, **kwargs):
+    if _inside.get() or _timings.get() is None:
+        return function(*args, **kwargs)
+    token = _inside.set(True)
+    started = time.perf_counter()
+    try:
+        return function(*args, **kwargs)
+    finally:
+        record(backend, time.perf_counter() - started, calls=calls)
+        _inside.reset(token)
+
+
+def instrument_engine(engine, backend: str):
+    # Every statement sent through the engine, so the queries of the ORM sessions too
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("timing_started", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        record(backend, time.perf_counter() - conn.info["timing_started"].pop())
+
+
+class MongoCommandTimer(monitoring.CommandListener):
+    # Collections and cursors send their commands without going through MongoDBClient, so they are timed by
+    # the driver. The events are published in the thread that runs the command.
+    def __init__(self, backend: str):
+        self.backend = backend
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        record(self.backend, event.duration_micros / 1e6)
+
+    def failed(self, event):
+        record(self.backend, event.duration_micros / 1e6)
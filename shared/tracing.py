@@ -0,0 +1,184 @@
+import json
+import os
+import queue
+import random
+import threading
+import time
+import urllib.request
+from collections import namedtuple
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+# Traces start at the API, go to the consumer in the headers of the messages and are exported as OTLP JSON,
+# either to a collector (OTLP_ENDPOINT, for example http://collector:4318/v1/traces) or to a file of JSON lines
+# (TRACE_FILE). With neither of them set nothing is traced.
+OTLP_ENDPOINT = os.environ.get("OTLP_ENDPOINT", "")
+TRACE_FILE = os.environ.get("TRACE_FILE", "")
+SERVICE_NAME = os.environ.get("SERVICE_NAME", "sensors")
+# Share of the requests that are traced
+SAMPLE_RATIO = float(os.environ.get("TRACE_SAMPLE_RATIO", "1.0"))
+
+TRACEPARENT = 'traceparent'
+# Nanoseconds since the epoch when the message was published, for the time it waited in the queue
+PUBLISHED_AT = 'x-published-at'
+_EXPORT_BATCH = 512
+_EXPORT_INTERVAL = 1.0
+_EXPORT_QUEUE = 10000
+
+SpanContext = namedtuple('SpanContext', ['trace_id', 'span_id'])
+
+# The spans the current work belongs to: the one of the request in the API, one per traced message of the
+# batch in the consumer, where each operation on the batch is recorded once in every trace
+_parents: ContextVar[tuple] = ContextVar("trace_parents", default=())
+
+
+def is_enabled() -> bool:
+    return _exporter is not None
+
+
+@contextmanager
+def start_trace(name: str, traceparent: str | None = None, **attributes):
+    # The root span of a request, or a child of the caller's span when it sent a traceparent
+    parent = parse_traceparent(traceparent) if traceparent else None
+    if _exporter is None or (parent is None and random.random() >= SAMPLE_RATIO):
+        yield
+        return
+    if parent is None:
+        parent = SpanContext(_new_id(16), None)
+    token = _parents.set((parent,))
+    try:
+        with span(name, **attributes):
+            yield
+    finally:
+        _parents.reset(token)
+
+
+@contextmanager
+def span(name: str, **attributes):
+    parents = _parents.get()
+    if not parents:
+        yield
+        return
+    children = tuple(SpanContext(parent.trace_id, _new_id(8)) for parent in parents)
+    token = _parents.set(children)
+    start = time.time_ns()
+    try:
+        yield
+    finally:
+        end = time.time_ns()
+        _parents.reset(token)
+        for parent, child in zip(parents, children):
+            _export(name, child, parent.span_id, start, end, attributes)
+
+
+@contextmanager
+def continue_traces(parents: list):
+    # Work done from here on is recorded in the traces of every given span
+    token = _parents.set(tuple(parents))
+    try:
+        yield
+    finally:
+        _parents.reset(token)
+
+
+def record_span(name: str, parent: SpanContext, start: int, end: int, **attributes) -> SpanContext:
+    # A span whose times were measured elsewhere, like the wait in the queue
+    child = SpanContext(parent.trace_id, _new_id(8))
+    _export(name, child, parent.span_id, start, end, attributes)
+    return child
+
+
+def inject() -> dict:
+    # Headers that carry the current span to whoever receives the message
+    parents = _parents.get()
+    if len(parents) != 1:
+        return {}
+    parent = parents[0]
+    return {TRACEPARENT: f"00-{parent.trace_id}-{parent.span_id}-01", PUBLISHED_AT: time.time_ns()}
+
+
+def parse_traceparent(traceparent: str) -> SpanContext | None:
+    # Only sampled traces are continued
+    parts = traceparent.split('-')
+    if len(parts) != 4 or len(parts[1]) != 32 or len(parts[2]) != 16 or parts[3] not in ('01', '03'):
+        return None
+    return SpanContext(parts[1], parts[2])
+
+
+def _new_id(size: int) -> str:
+    return random.getrandbits(size * 8).to_bytes(size, 'big').hex()
+
+
+def _export(name, context, parent_id, start, end, attributes):
+    span = {
+        "traceId": context.trace_id,
+        "spanId": context.span_id,
+        "name": name,
+        "startTimeUnixNano": str(start),
+        "endTimeUnixNano": str(end),
+        "attributes": [{"key": key, "value": {"stringValue": str(value)}} for key, value in attributes.items()],
+    }
+    if parent_id:
+        span["parentSpanId"] = parent_id
+    _exporter.add(span)
+
+
+class _Exporter:
+    # Spans are sent from a background thread in batches, and dropped if they come faster than they are sent
+
+    def __init__(self, send):
+        self.send = send
+        self.spans = queue.Queue(maxsize=_EXPORT_QUEUE)
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def add(self, span: dict):
+        if self.thread is None:
+            with self.lock:
+                if self.thread is None:
+                    self.thread = threading.Thread(target=self._run, name="trace-exporter", daemon=True)
+                    self.thread.start()
+        try:
+            self.spans.put_nowait(span)
+        except queue.Full:
+            pass
+
+    def _run(self):
+        while True:
+            spans = [self.spans.get()]
+            deadline = time.monotonic() + _EXPORT_INTERVAL
+            while len(spans) < _EXPORT_BATCH:
+                try:
+                    spans.append(self.spans.get(timeout=max(0.0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            try:
+                self.send({"resourceSpans": [{
+                    "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": SERVICE_NAME}}]},
+                    "scopeSpans": [{"scope": {"name": "sensors"}, "spans": spans}],
+                }]})
+            except OSError as e:
+                print("Could not export %d spans: %s" % (len(spans), e))
+
+
+def _send_to_collector(payload: dict):
+    request = urllib.request.Request(OTLP_ENDPOINT, data=json.dumps(payload).encode(),
+                                     headers={"Content-Type": "application/json"}, method="POST")
+    with urllib.request.urlopen(request, timeout=5):
+        pass
+
+
+def _append_to_file(payload: dict):
+    with open(TRACE_FILE, "a") as file:
+        file.write(json.dumps(payload) + "\n")
+
+
+def _get_exporter() -> _Exporter | None:
+    if OTLP_ENDPOINT:
+        return _Exporter(_send_to_collector)
+    if TRACE_FILE:
+        return _Exporter(_append_to_file)
+    return None
+
+
+_exporter = _get_exporter()